@@ -46,15 +46,50 @@ export async function POST(request: NextRequest) {
     // Forward image to Python service
     const forwardFormData = new FormData();
     forwardFormData.append('image', imageFile);
+    // Grad-CAM heatmap of the regions behind the prediction
+    const explain = incomingFormData.get('explain');
+    if (typeof explain === 'string') {
+      forwardFormData.append('explain', explain);
+    }
 
+    const timeoutMs = 30000;
     const response = await fetch(`${PYTHON_SERVICE_URL}/predict`, {
       method: 'POST',
       body: forwardFormData,
+      // The service drops the request if it cannot start inference before we give up
+      headers: { 'X-Request-Deadline': String(Date.now() + timeoutMs) },
+      signal: AbortSignal.timeout(timeoutMs),
     });
 
     if (!response.ok) {
-      const errorText = await response.text();
-      throw new Error(`Python service error: ${errorText}`);
+      const errorData = await response.json().catch(() => ({ error: 'Failed to analyze image' }));
+
+      // Overloaded service (429, or 503 without a model state): pass the
+      // status and Retry-After through so the client backs off
+      const retryAfter = response.headers.get('Retry-After');
+      if (response.status === 429 || (response.status === 503 && !errorData.state)) {
+        return NextResponse.json(
+          { error: 'Service busy', message: errorData.error || 'The Python service is overloaded. Please retry shortly.' },
+          { status: response.status, headers: retryAfter ? { 'Retry-After': retryAfter } : undefined }
+        );
+      }
+
+      // Model still loading, or missing / failed to load
+      if (response.status === 503) {
+        const loading = errorData.state === 'loading';
+        return NextResponse.json(
+          {
+            error: loading ? 'Malaria model loading' : 'Malaria model not available',
+            message: errorData.message || errorData.error || 'The malaria model is not loaded in the Python service.',
+            hint: loading
+              ? 'The Python service is still loading the malaria model. Please retry shortly.'
+              : 'Check the Python service logs and ensure the malaria model exists in ../lib/model/, then restart the service: cd python-service && python app.py'
+          },
+          { status: 503, headers: retryAfter ? { 'Retry-After': retryAfter } : undefined }
+        );
+      }
+
+      throw new Error(errorData.error || `Python service error: ${response.statusText}`);
     }
 
     const result = await response.json();
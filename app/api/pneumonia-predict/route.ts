@@ -69,13 +69,21 @@ export async function POST(request: NextRequest) {
     // Forward image to Python service (primary method - uses actual model)
     const forwardFormData = new FormData();
     forwardFormData.append('image', imageFile);
+    // Grad-CAM heatmap of the regions behind the prediction
+    const explain = incomingFormData.get('explain');
+    if (typeof explain === 'string') {
+      forwardFormData.append('explain', explain);
+    }
 
+    const timeoutMs = 30000;
     const controller = new AbortController();
-    const timeoutId = setTimeout(() => controller.abort(), 30000); // 30s timeout
+    const timeoutId = setTimeout(() => controller.abort(), timeoutMs); // 30s timeout
 
     const response = await fetch(`${PYTHON_SERVICE_URL}/pneumonia-predict`, {
       method: 'POST',
       body: forwardFormData,
+      // The service drops the request if it cannot start inference before we give up
+      headers: { 'X-Request-Deadline': String(Date.now() + timeoutMs) },
       signal: controller.signal,
     });
 
@@ -84,6 +92,16 @@ export async function POST(request: NextRequest) {
     if (!response.ok) {
       const errorData = await response.json().catch(() => ({ error: 'Failed to analyze image' }));
       
+      // Overloaded service (429, or 503 without a model state): pass the
+      // status and Retry-After through so the client backs off
+      const retryAfter = response.headers.get('Retry-After');
+      if (response.status === 429 || (response.status === 503 && !errorData.state)) {
+        return NextResponse.json(
+          { error: 'Service busy', message: errorData.error || 'The Python service is overloaded. Please retry shortly.' },
+          { status: response.status, headers: retryAfter ? { 'Retry-After': retryAfter } : undefined }
+        );
+      }
+      
       // If model is not loaded, provide helpful error message
       if (response.status === 503) {
         return NextResponse.json(
@@ -0,0 +1,91 @@
+"""
+Admission control and request deadlines for the inference endpoints.
+
+AdmissionControl caps the requests in progress per model, from admission to
+response, which covers upload parsing, preprocessing and inference. A request
+over the cap is refused up front, before its upload is read, so a burst
+costs a cheap rejection instead of queueing work without limit. The batch
+queue bound (MicroBatcher max_queue) and the ASGI pending-request bound
+(asgi.py) complement it.
+
+Deadlines come from the request headers, as an absolute time or a relative
+timeout. A request whose deadline has passed is dropped when it is admitted
+and again just before inference, so work for clients that have already
+timed out upstream is not run.
+"""
+
+import math
+import threading
+import time
+
+# Absolute deadline: Unix epoch in milliseconds (JavaScript's Date.now())
+DEADLINE_HEADER = 'X-Request-Deadline'
+# Relative deadline: milliseconds from when the service received the request
+TIMEOUT_HEADER = 'X-Request-Timeout-Ms'
+
+
+def request_deadline(headers, received_at):
+    """Deadline (a time.time() timestamp) from request headers, or None.
+
+    received_at is the time.time() the request was received, for relative
+    timeouts. Malformed values are ignored. With both headers, the earlier
+    deadline applies.
+    """
+    deadlines = []
+    for name, base in ((DEADLINE_HEADER, 0.0), (TIMEOUT_HEADER, received_at)):
+        value = headers.get(name)
+        if value is None:
+            continue
+        try:
+            milliseconds = float(value)
+        except ValueError:
+            continue
+        if math.isfinite(milliseconds):
+            deadlines.append(base + milliseconds / 1000.0)
+    return min(deadlines) if deadlines else None
+
+
+def deadline_passed(deadline):
+    return deadline is not None and time.time() >= deadline
+
+
+class AdmissionControl:
+    """Per-model cap on the requests in progress.
+
+    A max_pending of 0 admits everything; the in-flight counts are still
+    tracked for /health.
+    """
+
+    def __init__(self, names, max_pending=0):
+        self.max_pending = max(0, int(max_pending))
+        self._lock = threading.Lock()
+        self._pending = {name: 0 for name in names}
+        self._rejected = {name: 0 for name in names}
+
+    def try_admit(self, name):
+        """Count a request in for a model; False if the model is at its cap"""
+        with self._lock:
+            if self.max_pending and self._pending[name] >= self.max_pending:
+                self._rejected[name] += 1
+                return False
+            self._pending[name] += 1
+            return True
+
+    def release(self, name):
+        with self._lock:
+            self._pending[name] -= 1
+
+    def saturated(self, name):
+        with self._lock:
+            return bool(self.max_pending) and self._pending[name] >= self.max_pending
+
+    def stats(self):
+        with self._lock:
+            return {
+                name: {
+                    'pending': self._pending[name],
+                    'max_pending': self.max_pending or None,
+                    'rejected': self._rejected[name],
+                }
+                for name in self._pending
+            }
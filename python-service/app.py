@@ -1,478 +1,922 @@
-from flask import Flask, request, jsonify
+from flask import Flask, Response, g, request, jsonify
 from flask_cors import CORS
-import tensorflow as tf
+from werkzeug.exceptions import HTTPException, RequestEntityTooLarge
 import numpy as np
 from PIL import Image
 import io
 import base64
 import os
-from tensorflow import keras
-from tensorflow.keras import layers
+import functools
+import logging
+import time
+from concurrent.futures import Future
+
+from admission import AdmissionControl, deadline_passed, request_deadline
+from backends import bucket_sizes
+from batching import DeadlineExceeded, MicroBatcher, QueueFull
+from explain import Explainer, explanation_payload
+from inference_ipc import InferenceClient, RemoteBatcher, RemoteExplainer, RemoteModelRegistry
+from json_provider import OrjsonProvider
+from metrics import CONTENT_TYPE as METRICS_CONTENT_TYPE, MetricsRegistry, process_memory_bytes
+from model_loading import load_malaria_model, load_pneumonia_model, model_fingerprint
+from model_registry import ModelRegistry, UnknownModelVersion
+from prediction_cache import PredictionCache
+from preprocess_pool import PreprocessPool
+from preprocessing import (
+    AUGMENTATIONS, MAX_IMAGE_PIXELS, ImageTooLarge, InvalidTensor, decode_tensor, inspect_image, preprocess_image,
+    tensor_views, to_model_input,
+)
+from results import malaria_results, pneumonia_results
+from service_logging import SERVICE_LOGGER, configure_logging
+from uploads import UPLOAD_SPOOL_BYTES, UploadRequest, close_upload, upload_data
 
 app = Flask(__name__)
+# jsonify() serializes with orjson when it is installed
+app.json = OrjsonProvider(app)
 CORS(app)
 
-# Define custom LayerScale layer for ConvNeXt models
-# Simplified implementation that matches what the saved model expects
-class LayerScale(layers.Layer):
-    """
-    LayerScale layer as used in ConvNeXt models.
-    Scales input by a learnable parameter (gamma) per feature dimension.
-    """
-    def __init__(self, init_values=1e-6, projection_dim=None, **kwargs):
-        super().__init__(**kwargs)
-        self.init_values = float(init_values) if init_values is not None else 1e-6
-        self.projection_dim = projection_dim
-        
-    def build(self, input_shape):
-        # Determine gamma shape: use projection_dim if provided, else use input shape
-        if self.projection_dim is not None:
-            gamma_shape = (self.projection_dim,)
-        else:
-            gamma_shape = (input_shape[-1],)
-        
-        self.gamma = self.add_weight(
-            name='gamma',
-            shape=gamma_shape,
-            initializer=keras.initializers.Constant(self.init_values),
-            trainable=True,
-            dtype=self.dtype
-        )
-        super().build(input_shape)
-    
-    def call(self, inputs, **kwargs):
-        return inputs * self.gamma
-    
-    def get_config(self):
-        config = super().get_config()
-        config['init_values'] = self.init_values
-        if self.projection_dim is not None:
-            config['projection_dim'] = self.projection_dim
-        return config
-
-# Register custom objects for model loading
-custom_objects = {
-    'LayerScale': LayerScale
-}
+# Uploads: requests larger than MAX_UPLOAD_MB are refused with 413 before the
+# body is parsed. File parts of requests over UPLOAD_SPOOL_BYTES are spooled
+# to temporary files and memory-mapped rather than read into memory.
+MAX_UPLOAD_MB = float(os.environ.get('MAX_UPLOAD_MB', '64'))
+MAX_UPLOAD_BYTES = int(MAX_UPLOAD_MB * 1024 * 1024)
+app.config['MAX_CONTENT_LENGTH'] = MAX_UPLOAD_BYTES
+app.request_class = UploadRequest
+
+# LOG_LEVEL=DEBUG enables the per-request diagnostics; LOG_FORMAT=json writes
+# one JSON object per line
+configure_logging(os.environ.get('LOG_LEVEL', 'INFO'), os.environ.get('LOG_FORMAT', 'text'))
+logger = logging.getLogger(SERVICE_LOGGER)
+
+# Unix socket of a shared inference server (inference_server.py). When set,
+# this process loads no models and does not import TensorFlow: it preprocesses
+# uploads and sends the model inputs to the server, so memory per node stays
+# flat as workers are added.
+INFERENCE_SERVER = os.environ.get('INFERENCE_SERVER')
+INFERENCE_SERVER_TIMEOUT = float(os.environ.get('INFERENCE_SERVER_TIMEOUT', '60'))
+
+# Preprocessing runs in a worker pool (thread, process or inline) so decode
+# and resize of one image overlap with inference on another. Created before
+# TensorFlow is imported, so process-mode workers fork from a parent without
+# its runtime and thread pools (none of the modules imported above load it).
+PREPROCESS_POOL = os.environ.get('PREPROCESS_POOL', 'thread')
+PREPROCESS_WORKERS = int(os.environ.get('PREPROCESS_WORKERS', str(os.cpu_count() or 4)))
+preprocess_pool = PreprocessPool(PREPROCESS_POOL, PREPROCESS_WORKERS)
+
+# TensorFlow thread pools: must be configured before the runtime starts, i.e.
+# before the first model is loaded. 0 lets TensorFlow pick.
+TF_INTRA_OP_THREADS = int(os.environ.get('TF_INTRA_OP_THREADS', '0'))
+TF_INTER_OP_THREADS = int(os.environ.get('TF_INTER_OP_THREADS', '0'))
+if not INFERENCE_SERVER:
+    import tensorflow as tf
+    tf.config.threading.set_intra_op_parallelism_threads(TF_INTRA_OP_THREADS)
+    tf.config.threading.set_inter_op_parallelism_threads(TF_INTER_OP_THREADS)
 
 # Get the base directory (parent of python-service)
 BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
-MODEL_DIR = os.path.join(BASE_DIR, 'lib', 'model')
-
-print(f"Base directory: {BASE_DIR}")
-print(f"Model directory: {MODEL_DIR}")
-
-# Load models once at startup
-malaria_model = None
-pneumonia_model = None
-
-# Load Malaria Model
-try:
-    malaria_model_path = os.path.join(MODEL_DIR, 'malaria_model1.h5')
-    if os.path.exists(malaria_model_path):
-        print(f"Loading malaria model from {malaria_model_path}...")
-        malaria_model = tf.keras.models.load_model(malaria_model_path)
-        print("✓ Malaria model loaded successfully!")
-    else:
-        print(f"Warning: Malaria model not found at {malaria_model_path}")
-except Exception as e:
-    print(f"Error loading malaria model: {str(e)}")
-    import traceback
-    traceback.print_exc()
-
-# Load Pneumonia Model
-try:
-    # Try to load .h5 version - check both best_model.h5 and pneumonia_model.h5
-    pneumonia_model_paths = [
-        os.path.join(MODEL_DIR, 'best_model.h5'),        # Primary: best_model.h5 (pneumonia model)
-        os.path.join(MODEL_DIR, 'pneumonia_model.h5'),   # Fallback: pneumonia_model.h5
-    ]
-    
-    pneumonia_model_loaded = False
-    pneumonia_h5_path = None
-    
-    for model_path in pneumonia_model_paths:
-        if os.path.exists(model_path):
-            pneumonia_h5_path = model_path
-            print(f"Loading pneumonia model from {pneumonia_h5_path}...")
-            try:
-                # Load model with custom objects to handle LayerScale layer
-                pneumonia_model = tf.keras.models.load_model(
-                    pneumonia_h5_path,
-                    custom_objects=custom_objects,
-                    compile=False
-                )
-                print("✓ Pneumonia model loaded successfully!")
-                pneumonia_model_loaded = True
-                break
-            except Exception as load_error:
-                print(f"Error loading model from {pneumonia_h5_path}: {str(load_error)}")
-                import traceback
-                traceback.print_exc()
-                continue
-    
-    if not pneumonia_model_loaded:
-        # Check if TFJS model exists and try to convert it automatically
-        tfjs_model_paths = [
-            os.path.join(MODEL_DIR, 'tfjspnumoniaDetectorModel'),  # Actual folder name
-            os.path.join(MODEL_DIR, 'pnumoniaDetectorModel'),      # Alternative name
-        ]
-        
-        tfjs_model_found = None
-        for tfjs_path in tfjs_model_paths:
-            model_json_path = os.path.join(tfjs_path, 'model.json')
-            if os.path.exists(tfjs_path) and os.path.exists(model_json_path):
-                tfjs_model_found = tfjs_path
-                print(f"Found TFJS model at: {tfjs_model_found}")
-                break
-        
-        if tfjs_model_found:
-            print(f"⚠ Pneumonia TFJS model found at {tfjs_model_found}")
-            print("   Attempting automatic conversion to .h5 format...")
-            
-            try:
-                # Try to import tensorflowjs for conversion
-                import tensorflowjs as tfjs
-                
-                # Use best_model.h5 as output (primary pneumonia model name)
-                output_path = os.path.join(MODEL_DIR, 'best_model.h5')
-                # Ensure output directory exists
-                os.makedirs(os.path.dirname(output_path), exist_ok=True)
-                
-                print("   Converting TFJS model to Keras format (this may take a few minutes)...")
-                print(f"   Source: {tfjs_model_found}")
-                print(f"   Target: {output_path}")
-                
-                model = tfjs.converters.load_keras_model(tfjs_model_found)
-                
-                print(f"   Saving converted model to {output_path}...")
-                model.save(output_path)
-                
-                print("   ✓ Conversion successful! Loading converted model...")
-                pneumonia_model = tf.keras.models.load_model(
-                    output_path,
-                    custom_objects=custom_objects,
-                    compile=False
-                )
-                print("✓ Pneumonia model loaded successfully after conversion!")
-                pneumonia_model_loaded = True
-                
-            except ImportError as import_err:
-                print("   ❌ tensorflowjs not installed. Cannot auto-convert.")
-                print(f"   Error: {str(import_err)}")
-                print("   Install it with: pip install tensorflowjs")
-                print("   Or run manually: cd python-service && python convert_tfjs_to_keras.py")
-            except Exception as conv_error:
-                print(f"   ❌ Auto-conversion failed: {str(conv_error)}")
-                print(f"   Error type: {type(conv_error).__name__}")
-                import traceback
-                traceback.print_exc()
-                print("   Please run manually: cd python-service && python convert_tfjs_to_keras.py")
-        
-        if not pneumonia_model_loaded:
-            print(f"\n{'='*60}")
-            print(f"⚠ PNEUMONIA MODEL NOT AVAILABLE")
-            print(f"{'='*60}")
-            print(f"Checked model files:")
-            for path in pneumonia_model_paths:
-                exists = os.path.exists(path)
-                print(f"  - {path}: {'✓ EXISTS' if exists else '✗ NOT FOUND'}")
-            
-            if tfjs_model_found:
-                print(f"\n✓ TFJS model found at: {tfjs_model_found}")
-                print(f"  Model JSON exists: {os.path.exists(os.path.join(tfjs_model_found, 'model.json'))}")
-                print("\n❌ Conversion failed or tensorflowjs is not installed.")
-                print("\nTo fix:")
-                print("  1. Install tensorflowjs: pip install tensorflowjs")
-                print("  2. Restart this Python service")
-                print("  OR manually convert:")
-                print(f"     cd python-service")
-                print(f"     python convert_tfjs_to_keras.py")
-            else:
-                print(f"\n❌ No TFJS model found.")
-                print(f"Searched in: {MODEL_DIR}")
-                print(f"Checked paths:")
-                for path in tfjs_model_paths:
-                    exists = os.path.exists(path)
-                    print(f"  - {path}: {'✓ EXISTS' if exists else '✗ NOT FOUND'}")
-            print(f"{'='*60}\n")
-except Exception as e:
-    print(f"❌ Error loading pneumonia model: {str(e)}")
-    import traceback
-    traceback.print_exc()
-
-IMAGE_SIZE = 224
-CHANNELS = 3
-
-def preprocess_image(image_bytes, enhance_contrast=True):
-    """Preprocess image for model input with enhanced handling for medical images"""
-    # Open image
-    img = Image.open(io.BytesIO(image_bytes))
-    
-    # Convert to grayscale first (medical X-rays are typically grayscale)
-    if img.mode != 'L':
-        img = img.convert('L')
-    
-    # Convert to numpy array for processing
-    img_array = np.array(img, dtype=np.float32)
-    
-    # Apply contrast enhancement for medical images
-    if enhance_contrast:
-        # Histogram equalization-like enhancement
-        # Normalize to 0-255 range first
-        if img_array.max() > 255:
-            img_array = (img_array - img_array.min()) / (img_array.max() - img_array.min() + 1e-7) * 255
-        
-        # Apply CLAHE-like contrast enhancement (simplified)
-        # Clip extreme values (remove outliers)
-        p2, p98 = np.percentile(img_array, (2, 98))
-        img_array = np.clip(img_array, p2, p98)
-        
-        # Normalize to 0-255
-        if img_array.max() > img_array.min():
-            img_array = (img_array - img_array.min()) / (img_array.max() - img_array.min()) * 255
-    
-    # Convert back to PIL Image for resizing
-    img = Image.fromarray(img_array.astype(np.uint8))
-    
-    # Resize to model input size with high-quality resampling
-    img = img.resize((IMAGE_SIZE, IMAGE_SIZE), Image.Resampling.LANCZOS)
-    
-    # Convert to RGB (3 channels) as model expects
-    if img.mode != 'RGB':
-        img = img.convert('RGB')
-    
-    # Convert to numpy array and normalize to [0, 1]
-    img_array = np.array(img, dtype=np.float32) / 255.0
-    
-    # Add batch dimension
-    img_array = np.expand_dims(img_array, axis=0)
-    
-    return img_array
+# MODEL_DIR overrides the model directory, e.g. for benchmarks with stand-in models
+MODEL_DIR = os.environ.get('MODEL_DIR', os.path.join(BASE_DIR, 'lib', 'model'))
+
+logger.info(f"Base directory: {BASE_DIR}")
+logger.info(f"Model directory: {MODEL_DIR}")
+
+# Inference backend per model: 'keras' (the .h5 model), 'tflite' or 'onnx'.
+# The optimized backends load the export created by export_optimized.py with
+# the given quantization (none, dynamic, fp16 or int8).
+MALARIA_BACKEND = os.environ.get('MALARIA_BACKEND', 'keras')
+MALARIA_QUANTIZATION = os.environ.get('MALARIA_QUANTIZATION', 'none')
+PNEUMONIA_BACKEND = os.environ.get('PNEUMONIA_BACKEND', 'keras')
+PNEUMONIA_QUANTIZATION = os.environ.get('PNEUMONIA_QUANTIZATION', 'none')
+INFERENCE_THREADS = int(os.environ.get('INFERENCE_THREADS', '0')) or None
+# Compile the Keras inference function with XLA
+INFERENCE_XLA = os.environ.get('INFERENCE_XLA', '0') == '1'
+
+# Grad-CAM explanations (explain.py) for the Keras backends. With EXPLAIN=1
+# the forward pass also captures the feature maps of the last convolutional
+# layer (or *_EXPLAIN_LAYER), and the last EXPLAIN_CACHE_SIZE of them are kept
+# by upload, so an explanation requested with or after the prediction only
+# runs the gradient of the model head.
+EXPLAIN = os.environ.get('EXPLAIN', '1') == '1'
+MALARIA_EXPLAIN_LAYER = os.environ.get('MALARIA_EXPLAIN_LAYER') or None
+PNEUMONIA_EXPLAIN_LAYER = os.environ.get('PNEUMONIA_EXPLAIN_LAYER') or None
+EXPLAIN_CACHE_SIZE = int(os.environ.get('EXPLAIN_CACHE_SIZE', '128'))
+
+# Micro-batching: concurrent requests for the same model are coalesced into
+# one forward pass of up to BATCH_MAX_SIZE images, waiting at most
+# BATCH_MAX_WAIT_MS for the batch to fill
+BATCH_MAX_SIZE = int(os.environ.get('BATCH_MAX_SIZE', '32'))
+BATCH_MAX_WAIT_MS = float(os.environ.get('BATCH_MAX_WAIT_MS', '10'))
+# At most BATCH_MAX_QUEUE images wait per model; requests that would exceed
+# it are refused with 503 (0 = unbounded)
+BATCH_MAX_QUEUE = int(os.environ.get('BATCH_MAX_QUEUE', str(BATCH_MAX_SIZE * 4)))
+
+# Warm up every model at each bucketed batch size (1, 2, 4, ... BATCH_MAX_SIZE)
+# so tracing/compilation happens at boot rather than on the first requests
+INFERENCE_WARMUP = os.environ.get('INFERENCE_WARMUP', '1') == '1'
+
+# Models listed here (comma-separated) are loaded on first use instead of at
+# startup, e.g. LAZY_MODELS=pneumonia for a rarely used model
+LAZY_MODELS = {name.strip() for name in os.environ.get('LAZY_MODELS', '').split(',') if name.strip()}
+
+# Hot swap: the model files (or lib/model/models.json) are checked every
+# MODEL_WATCH_INTERVAL seconds (0 disables it). A changed model is loaded and
+# warmed up in the background, then swapped in without dropping requests.
+# MODEL_RETAIN_VERSIONS earlier versions stay loaded for requests that pin
+# them with X-Model-Version.
+MODEL_WATCH_INTERVAL = float(os.environ.get('MODEL_WATCH_INTERVAL', '10'))
+MODEL_RETAIN_VERSIONS = int(os.environ.get('MODEL_RETAIN_VERSIONS', '0'))
+
+# Models load concurrently in the background; the server starts listening
+# straight away and /health reports per-model readiness
+if INFERENCE_SERVER:
+    inference_client = InferenceClient(INFERENCE_SERVER, timeout=INFERENCE_SERVER_TIMEOUT)
+    model_registry = RemoteModelRegistry(inference_client, ('malaria', 'pneumonia'))
+    logger.info(f"Using the inference server at {INFERENCE_SERVER}")
+else:
+    model_registry = ModelRegistry(retain_versions=MODEL_RETAIN_VERSIONS)
+    warmup_batch_sizes = bucket_sizes(BATCH_MAX_SIZE) if INFERENCE_WARMUP else ()
+    model_registry.register(
+        'malaria',
+        functools.partial(
+            load_malaria_model, MODEL_DIR, MALARIA_BACKEND, MALARIA_QUANTIZATION,
+            jit_compile=INFERENCE_XLA, num_threads=INFERENCE_THREADS,
+            explain=EXPLAIN, explain_layer=MALARIA_EXPLAIN_LAYER,
+        ),
+        lazy='malaria' in LAZY_MODELS,
+        warmup_batch_sizes=warmup_batch_sizes,
+        source=functools.partial(model_fingerprint, MODEL_DIR, 'malaria', MALARIA_BACKEND, MALARIA_QUANTIZATION),
+    )
+    model_registry.register(
+        'pneumonia',
+        functools.partial(
+            load_pneumonia_model, MODEL_DIR, PNEUMONIA_BACKEND, PNEUMONIA_QUANTIZATION,
+            jit_compile=INFERENCE_XLA, num_threads=INFERENCE_THREADS,
+            explain=EXPLAIN, explain_layer=PNEUMONIA_EXPLAIN_LAYER,
+        ),
+        lazy='pneumonia' in LAZY_MODELS,
+        warmup_batch_sizes=warmup_batch_sizes,
+        source=functools.partial(model_fingerprint, MODEL_DIR, 'pneumonia', PNEUMONIA_BACKEND, PNEUMONIA_QUANTIZATION),
+    )
+    model_registry.start()
+    model_registry.watch(MODEL_WATCH_INTERVAL)
+
+# Metrics served at /metrics in the Prometheus text format
+metrics = MetricsRegistry()
+REQUESTS = metrics.counter('http_requests_total', 'HTTP requests by endpoint and status code', ('endpoint', 'status'))
+REQUEST_ERRORS = metrics.counter('http_request_errors_total', 'HTTP requests answered with a 4xx or 5xx status', ('endpoint',))
+REQUESTS_IN_FLIGHT = metrics.gauge('http_requests_in_flight', 'HTTP requests currently being handled', ('endpoint',))
+REQUEST_SECONDS = metrics.histogram('http_request_duration_seconds', 'HTTP request handling time', ('endpoint',))
+# Stages: upload_read, decode, contrast, resize, batch_wait (queueing plus the
+# forward pass, per request), inference (forward pass, per batch),
+# serialization and explain (Grad-CAM heatmap, per explained image)
+STAGE_SECONDS = metrics.histogram('prediction_stage_duration_seconds', 'Time spent per prediction stage', ('model', 'stage'))
+# Powers of four from 64 KiB to 1 GiB
+BYTE_BUCKETS = tuple(64 * 1024 * 4 ** i for i in range(8))
+UPLOAD_BYTES = metrics.histogram('upload_size_bytes', 'Size of uploaded images', ('model',), buckets=BYTE_BUCKETS)
+DECODE_BYTES = metrics.histogram(
+    'decode_memory_bytes', 'Estimated peak memory to decode each image, from its header', ('model',), buckets=BYTE_BUCKETS,
+)
+metrics.callback_gauge(
+    'process_memory_bytes', 'Resident (rss) and peak resident (peak_rss) memory of this process', ('kind',),
+    lambda: {(kind,): value for kind, value in process_memory_bytes().items()},
+)
+metrics.callback_gauge(
+    'model_load_duration_seconds', 'Time taken to load and warm up each model', ('model',),
+    lambda: {(name,): status['load_seconds'] for name, status in model_registry.status().items()},
+)
+metrics.callback_gauge(
+    'model_ready', '1 if the model is loaded and serving', ('model',),
+    lambda: {(name,): int(status['state'] == 'ready') for name, status in model_registry.status().items()},
+)
+metrics.callback_gauge(
+    'model_version_info', '1 for the version currently serving each model', ('model', 'version'),
+    lambda: {(name, status['version']): 1 for name, status in model_registry.status().items() if status['version']},
+)
+# Counted by the model registry (in the inference server when there is one)
+metrics.callback_counter(
+    'model_swaps_total', 'New model versions swapped in since startup', ('model',),
+    lambda: {(name,): status['swaps'] for name, status in model_registry.status().items()},
+)
+ADMISSION_REJECTIONS = metrics.counter(
+    'admission_rejections_total', 'Prediction requests refused: admission limit, full batch queue or passed deadline',
+    ('model', 'reason'),
+)
+metrics.callback_gauge(
+    'admission_pending_requests', 'Prediction requests in progress per model', ('model',),
+    lambda: {(name,): stats['pending'] for name, stats in admission.stats().items()},
+)
+metrics.callback_gauge(
+    'batch_queue_images', 'Images waiting in the micro-batch queue', ('model',),
+    lambda: {(batcher.name,): batcher.stats()['queued'] for batcher in (malaria_batcher, pneumonia_batcher)},
+)
+
+def timed_predict(model_name):
+    """Batcher predict_fn that runs the batch's model version and times each
+    forward pass. Explainable versions return (outputs, activations)."""
+    def predict(batch, model):
+        with STAGE_SECONDS.time(model=model_name, stage='inference'):
+            if model.explainable:
+                return model.model.predict_with_activations(batch)
+            return model.model.predict(batch)
+    return predict
+
+# Requests are batched by the ModelVersion they acquired, so a hot swap never
+# mixes versions in one forward pass. With an inference server, batching (and
+# the inference stage timing) happens in the server process.
+if INFERENCE_SERVER:
+    malaria_batcher = RemoteBatcher(inference_client, 'malaria')
+    pneumonia_batcher = RemoteBatcher(inference_client, 'pneumonia')
+else:
+    malaria_batcher = MicroBatcher(
+        'malaria',
+        timed_predict('malaria'),
+        max_batch_size=BATCH_MAX_SIZE,
+        max_wait_ms=BATCH_MAX_WAIT_MS,
+        max_queue=BATCH_MAX_QUEUE,
+    )
+    pneumonia_batcher = MicroBatcher(
+        'pneumonia',
+        timed_predict('pneumonia'),
+        max_batch_size=BATCH_MAX_SIZE,
+        max_wait_ms=BATCH_MAX_WAIT_MS,
+        max_queue=BATCH_MAX_QUEUE,
+    )
+
+batchers = {'malaria': malaria_batcher, 'pneumonia': pneumonia_batcher}
+
+# Maximum number of files accepted by the batch endpoints
+BATCH_MAX_FILES = int(os.environ.get('BATCH_MAX_FILES', '64'))
+
+# Admission control: at most ADMISSION_MAX_PENDING prediction requests per
+# model are in progress at once (0 = unlimited); more are refused with 429
+# before their upload is read. Refusals carry Retry-After:
+# ADMISSION_RETRY_AFTER seconds. Requests may set a deadline with
+# X-Request-Deadline (epoch ms) or X-Request-Timeout-Ms; once it has passed
+# they are answered 504 without running inference.
+ADMISSION_MAX_PENDING = int(os.environ.get('ADMISSION_MAX_PENDING', '64'))
+ADMISSION_RETRY_AFTER = int(os.environ.get('ADMISSION_RETRY_AFTER', '1'))
+admission = AdmissionControl(batchers, ADMISSION_MAX_PENDING)
+
+# Test-time augmentation: the single-image endpoints can score several views
+# of the image (flips, crops, contrast variants) in one forward pass and
+# average them. TTA_VIEWS is the default view count (1 = off); requests
+# override it with a `tta` form field or query parameter, up to one view per
+# augmentation. A standard deviation of the averaged probabilities of at
+# least TTA_UNCERTAINTY_STD marks the result as uncertain.
+TTA_VIEWS = int(os.environ.get('TTA_VIEWS', '1'))
+TTA_MAX_VIEWS = len(AUGMENTATIONS)
+TTA_UNCERTAINTY_STD = float(os.environ.get('TTA_UNCERTAINTY_STD', '0.1'))
+
+# Compact results carry an outcome code and the probabilities only, without
+# the message and recommendations. RESPONSE_COMPACT=1 makes them the default;
+# requests choose with a `compact` form field or query parameter.
+RESPONSE_COMPACT = os.environ.get('RESPONSE_COMPACT', '0') == '1'
+
+# Prediction cache keyed by image hash + model identity + preprocessing flags.
+# PREDICTION_CACHE_SIZE=0 disables it; PREDICTION_CACHE_DIR adds a disk tier
+# that survives restarts.
+prediction_cache = PredictionCache(
+    max_entries=int(os.environ.get('PREDICTION_CACHE_SIZE', '1024')),
+    ttl_seconds=float(os.environ.get('PREDICTION_CACHE_TTL', '3600')),
+    disk_dir=os.environ.get('PREDICTION_CACHE_DIR'),
+    disk_max_entries=int(os.environ.get('PREDICTION_CACHE_DISK_MAX_ENTRIES', '100000')),
+)
+
+# Grad-CAM activations of recent uploads, keyed like the prediction cache.
+# With an inference server they are cached in the server process.
+if INFERENCE_SERVER:
+    explainer = RemoteExplainer(inference_client)
+else:
+    activation_cache = PredictionCache(
+        max_entries=EXPLAIN_CACHE_SIZE,
+        ttl_seconds=float(os.environ.get('PREDICTION_CACHE_TTL', '3600')),
+    )
+    explainer = Explainer(activation_cache, batchers)
+
+def requested_version():
+    """Model version pinned by the request (X-Model-Version header or model_version field), if any"""
+    return request.headers.get('X-Model-Version') or request.values.get('model_version') or None
+
+def retry_later(body, status):
+    response = jsonify(body)
+    response.headers['Retry-After'] = str(ADMISSION_RETRY_AFTER)
+    return response, status
+
+def deadline_expired():
+    return jsonify({'error': 'Request deadline passed before inference started'}), 504
+
+def admit(model_name):
+    """Admit a prediction request, or return the response refusing it.
+
+    Runs before the upload is read. An admitted request is counted against
+    the model's limit until teardown.
+    """
+    received_at = request.environ.get('service.received_at', g.received_at)
+    g.deadline = request_deadline(request.headers, received_at)
+    if deadline_passed(g.deadline):
+        ADMISSION_REJECTIONS.inc(model=model_name, reason='deadline')
+        return deadline_expired()
+    if batchers[model_name].queue_full():
+        ADMISSION_REJECTIONS.inc(model=model_name, reason='queue_full')
+        return retry_later({'error': f'{model_name.capitalize()} inference queue is full'}, 503)
+    if not admission.try_admit(model_name):
+        ADMISSION_REJECTIONS.inc(model=model_name, reason='admission')
+        return retry_later({'error': f'Too many {model_name} requests in progress'}, 429)
+    g.admitted = model_name
+    return None
+
+def acquire_model(model_name, message=None):
+    """Admit the request and return the ModelVersion serving it, or an error response"""
+    rejection = admit(model_name)
+    if rejection is not None:
+        return None, rejection
+    try:
+        model = model_registry.acquire(model_name, requested_version())
+    except UnknownModelVersion as e:
+        return None, (jsonify({'error': str(e), 'available_versions': e.available}), 404)
+    if model is None:
+        return None, model_unavailable(model_name, message)
+    return model, None
+
+def served_by(response, model):
+    """Tag a response with the model version that produced it"""
+    response.headers['X-Model-Version'] = model.version
+    return response
+
+def model_unavailable(model_name, message=None):
+    """503 response for a model that is still loading or failed to load"""
+    state = model_registry.state(model_name)
+    if state == 'loading':
+        response = jsonify({
+            'error': f'{model_name.capitalize()} model is still loading',
+            'state': state,
+        })
+        response.headers['Retry-After'] = '5'
+        return response, 503
+    body = {'error': f'{model_name.capitalize()} model not loaded', 'state': state}
+    if message:
+        body['message'] = message
+    return jsonify(body), 503
+
+@app.before_request
+def start_request_metrics():
+    g.metrics_endpoint = request.url_rule.rule if request.url_rule else 'unmatched'
+    g.request_started = time.perf_counter()
+    g.received_at = time.time()
+    REQUESTS_IN_FLIGHT.inc(endpoint=g.metrics_endpoint)
+
+@app.after_request
+def record_request_metrics(response):
+    endpoint = g.get('metrics_endpoint', 'unmatched')
+    REQUESTS.inc(endpoint=endpoint, status=response.status_code)
+    if response.status_code >= 400:
+        REQUEST_ERRORS.inc(endpoint=endpoint)
+    if 'request_started' in g:
+        REQUEST_SECONDS.observe(time.perf_counter() - g.request_started, endpoint=endpoint)
+    return response
+
+@app.teardown_request
+def finish_request_metrics(exc=None):
+    for data in g.get('uploads', ()):
+        close_upload(data)
+    if 'admitted' in g:
+        admission.release(g.admitted)
+    if 'metrics_endpoint' in g:
+        REQUESTS_IN_FLIGHT.dec(endpoint=g.metrics_endpoint)
+
+@app.before_request
+def check_upload_size():
+    """Refuse oversized uploads from Content-Length, before reading the body"""
+    if request.content_length is not None and request.content_length > MAX_UPLOAD_BYTES:
+        return upload_too_large()
+
+@app.errorhandler(RequestEntityTooLarge)
+def upload_too_large(error=None):
+    return jsonify({'error': f'Upload too large (maximum is {MAX_UPLOAD_MB:g} MB)'}), 413
+
+@app.errorhandler(QueueFull)
+def queue_full(error):
+    ADMISSION_REJECTIONS.inc(model=g.get('admitted', 'unknown'), reason='queue_full')
+    return retry_later({'error': str(error)}, 503)
+
+@app.errorhandler(DeadlineExceeded)
+def deadline_exceeded(error):
+    ADMISSION_REJECTIONS.inc(model=g.get('admitted', 'unknown'), reason='deadline')
+    return deadline_expired()
+
+def observe_stages(model_name, timings):
+    """Record decode/contrast/resize timings reported by the preprocessing pool"""
+    for stage, seconds in timings.items():
+        STAGE_SECONDS.observe(seconds, model=model_name, stage=stage)
+
+def read_files(model_name, image_files):
+    """Contents of uploaded files (bytes or mmap), released at the end of the request"""
+    datas = [upload_data(image_file) for image_file in image_files]
+    g.setdefault('uploads', []).extend(datas)
+    for data in datas:
+        UPLOAD_BYTES.observe(len(data), model=model_name)
+    return datas
+
+def read_upload(model_name):
+    """Contents of the 'image' upload, or None if the request has none"""
+    with STAGE_SECONDS.time(model=model_name, stage='upload_read'):
+        image_file = request.files.get('image')
+        return read_files(model_name, [image_file])[0] if image_file is not None else None
+
+def check_image(model_name, image_data):
+    """Refuse an image from its header before it is decoded (see inspect_image)"""
+    info = inspect_image(image_data)
+    DECODE_BYTES.observe(info['decode_bytes'], model=model_name)
+    return info
 
 def preprocess_image_pneumonia(image_bytes):
     """Specialized preprocessing for pneumonia detection - handles hospital X-rays better"""
     return preprocess_image(image_bytes, enhance_contrast=True)
 
+def load_status():
+    """Queue depth and saturation per model; a saturated model refuses new requests"""
+    admission_stats = admission.stats()
+    models = {}
+    for name, batcher in batchers.items():
+        # From the batcher's stats, which come from the inference server
+        # when there is one
+        batching = batcher.stats()
+        max_queue = batching.get('max_queue')
+        models[name] = {
+            **admission_stats[name],
+            'queued_images': batching['queued'],
+            'max_queued_images': max_queue,
+            'saturated': admission.saturated(name) or bool(max_queue and batching['queued'] >= max_queue),
+        }
+    return {'saturated': any(model['saturated'] for model in models.values()), 'models': models}
+
 @app.route('/health', methods=['GET'])
 def health():
+    model_states = model_registry.status()
+    # Lazy models that have not been requested yet load on first use, so they
+    # count as available
+    available = {
+        name: status['state'] == 'ready' or (status['lazy'] and status['state'] == 'pending')
+        for name, status in model_states.items()
+    }
+    
     models_available = []
-    if malaria_model is not None:
+    if available['malaria']:
         models_available.append('malaria-detection')
-    if pneumonia_model is not None:
+    if available['pneumonia']:
         models_available.append('pneumonia-detection')
     
     return jsonify({
-        'status': 'ready',
+        'status': 'loading' if model_registry.loading else 'ready',
         'models': models_available,
-        'malaria_model': malaria_model is not None,
-        'pneumonia_model': pneumonia_model is not None
+        'malaria_model': available['malaria'],
+        'pneumonia_model': available['pneumonia'],
+        'model_states': model_states,
+        'batching': {
+            'malaria': malaria_batcher.stats(),
+            'pneumonia': pneumonia_batcher.stats(),
+        },
+        'load': load_status(),
+        'preprocessing': preprocess_pool.stats(),
+        'tta': {
+            'default_views': max(1, min(TTA_VIEWS, TTA_MAX_VIEWS)),
+            'max_views': TTA_MAX_VIEWS,
+            'uncertainty_std': TTA_UNCERTAINTY_STD,
+        },
+        'cache': prediction_cache.stats(),
+        'explain': {
+            'enabled': EXPLAIN,
+            'activation_cache': explainer.stats(),
+        },
+        'memory': {
+            **{f'{kind}_mb': round(value / 1024 / 1024, 1) for kind, value in process_memory_bytes().items()},
+            'max_upload_mb': MAX_UPLOAD_MB,
+            'upload_spool_bytes': UPLOAD_SPOOL_BYTES,
+            'max_image_pixels': MAX_IMAGE_PIXELS,
+        },
     })
 
+@app.route('/ready', methods=['GET'])
+def ready():
+    """Load balancer check: 200 while every eagerly loaded model is ready and
+    none is saturated, else 503 with Retry-After"""
+    load = load_status()
+    loading = model_registry.loading
+    body = {
+        'ready': not loading and not load['saturated'],
+        'loading': loading,
+        'saturated': load['saturated'],
+        'queued_images': {name: model['queued_images'] for name, model in load['models'].items()},
+        'pending': {name: model['pending'] for name, model in load['models'].items()},
+    }
+    if body['ready']:
+        return jsonify(body)
+    return retry_later(body, 503)
+
+@app.route('/metrics', methods=['GET'])
+def metrics_endpoint():
+    """Prometheus metrics"""
+    return Response(metrics.render(), content_type=METRICS_CONTENT_TYPE)
+
 @app.route('/predict', methods=['POST'])
 def predict():
     """Malaria prediction endpoint (backward compatibility)"""
     return predict_malaria()
 
+def requested_views():
+    """Test-time augmentation view count for this request, or None if invalid"""
+    value = request.values.get('tta')
+    if value is None:
+        return max(1, min(TTA_VIEWS, TTA_MAX_VIEWS))
+    if not value.isdigit() or not 1 <= int(value) <= TTA_MAX_VIEWS:
+        return None
+    return int(value)
+
+def invalid_views():
+    return jsonify({'error': f'tta must be a view count from 1 to {TTA_MAX_VIEWS}'}), 400
+
+def result_builder(build_results_fn):
+    """build_results_fn (results.py), building compact results if this
+    request asks for them"""
+    value = request.values.get('compact')
+    compact = RESPONSE_COMPACT if value is None else value.lower() in ('1', 'true', 'yes')
+    return functools.partial(build_results_fn, compact=True) if compact else build_results_fn
+
+def requested_input():
+    """How to read the upload: 'image', or 'tensor' for a client-side
+    pre-resized 224x224 plane (see decode_tensor). None if invalid."""
+    value = request.values.get('input', 'image')
+    return value if value in ('image', 'tensor') else None
+
+def invalid_input():
+    return jsonify({'error': "input must be 'image' or 'tensor'"}), 400
+
+def input_flags(enhance_contrast, tensor):
+    """Cache key flags for how an upload becomes model input"""
+    return {'input': 'tensor'} if tensor else {'enhance_contrast': enhance_contrast}
+
+def submit_input(model_name, image_data, enhance_contrast, tensor, timings):
+    """Future for the float32 (1, 224, 224, 3) model input of an upload.
+
+    Images are checked from their header and preprocessed in the pool.
+    Pre-resized tensors are only validated and normalized, inline.
+    """
+    if not tensor:
+        check_image(model_name, image_data)
+        return preprocess_pool.submit(image_data, enhance_contrast, timings)
+    future = Future()
+    try:
+        future.set_result(to_model_input(decode_tensor(image_data, timings)[np.newaxis]))
+    except Exception as e:
+        future.set_exception(e)
+    return future
+
+def forward(model, batcher, inputs, deadline=None, activation_keys=None):
+    """Model outputs for inputs, batched with other requests.
+
+    Activations the forward pass captures for explanations are cached under
+    activation_keys, one key per input row (None: not cached).
+    """
+    if INFERENCE_SERVER:
+        return batcher.predict(inputs, key=model, deadline=deadline, activation_keys=activation_keys)
+    outputs = batcher.predict(inputs, key=model, deadline=deadline)
+    if not isinstance(outputs, tuple):
+        return outputs
+    outputs, activations = outputs
+    for key, row in zip(activation_keys or (), activations):
+        explainer.remember(key, row)
+    return outputs
+
+def requested_explain():
+    """True if this request asks for a Grad-CAM explanation"""
+    value = request.values.get('explain')
+    return value is not None and value.lower() in ('1', 'true', 'yes')
+
+def explanation_unavailable(model):
+    return jsonify({'error': f'Explanations are not available for the {model.name} model backend'}), 501
+
+def explain_image(image_bytes, model, enhance_contrast=True, tensor=False):
+    """Grad-CAM `explanation` block for one image, from the activations of
+    its prediction when they are still cached"""
+    model_name = model.name
+    cache_key = prediction_cache.make_key(
+        image_bytes, model_name, model.model_id, **input_flags(enhance_contrast, tensor)
+    )
+    timings = {}
+    
+    def compute_inputs():
+        return submit_input(model_name, image_bytes, enhance_contrast, tensor, timings).result()
+    
+    with STAGE_SECONDS.time(model=model_name, stage='explain'):
+        heatmap, layer_name, cached = explainer.heatmap(model, cache_key, compute_inputs, deadline=g.deadline)
+    observe_stages(model_name, timings)
+    return explanation_payload(heatmap, layer_name, cached)
+
+def run_tta_prediction(image_bytes, model, batcher, views, enhance_contrast=True, tensor=False):
+    """Return the mean and standard deviation of the output rows over the
+    augmented views of one image, from the cache when possible"""
+    model_name = model.name
+    cache_key = prediction_cache.make_key(
+        image_bytes, model_name, model.model_id, **input_flags(enhance_contrast, tensor), tta_views=views,
+    )
+    summary = prediction_cache.get(cache_key)
+    if summary is None:
+        timings = {}
+        if tensor:
+            inputs = to_model_input(tensor_views(image_bytes, views, timings))
+        else:
+            check_image(model_name, image_bytes)
+            inputs = preprocess_pool.submit_views(image_bytes, views, enhance_contrast, timings).result()
+        observe_stages(model_name, timings)
+        
+        # Every view runs in the same forward pass (batched with other requests)
+        with STAGE_SECONDS.time(model=model_name, stage='batch_wait'):
+            outputs = forward(model, batcher, inputs, g.deadline)
+        summary = np.stack([outputs.mean(axis=0), outputs.std(axis=0)])
+        prediction_cache.put(cache_key, summary)
+    return summary[0], summary[1]
+
+def predict_single(image_bytes, model, batcher, build_results_fn, views=1, enhance_contrast=True, tensor=False,
+                   explain=False):
+    """Result payload for one image, averaged over `views` augmented views if
+    more than one, with a Grad-CAM explanation of the plain image if asked"""
+    if views == 1:
+        prediction = run_prediction(image_bytes, model, batcher, enhance_contrast=enhance_contrast, tensor=tensor)
+        explanation = explain_image(image_bytes, model, enhance_contrast, tensor) if explain else None
+        with STAGE_SECONDS.time(model=model.name, stage='serialization'):
+            result = build_results_fn(prediction[np.newaxis], calibration=model.calibration)[0]
+            result['model_version'] = model.version
+            if explanation is not None:
+                result['explanation'] = explanation
+            return served_by(jsonify(result), model)
+    
+    prediction, spread = run_tta_prediction(
+        image_bytes, model, batcher, views, enhance_contrast=enhance_contrast, tensor=tensor,
+    )
+    explanation = explain_image(image_bytes, model, enhance_contrast, tensor) if explain else None
+    with STAGE_SECONDS.time(model=model.name, stage='serialization'):
+        result = build_results_fn(prediction[np.newaxis], calibration=model.calibration)[0]
+        result['model_version'] = model.version
+        if explanation is not None:
+            result['explanation'] = explanation
+        uncertainty = float(spread.max())
+        result['tta'] = {
+            'views': views,
+            'augmentations': list(AUGMENTATIONS[:views]),
+            'std': [round(float(value), 4) for value in spread],
+            'uncertainty': round(uncertainty, 4),
+            'uncertain': uncertainty >= TTA_UNCERTAINTY_STD,
+        }
+        return served_by(jsonify(result), model)
+
+def run_prediction(image_bytes, model, batcher, enhance_contrast=True, tensor=False):
+    """Return the raw output row for one image, from the cache when possible"""
+    model_name = model.name
+    cache_key = prediction_cache.make_key(
+        image_bytes, model_name, model.model_id, **input_flags(enhance_contrast, tensor)
+    )
+    prediction = prediction_cache.get(cache_key)
+    if prediction is None:
+        timings = {}
+        if tensor:
+            image_info = {'format': 'tensor', 'bytes': len(image_bytes)}
+            preprocessed = to_model_input(decode_tensor(image_bytes, timings)[np.newaxis])
+        else:
+            image_info = check_image(model_name, image_bytes)
+            preprocessed = preprocess_pool.preprocess(image_bytes, enhance_contrast, timings)
+        observe_stages(model_name, timings)
+        
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug('Preprocessed image', extra={'fields': {
+                'model': model_name,
+                **image_info,
+                'shape': preprocessed.shape,
+                'min': round(float(preprocessed.min()), 4),
+                'max': round(float(preprocessed.max()), 4),
+                'mean': round(float(preprocessed.mean()), 4),
+            }})
+        
+        # Run prediction (batched with other concurrent requests)
+        with STAGE_SECONDS.time(model=model_name, stage='batch_wait'):
+            prediction = forward(model, batcher, preprocessed, g.deadline, activation_keys=[cache_key])[0]
+        prediction_cache.put(cache_key, prediction)
+    return prediction
+
+def predict_batch(model, batcher, build_results_fn, enhance_contrast=True, tensor=False):
+    """Shared handler for the multi-image batch endpoints.
+
+    Files are preprocessed in parallel, inference runs as a single batch and
+    results come back in upload order. A file that fails to decode gets a
+    per-item error instead of failing the whole request.
+    """
+    model_name = model.name
+    upload_started = time.perf_counter()
+    # Accept both `images` and repeated `image` fields
+    image_files = request.files.getlist('images') or request.files.getlist('image')
+    if not image_files:
+        return jsonify({'error': 'No image files provided'}), 400
+    if len(image_files) > BATCH_MAX_FILES:
+        return jsonify({
+            'error': f'Too many images in one request (maximum is {BATCH_MAX_FILES})'
+        }), 413
+    
+    filenames = [image_file.filename for image_file in image_files]
+    image_bytes_list = read_files(model_name, image_files)
+    STAGE_SECONDS.observe(time.perf_counter() - upload_started, model=model_name, stage='upload_read')
+    
+    # Serve repeated images from the cache; only the rest are preprocessed
+    cache_keys = [
+        prediction_cache.make_key(image_bytes, model_name, model.model_id, **input_flags(enhance_contrast, tensor))
+        for image_bytes in image_bytes_list
+    ]
+    predictions = [prediction_cache.get(cache_key) for cache_key in cache_keys]
+    
+    # Check every cache miss from its header, then preprocess the accepted
+    # ones in parallel in the worker pool
+    results = [None] * len(image_files)
+    timings = {}
+    futures = {}
+    for index, prediction in enumerate(predictions):
+        if prediction is not None:
+            continue
+        timings[index] = {}
+        try:
+            futures[index] = submit_input(model_name, image_bytes_list[index], enhance_contrast, tensor, timings[index])
+        except Exception as e:
+            results[index] = {
+                'index': index,
+                'filename': filenames[index],
+                'error': f'Could not process image: {str(e)}',
+            }
+    
+    ok_indices = []
+    ok_arrays = []
+    for index, future in futures.items():
+        try:
+            ok_arrays.append(future.result())
+            ok_indices.append(index)
+            observe_stages(model_name, timings[index])
+        except Exception as e:
+            results[index] = {
+                'index': index,
+                'filename': filenames[index],
+                'error': f'Could not process image: {str(e)}',
+            }
+    
+    # One forward pass for every image that preprocessed successfully
+    if ok_arrays:
+        with STAGE_SECONDS.time(model=model_name, stage='batch_wait'):
+            batch_predictions = forward(
+                model, batcher, np.concatenate(ok_arrays, axis=0), g.deadline,
+                activation_keys=[cache_keys[index] for index in ok_indices],
+            )
+        for index, prediction in zip(ok_indices, batch_predictions):
+            predictions[index] = prediction
+            prediction_cache.put(cache_keys[index], prediction)
+    
+    with STAGE_SECONDS.time(model=model_name, stage='serialization'):
+        # Every successful image's result from one pass over the stacked outputs
+        scored = [index for index, prediction in enumerate(predictions) if prediction is not None]
+        if scored:
+            built = build_results_fn(np.stack([predictions[index] for index in scored]), calibration=model.calibration)
+            for index, result in zip(scored, built):
+                results[index] = {'index': index, 'filename': filenames[index], **result}
+        succeeded = len(scored)
+        
+        return served_by(jsonify({
+            'results': results,
+            'count': len(results),
+            'succeeded': succeeded,
+            'failed': len(results) - succeeded,
+            'model_version': model.version,
+        }), model)
+
 @app.route('/malaria-predict', methods=['POST'])
 def predict_malaria():
     """Malaria detection endpoint"""
     try:
-        if malaria_model is None:
-            return jsonify({'error': 'Malaria model not loaded'}), 503
+        model, error = acquire_model('malaria')
+        if error:
+            return error
         
         # Get image from form data
-        if 'image' not in request.files:
+        image_bytes = read_upload('malaria')
+        if image_bytes is None:
             return jsonify({'error': 'No image file provided'}), 400
+        views = requested_views()
+        if views is None:
+            return invalid_views()
+        input_kind = requested_input()
+        if input_kind is None:
+            return invalid_input()
+        explain = requested_explain()
+        if explain and not model.explainable:
+            return explanation_unavailable(model)
+        
+        # Preprocess and run prediction (cached, batched with other requests)
+        return predict_single(
+            image_bytes, model, malaria_batcher, result_builder(malaria_results), views,
+            tensor=input_kind == 'tensor', explain=explain,
+        )
         
-        image_file = request.files['image']
-        image_bytes = image_file.read()
-        
-        # Preprocess image
-        preprocessed = preprocess_image(image_bytes)
-        
-        # Run prediction
-        prediction = malaria_model.predict(preprocessed, verbose=0)[0]
-        
-        # Model outputs single value (sigmoid), so: 
-        # - prediction[0] is probability of parasitized
-        # - 1 - prediction[0] is probability of uninfected
-        parasitized_prob = float(prediction[0])
-        uninfected_prob = float(1 - prediction[0])
-        
-        # Determine result
-        is_parasitized = parasitized_prob >= 0.5
-        confidence = parasitized_prob if is_parasitized else uninfected_prob
+    except ImageTooLarge as e:
+        return jsonify({'error': str(e)}), 413
+    except InvalidTensor as e:
+        return jsonify({'error': str(e)}), 400
+    except (HTTPException, QueueFull, DeadlineExceeded):
+        raise
+    except Exception as e:
+        logger.exception(f"Error in malaria prediction: {str(e)}")
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/malaria-predict/batch', methods=['POST'])
+def predict_malaria_batch():
+    """Malaria detection for many blood smear images in one request"""
+    try:
+        model, error = acquire_model('malaria')
+        if error:
+            return error
         
-        result = {
-            'prediction': 'Parasitized' if is_parasitized else 'Uninfected',
-            'confidence': confidence,
-            'message': (
-                'Malaria parasites have been detected in the blood smear image. Please consult with a healthcare professional immediately for proper diagnosis and treatment.'
-                if is_parasitized
-                else 'No malaria parasites detected in the blood smear image. The sample appears to be uninfected. However, this is a preliminary analysis and should be confirmed by a medical professional.'
-            ),
-            'recommendations': (
-                [
-                    'Seek immediate medical attention',
-                    'Get a proper laboratory test for confirmation',
-                    "Follow your healthcare provider's treatment recommendations",
-                    'Monitor symptoms closely',
-                    'Complete the full course of treatment if prescribed',
-                ]
-                if is_parasitized
-                else [
-                    'Continue regular health monitoring',
-                    'If experiencing symptoms, consult a healthcare professional',
-                    'Consider preventive measures if in a malaria-endemic area',
-                    'Keep the image for medical records',
-                ]
-            ),
-        }
+        input_kind = requested_input()
+        if input_kind is None:
+            return invalid_input()
         
-        return jsonify(result)
+        return predict_batch(model, malaria_batcher, result_builder(malaria_results), tensor=input_kind == 'tensor')
         
+    except (HTTPException, QueueFull, DeadlineExceeded):
+        raise
     except Exception as e:
-        print(f"Error in malaria prediction: {str(e)}")
+        logger.exception(f"Error in malaria batch prediction: {str(e)}")
         return jsonify({'error': str(e)}), 500
 
 @app.route('/pneumonia-predict', methods=['POST'])
 def predict_pneumonia():
     """Pneumonia detection endpoint"""
     try:
-        if pneumonia_model is None:
-            return jsonify({
-                'error': 'Pneumonia model not loaded',
-                'message': 'Please ensure pneumonia_model.h5 exists in ../lib/model/ directory'
-            }), 503
+        model, error = acquire_model(
+            'pneumonia',
+            'Please ensure pneumonia_model.h5 exists in ../lib/model/ directory',
+        )
+        if error:
+            return error
         
         # Get image from form data
-        if 'image' not in request.files:
+        image_bytes = read_upload('pneumonia')
+        if image_bytes is None:
             return jsonify({'error': 'No image file provided'}), 400
+        views = requested_views()
+        if views is None:
+            return invalid_views()
+        input_kind = requested_input()
+        if input_kind is None:
+            return invalid_input()
+        explain = requested_explain()
+        if explain and not model.explainable:
+            return explanation_unavailable(model)
+        
+        # Preprocess with enhanced contrast for medical X-rays and run
+        # prediction (cached, batched with other requests)
+        return predict_single(
+            image_bytes, model, pneumonia_batcher, result_builder(pneumonia_results), views,
+            enhance_contrast=True, tensor=input_kind == 'tensor', explain=explain,
+        )
         
-        image_file = request.files['image']
-        image_bytes = image_file.read()
-        
-        # Preprocess image with enhanced preprocessing for medical X-rays
-        preprocessed = preprocess_image_pneumonia(image_bytes)
-        
-        # Debug: Print image statistics
-        print(f"DEBUG: Preprocessed image shape: {preprocessed.shape}")
-        print(f"DEBUG: Preprocessed image min: {preprocessed.min():.4f}, max: {preprocessed.max():.4f}, mean: {preprocessed.mean():.4f}")
-        
-        # Run prediction
-        prediction = pneumonia_model.predict(preprocessed, verbose=0)[0]
-        
-        # Debug: Print raw prediction output
-        print(f"DEBUG: Raw prediction shape: {prediction.shape}")
-        print(f"DEBUG: Raw prediction values: {prediction}")
-        print(f"DEBUG: Prediction type: {type(prediction)}")
-        
-        # Model output format may vary - adjust based on your model
-        # Common formats:
-        # 1. Binary classification: [prob_normal, prob_pneumonia] (most common for pneumonia models)
-        # 2. Single sigmoid value (pneumonia probability)
-        # 3. [prob_pneumonia, prob_normal] (less common)
-        
-        # Try to handle different output formats
-        if len(prediction.shape) == 0:
-            # Single value (sigmoid output) - value is pneumonia probability
-            pneumonia_prob = float(prediction)
-            normal_prob = 1.0 - pneumonia_prob
-            print(f"DEBUG: Single value output - Pneumonia prob: {pneumonia_prob}, Normal prob: {normal_prob}")
-        elif len(prediction) == 2:
-            # Two-class output - Most pneumonia models use [normal_prob, pneumonia_prob]
-            # Check which index has higher value to determine format
-            if prediction[0] > prediction[1]:
-                # Likely [pneumonia_prob, normal_prob] - first is pneumonia
-                pneumonia_prob = float(prediction[0])
-                normal_prob = float(prediction[1])
-                print(f"DEBUG: Format [pneumonia, normal] - Pneumonia: {pneumonia_prob}, Normal: {normal_prob}")
-            else:
-                # Likely [normal_prob, pneumonia_prob] - second is pneumonia (most common)
-                normal_prob = float(prediction[0])
-                pneumonia_prob = float(prediction[1])
-                print(f"DEBUG: Format [normal, pneumonia] - Normal: {normal_prob}, Pneumonia: {pneumonia_prob}")
-        else:
-            # Default: use first value as pneumonia probability
-            pneumonia_prob = float(prediction[0])
-            normal_prob = 1.0 - pneumonia_prob
-            print(f"DEBUG: Default format - Pneumonia prob: {pneumonia_prob}, Normal prob: {normal_prob}")
-        
-        # Determine result with adaptive threshold
-        # Use slightly higher threshold to reduce false positives on hospital images
-        # This helps when model was trained on Kaggle data but tested on hospital images
-        threshold = 0.6  # Increased from 0.5 to reduce false positives
-        has_pneumonia = pneumonia_prob >= threshold
-        confidence = pneumonia_prob if has_pneumonia else normal_prob
-        
-        # Also check if probabilities are too close (uncertain prediction)
-        prob_diff = abs(pneumonia_prob - normal_prob)
-        is_uncertain = prob_diff < 0.1  # Less than 10% difference = uncertain
-        
-        print(f"DEBUG: Final decision - Has Pneumonia: {has_pneumonia}, Confidence: {confidence:.4f}")
-        print(f"DEBUG: Probability difference: {prob_diff:.4f}, Uncertain: {is_uncertain}")
-        
-        if is_uncertain:
-            print(f"DEBUG: WARNING - Uncertain prediction (probabilities too close)")
-        
-        # If uncertain, be more conservative
-        if is_uncertain and has_pneumonia:
-            # If uncertain but leaning towards pneumonia, mark as uncertain
-            prediction_label = 'Uncertain - Recommend professional review'
-            confidence = 0.5  # Neutral confidence for uncertain cases
-        else:
-            prediction_label = 'Pneumonia' if has_pneumonia else 'Normal'
+    except ImageTooLarge as e:
+        return jsonify({'error': str(e)}), 413
+    except InvalidTensor as e:
+        return jsonify({'error': str(e)}), 400
+    except (HTTPException, QueueFull, DeadlineExceeded):
+        raise
+    except Exception as e:
+        logger.exception(f"Error in pneumonia prediction: {str(e)}")
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/pneumonia-predict/batch', methods=['POST'])
+def predict_pneumonia_batch():
+    """Pneumonia detection for many chest X-rays in one request"""
+    try:
+        model, error = acquire_model(
+            'pneumonia',
+            'Please ensure pneumonia_model.h5 exists in ../lib/model/ directory',
+        )
+        if error:
+            return error
         
-        result = {
-            'prediction': prediction_label,
-            'confidence': round(confidence, 4),
-            'probabilities': {
-                'pneumonia': round(pneumonia_prob, 4),
-                'normal': round(normal_prob, 4)
-            },
-            'uncertain': is_uncertain,
-            'threshold_used': threshold,
-            'raw_prediction': prediction.tolist() if hasattr(prediction, 'tolist') else str(prediction),
-            'message': (
-                'Uncertain prediction - The model probabilities are very close, indicating low confidence. Please have this X-ray reviewed by a licensed radiologist for accurate diagnosis.'
-                if is_uncertain
-                else (
-                    'Pneumonia-like patterns have been detected in the chest X-ray image. Please consult with a healthcare professional immediately for proper diagnosis and treatment. This is a preliminary analysis and should be confirmed by a licensed radiologist.'
-                    if has_pneumonia
-                    else 'No obvious signs of pneumonia detected in the chest X-ray image. The X-ray appears normal. However, this is a preliminary analysis and should be confirmed by a licensed radiologist for accurate diagnosis.'
-                )
-            ),
-            'recommendations': (
-                [
-                    'Seek immediate medical attention',
-                    'Consult with a pulmonologist or radiologist for proper diagnosis',
-                    "Follow your healthcare provider's treatment recommendations",
-                    'Monitor respiratory symptoms closely',
-                    'Complete the full course of treatment if prescribed',
-                    'Get follow-up X-rays as recommended by your doctor',
-                ]
-                if has_pneumonia
-                else [
-                    'Continue regular health monitoring',
-                    'If experiencing respiratory symptoms, consult a healthcare professional',
-                    'Consider preventive measures during flu season',
-                    'Keep the X-ray for medical records',
-                    'Follow up with your healthcare provider if symptoms persist',
-                ]
-            ),
-        }
+        input_kind = requested_input()
+        if input_kind is None:
+            return invalid_input()
         
-        return jsonify(result)
+        return predict_batch(
+            model, pneumonia_batcher, result_builder(pneumonia_results), enhance_contrast=True,
+            tensor=input_kind == 'tensor',
+        )
         
+    except (HTTPException, QueueFull, DeadlineExceeded):
+        raise
     except Exception as e:
-        print(f"Error in pneumonia prediction: {str(e)}")
-        import traceback
-        traceback.print_exc()
+        logger.exception(f"Error in pneumonia batch prediction: {str(e)}")
         return jsonify({'error': str(e)}), 500
 
 if __name__ == '__main__':
-    print("Starting Flask server on http://localhost:5000")
+    logger.info("Starting Flask server on http://localhost:5007")
     app.run(host='0.0.0.0', port=5007, debug=False)
-
-
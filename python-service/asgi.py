@@ -0,0 +1,222 @@
+"""
+ASGI entry point for production serving.
+
+The Flask development server (python app.py) gives every connection a thread
+for the whole request, so a slow multipart upload holds a thread while
+TensorFlow sits idle. This module serves the same Flask app under an ASGI
+server instead:
+
+- the request body is received on the event loop, so an upload in progress
+  costs no thread. Bodies up to UPLOAD_SPOOL_BYTES stay in memory, larger
+  ones spill to a temporary file, and bodies over MAX_UPLOAD_MB are refused
+  with 413 as soon as they exceed it.
+- once the body is complete the Flask view runs on a bounded thread pool
+  (SERVER_THREADS), where the preprocessing pool and the micro-batchers do
+  the actual work.
+- at most SERVER_MAX_PENDING POST requests are received or waiting for a
+  thread at once; more are refused with 503 and Retry-After before their
+  body is read. GET requests (/health, /ready, /metrics) are never shed.
+
+Run a single process with uvicorn, or several with gunicorn (gunicorn.conf.py):
+    uvicorn asgi:app --host 0.0.0.0 --port 5007
+    gunicorn -c gunicorn.conf.py asgi:app
+"""
+
+import asyncio
+import logging
+import os
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from app import ADMISSION_RETRY_AFTER, MAX_UPLOAD_BYTES, app as flask_app, preprocess_pool
+from service_logging import SERVICE_LOGGER
+from uploads import UPLOAD_SPOOL_BYTES
+
+# Threads running Flask views. Views block on preprocessing and inference, so
+# this bounds how many requests are in flight at once; more threads than
+# BATCH_MAX_SIZE mostly adds queueing.
+SERVER_THREADS = int(os.environ.get('SERVER_THREADS', '32'))
+# POST requests in progress (receiving, waiting for a thread or running)
+# beyond which new ones are shed with 503; 0 = unlimited
+SERVER_MAX_PENDING = int(os.environ.get('SERVER_MAX_PENDING', str(SERVER_THREADS * 4)))
+
+logger = logging.getLogger(SERVICE_LOGGER)
+
+
+def build_environ(scope, body, content_length, received_at):
+    """WSGI environ for an ASGI HTTP scope whose body has been received"""
+    server = scope.get('server') or ('localhost', None)
+    client = scope.get('client') or ('', 0)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', '').encode('utf8').decode('latin1'),
+        'PATH_INFO': scope['path'].encode('utf8').decode('latin1'),
+        'QUERY_STRING': scope['query_string'].decode('latin1'),
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1] or 80),
+        'SERVER_PROTOCOL': f"HTTP/{scope['http_version']}",
+        'REMOTE_ADDR': client[0],
+        'REMOTE_PORT': str(client[1]),
+        'CONTENT_LENGTH': str(content_length),
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': body,
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False,
+        # When the request arrived, before its body was received; relative
+        # request deadlines count from here (admission.py)
+        'service.received_at': received_at,
+    }
+    for name, value in scope['headers']:
+        name = name.decode('latin1')
+        value = value.decode('latin1')
+        if name == 'content-length':
+            continue
+        if name == 'content-type':
+            environ['CONTENT_TYPE'] = value
+            continue
+        key = 'HTTP_' + name.upper().replace('-', '_')
+        environ[key] = f'{environ[key]},{value}' if key in environ else value
+    return environ
+
+
+class _BodyTooLarge(Exception):
+    pass
+
+
+class WSGIAdapter:
+    """Serves a WSGI app over ASGI: bodies are received asynchronously, the
+    app runs on a bounded thread pool once the body is complete"""
+
+    def __init__(self, wsgi_app, threads=SERVER_THREADS, spool_bytes=UPLOAD_SPOOL_BYTES,
+                 max_body_bytes=None, max_pending=SERVER_MAX_PENDING, on_shutdown=None):
+        self.wsgi_app = wsgi_app
+        self.spool_bytes = spool_bytes
+        self.max_body_bytes = max_body_bytes
+        self.max_pending = max_pending
+        self.on_shutdown = on_shutdown
+        # POST requests in progress; only touched on the event loop
+        self.pending = 0
+        self.executor = ThreadPoolExecutor(max_workers=threads, thread_name_prefix='wsgi')
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'http':
+            await self._http(scope, receive, send)
+        elif scope['type'] == 'lifespan':
+            await self._lifespan(receive, send)
+
+    async def _lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                self.executor.shutdown(wait=False)
+                if self.on_shutdown:
+                    self.on_shutdown()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def _receive_body(self, receive):
+        """Spool the request body.
+
+        Returns None if the client disconnected first and raises
+        _BodyTooLarge once the body exceeds max_body_bytes.
+        """
+        body = tempfile.SpooledTemporaryFile(max_size=self.spool_bytes)
+        while True:
+            message = await receive()
+            if message['type'] == 'http.disconnect':
+                body.close()
+                return None
+            body.write(message.get('body', b''))
+            if self.max_body_bytes is not None and body.tell() > self.max_body_bytes:
+                body.close()
+                raise _BodyTooLarge()
+            if not message.get('more_body', False):
+                break
+        content_length = body.tell()
+        body.seek(0)
+        return body, content_length
+
+    async def _too_large(self, send):
+        limit_mb = self.max_body_bytes / 1024 / 1024
+        body = f'{{"error": "Upload too large (maximum is {limit_mb:g} MB)"}}'.encode()
+        await send({'type': 'http.response.start', 'status': 413, 'headers': [
+            (b'content-type', b'application/json'), (b'connection', b'close'),
+        ]})
+        await send({'type': 'http.response.body', 'body': body})
+
+    async def _overloaded(self, send):
+        await send({'type': 'http.response.start', 'status': 503, 'headers': [
+            (b'content-type', b'application/json'), (b'connection', b'close'),
+            (b'retry-after', str(ADMISSION_RETRY_AFTER).encode()),
+        ]})
+        await send({'type': 'http.response.body', 'body': b'{"error": "Server is overloaded"}'})
+
+    async def _http(self, scope, receive, send):
+        if scope['method'] != 'POST':
+            await self._serve(scope, receive, send)
+            return
+        if self.max_pending and self.pending >= self.max_pending:
+            await self._overloaded(send)
+            return
+        self.pending += 1
+        try:
+            await self._serve(scope, receive, send)
+        finally:
+            self.pending -= 1
+
+    async def _serve(self, scope, receive, send):
+        received_at = time.time()
+        # Refuse from Content-Length before receiving anything
+        declared = dict(scope['headers']).get(b'content-length')
+        if self.max_body_bytes is not None and declared and declared.isdigit() and int(declared) > self.max_body_bytes:
+            await self._too_large(send)
+            return
+        try:
+            received = await self._receive_body(receive)
+        except _BodyTooLarge:
+            await self._too_large(send)
+            return
+        if received is None:
+            return
+        body, content_length = received
+
+        environ = build_environ(scope, body, content_length, received_at)
+        loop = asyncio.get_running_loop()
+        try:
+            status, headers, chunks = await loop.run_in_executor(self.executor, self._call_app, environ)
+        except Exception as e:
+            logger.exception(f"Error serving {scope['method']} {scope['path']}: {str(e)}")
+            status, headers, chunks = 500, [(b'content-type', b'text/plain')], [b'Internal Server Error']
+        finally:
+            body.close()
+
+        await send({'type': 'http.response.start', 'status': status, 'headers': headers})
+        await send({'type': 'http.response.body', 'body': b''.join(chunks)})
+
+    def _call_app(self, environ):
+        """Run the WSGI app to completion on a pool thread"""
+        response = {}
+        chunks = []
+
+        def start_response(status, headers, exc_info=None):
+            response['status'] = int(status.split(' ', 1)[0])
+            response['headers'] = [(name.lower().encode('latin1'), value.encode('latin1')) for name, value in headers]
+            return chunks.append
+
+        result = self.wsgi_app(environ, start_response)
+        try:
+            chunks.extend(result)
+        finally:
+            if hasattr(result, 'close'):
+                result.close()
+        return response['status'], response['headers'], chunks
+
+
+app = WSGIAdapter(flask_app, max_body_bytes=MAX_UPLOAD_BYTES, on_shutdown=preprocess_pool.shutdown)
@@ -0,0 +1,195 @@
+"""
+Inference backends.
+
+Every backend exposes ``predict(batch) -> np.ndarray`` for a float32
+(n, 224, 224, 3) batch, so the service can switch between the original Keras
+model and optimized TFLite / ONNX Runtime exports per model at startup:
+
+- ``keras``:  the .h5 model through a compiled tf.function (optionally XLA)
+- ``tflite``: a .tflite export run by the TFLite interpreter (XNNPACK)
+- ``onnx``:   an .onnx export run by ONNX Runtime on CPU
+
+Exports are produced by export_optimized.py and live next to the source model
+as ``<stem>.tflite``, ``<stem>.<quantization>.tflite``, ``<stem>.onnx`` or
+``<stem>.<quantization>.onnx``.
+"""
+
+import logging
+import os
+import threading
+
+import numpy as np
+
+from service_logging import SERVICE_LOGGER
+
+logger = logging.getLogger(SERVICE_LOGGER)
+
+BACKENDS = ('keras', 'tflite', 'onnx')
+QUANTIZATIONS = ('none', 'dynamic', 'fp16', 'int8')
+
+_EXTENSIONS = {'tflite': '.tflite', 'onnx': '.onnx'}
+
+IMAGE_SHAPE = (224, 224, 3)
+
+
+def bucket_sizes(max_batch_size):
+    """Powers of two up to (and including) max_batch_size: 1, 2, 4, ..."""
+    sizes = []
+    size = 1
+    while size < max_batch_size:
+        sizes.append(size)
+        size *= 2
+    sizes.append(max(1, int(max_batch_size)))
+    return sizes
+
+
+def bucket_for(batch_size):
+    """Smallest power of two >= batch_size"""
+    return 1 << max(0, int(batch_size) - 1).bit_length()
+
+
+def optimized_model_path(source_path, backend, quantization='none'):
+    """Path of the exported artifact for a source .h5 model"""
+    stem = os.path.splitext(source_path)[0]
+    suffix = '' if quantization in (None, '', 'none') else f'.{quantization}'
+    return f'{stem}{suffix}{_EXTENSIONS[backend]}'
+
+
+class _WarmupMixin:
+    def warmup(self, batch_sizes):
+        """Run dummy batches so the first real requests don't pay for setup"""
+        for size in batch_sizes:
+            self.predict(np.zeros((size,) + IMAGE_SHAPE, dtype=np.float32))
+
+
+class KerasBackend(_WarmupMixin):
+    """Runs a tf.keras model through a tf.function with a fixed input signature.
+
+    Avoids Model.predict's per-call data adapter, iterator and callback setup.
+    With jit_compile the graph is compiled by XLA, which specializes on the
+    batch size, so batches are padded up to the next power of two to bound the
+    number of compilations.
+
+    With explain, the compiled forward pass also returns the feature maps
+    Grad-CAM needs (see explain.py), and predict_with_activations() hands
+    them out. A model without a suitable layer is served without
+    explanations.
+    """
+
+    name = 'keras'
+
+    def __init__(self, model, jit_compile=False, explain=False, explain_layer=None):
+        import tensorflow as tf
+
+        self.model = model
+        self.jit_compile = bool(jit_compile)
+        self.gradcam = None
+        if explain:
+            from explain import GradCam
+            try:
+                self.gradcam = GradCam(model, explain_layer)
+            except ValueError as e:
+                logger.warning(f"Explanations disabled for {model.name}: {str(e)}", extra={'fields': {
+                    'model_name': model.name, 'explain_layer': explain_layer,
+                }})
+        forward = self.gradcam.forward if self.gradcam is not None else lambda images: model(images, training=False)
+        self._fn = tf.function(
+            forward,
+            input_signature=[tf.TensorSpec((None,) + IMAGE_SHAPE, tf.float32)],
+            jit_compile=self.jit_compile,
+        )
+
+    def _run(self, batch):
+        count = len(batch)
+        batch = np.ascontiguousarray(batch, dtype=np.float32)
+        if self.jit_compile:
+            padded = bucket_for(count)
+            if padded > count:
+                batch = np.concatenate([batch, np.zeros((padded - count,) + batch.shape[1:], dtype=np.float32)])
+        outputs = self._fn(batch)
+        if self.gradcam is None:
+            return outputs.numpy()[:count], None
+        return outputs[0].numpy()[:count], outputs[1].numpy()[:count]
+
+    def predict(self, batch):
+        return self._run(batch)[0]
+
+    def predict_with_activations(self, batch):
+        """(outputs, Grad-CAM activations) of one forward pass; activations
+        are None without explanations"""
+        return self._run(batch)
+
+    def warmup(self, batch_sizes):
+        super().warmup(batch_sizes)
+        if self.gradcam is not None:
+            self.gradcam.warmup()
+
+
+class TFLiteBackend(_WarmupMixin):
+    """Runs a .tflite model with the TFLite interpreter (XNNPACK on CPU)"""
+
+    name = 'tflite'
+
+    def __init__(self, path, num_threads=None):
+        import tensorflow as tf
+
+        self.path = path
+        self.interpreter = tf.lite.Interpreter(model_path=path, num_threads=num_threads)
+        self._input = self.interpreter.get_input_details()[0]
+        self._output = self.interpreter.get_output_details()[0]
+        self._batch_size = None
+        # The interpreter is not thread-safe
+        self._lock = threading.Lock()
+
+    def _quantize(self, batch):
+        dtype = self._input['dtype']
+        if dtype == np.float32:
+            return np.ascontiguousarray(batch, dtype=np.float32)
+        scale, zero_point = self._input['quantization']
+        return np.clip(np.round(batch / scale + zero_point), np.iinfo(dtype).min, np.iinfo(dtype).max).astype(dtype)
+
+    def predict(self, batch):
+        with self._lock:
+            if self._batch_size != len(batch):
+                self.interpreter.resize_tensor_input(self._input['index'], list(batch.shape))
+                self.interpreter.allocate_tensors()
+                self._batch_size = len(batch)
+                self._output = self.interpreter.get_output_details()[0]
+
+            self.interpreter.set_tensor(self._input['index'], self._quantize(batch))
+            self.interpreter.invoke()
+            output = self.interpreter.get_tensor(self._output['index'])
+
+            if output.dtype != np.float32:
+                scale, zero_point = self._output['quantization']
+                output = (output.astype(np.float32) - zero_point) * scale
+            return output.copy()
+
+
+class OnnxBackend(_WarmupMixin):
+    """Runs an .onnx model with ONNX Runtime on CPU"""
+
+    name = 'onnx'
+
+    def __init__(self, path, num_threads=None):
+        import onnxruntime as ort
+
+        self.path = path
+        options = ort.SessionOptions()
+        if num_threads:
+            options.intra_op_num_threads = num_threads
+        self.session = ort.InferenceSession(path, sess_options=options, providers=['CPUExecutionProvider'])
+        self._input_name = self.session.get_inputs()[0].name
+
+    def predict(self, batch):
+        feed = {self._input_name: np.ascontiguousarray(batch, dtype=np.float32)}
+        return self.session.run(None, feed)[0]
+
+
+def load_backend(backend, path, num_threads=None):
+    """Load an exported (non-Keras) model file with the given backend"""
+    if backend == 'tflite':
+        return TFLiteBackend(path, num_threads=num_threads)
+    if backend == 'onnx':
+        return OnnxBackend(path, num_threads=num_threads)
+    raise ValueError(f"Unknown inference backend '{backend}' (expected one of {', '.join(BACKENDS)})")
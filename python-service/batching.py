@@ -0,0 +1,211 @@
+"""
+Dynamic micro-batching for model inference.
+
+Requests for the same model are queued and coalesced into a single forward
+pass of up to ``max_batch_size`` images, waiting at most ``max_wait_ms`` after
+the first queued request before running whatever has been collected.
+Each caller gets back its own slice of the batched output. ``predict_fn`` may
+also return a tuple of arrays with a row per input (e.g. outputs plus the
+activations captured for explanations); callers then get a tuple of slices.
+
+Requests carry an optional key (the model version they must run on); only
+requests with the same key are coalesced, and the key is passed to
+``predict_fn(inputs, key)``.
+
+The queue is bounded: with ``max_queue`` set, submitting rows that would take
+the queue past it raises QueueFull. Requests may carry a deadline (a
+time.time() timestamp); a request still queued when its deadline passes is
+dropped with DeadlineExceeded instead of running.
+"""
+
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+
+import numpy as np
+
+
+class QueueFull(RuntimeError):
+    """The batch queue has no room for more rows"""
+
+
+class DeadlineExceeded(TimeoutError):
+    """The request's deadline passed before inference started"""
+
+
+class _PendingBatch:
+    """A caller's input rows waiting in the queue"""
+    __slots__ = ('inputs', 'key', 'deadline', 'future', 'enqueued_at')
+
+    def __init__(self, inputs, key, deadline):
+        self.inputs = inputs
+        self.key = key
+        self.deadline = deadline
+        self.future = Future()
+        self.enqueued_at = time.monotonic()
+
+
+class MicroBatcher:
+    """Coalesces concurrent predict calls for one model into batched forward passes"""
+
+    def __init__(self, name, predict_fn, max_batch_size=32, max_wait_ms=10.0, max_queue=None):
+        self.name = name
+        self.predict_fn = predict_fn
+        self.max_batch_size = max(1, int(max_batch_size))
+        self.max_wait = max(0.0, float(max_wait_ms)) / 1000.0
+        self.max_queue = int(max_queue) if max_queue else None
+
+        self._queue = deque()
+        self._queued_rows = 0
+        self._cond = threading.Condition()
+
+        # Achieved batch size -> number of forward passes run at that size
+        self._histogram = {}
+        self._batches = 0
+        self._rows = 0
+        self._rejected = 0
+        self._expired = 0
+
+        self._worker = threading.Thread(
+            target=self._run, name=f'{name}-batcher', daemon=True
+        )
+        self._worker.start()
+
+    def submit(self, inputs, key=None, deadline=None):
+        """Queue a (n, H, W, C) array and return a Future for its (n, ...) output.
+
+        Raises QueueFull if the rows do not fit in the queue (a request is
+        always accepted into an empty queue, whatever its size) and
+        DeadlineExceeded if the deadline has already passed.
+        """
+        if deadline is not None and time.time() >= deadline:
+            with self._cond:
+                self._expired += 1
+            raise DeadlineExceeded(f'{self.name} request deadline passed before inference')
+        pending = _PendingBatch(inputs, key, deadline)
+        with self._cond:
+            if self.max_queue is not None and self._queued_rows and self._queued_rows + len(inputs) > self.max_queue:
+                self._rejected += 1
+                raise QueueFull(f'{self.name} batch queue is full ({self._queued_rows} images queued)')
+            self._queue.append(pending)
+            self._queued_rows += len(inputs)
+            self._cond.notify()
+        return pending.future
+
+    def queue_full(self):
+        """True if the queue is at max_queue, so further rows would be refused"""
+        with self._cond:
+            return self.max_queue is not None and self._queued_rows >= self.max_queue
+
+    def predict(self, inputs, timeout=None, key=None, deadline=None):
+        """Blocking helper: submit inputs and wait for their slice of the output"""
+        return self.submit(inputs, key, deadline).result(timeout=timeout)
+
+    def _drop_expired(self):
+        """Fail queued requests whose deadline has passed; called with the lock held"""
+        now = time.time()
+        if not any(pending.deadline is not None and now >= pending.deadline for pending in self._queue):
+            return
+        kept = deque()
+        for pending in self._queue:
+            if pending.deadline is not None and now >= pending.deadline:
+                self._queued_rows -= len(pending.inputs)
+                self._expired += 1
+                pending.future.set_exception(
+                    DeadlineExceeded(f'{self.name} request deadline passed before inference')
+                )
+            else:
+                kept.append(pending)
+        self._queue = kept
+
+    def _collect(self):
+        """Wait for work, then take up to max_batch_size rows off the queue"""
+        with self._cond:
+            while True:
+                while not self._queue:
+                    self._cond.wait()
+
+                # Give other requests up to max_wait (measured from the oldest
+                # queued request) to join, unless the batch is already full
+                wait_until = self._queue[0].enqueued_at + self.max_wait
+                while self._queued_rows < self.max_batch_size:
+                    remaining = wait_until - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._cond.wait(remaining)
+
+                # Requests whose client has given up are not run
+                self._drop_expired()
+                if self._queue:
+                    break
+
+            # Always take at least one request, even if it alone exceeds
+            # max_batch_size (e.g. a multi-image upload). Requests for other
+            # keys stay queued in order.
+            taken = [self._queue.popleft()]
+            key = taken[0].key
+            rows = len(taken[0].inputs)
+            kept = deque()
+            while self._queue:
+                pending = self._queue.popleft()
+                if pending.key is not key:
+                    kept.append(pending)
+                elif rows + len(pending.inputs) <= self.max_batch_size:
+                    taken.append(pending)
+                    rows += len(pending.inputs)
+                else:
+                    kept.append(pending)
+                    break
+            kept.extend(self._queue)
+            self._queue = kept
+            self._queued_rows -= rows
+            return taken, rows
+
+    def _run(self):
+        while True:
+            taken, rows = self._collect()
+
+            if len(taken) == 1:
+                inputs = taken[0].inputs
+            else:
+                inputs = np.concatenate([pending.inputs for pending in taken], axis=0)
+
+            try:
+                outputs = self.predict_fn(inputs, taken[0].key)
+            except Exception as e:
+                for pending in taken:
+                    pending.future.set_exception(e)
+                continue
+
+            offset = 0
+            for pending in taken:
+                count = len(pending.inputs)
+                if isinstance(outputs, tuple):
+                    pending.future.set_result(tuple(part[offset:offset + count] for part in outputs))
+                else:
+                    pending.future.set_result(outputs[offset:offset + count])
+                offset += count
+
+            with self._cond:
+                self._histogram[rows] = self._histogram.get(rows, 0) + 1
+                self._batches += 1
+                self._rows += rows
+
+    def stats(self):
+        """Batching configuration and achieved batch-size histogram"""
+        with self._cond:
+            return {
+                'max_batch_size': self.max_batch_size,
+                'max_wait_ms': self.max_wait * 1000.0,
+                'max_queue': self.max_queue,
+                'queued': self._queued_rows,
+                'rejected': self._rejected,
+                'expired': self._expired,
+                'batches': self._batches,
+                'images': self._rows,
+                'mean_batch_size': round(self._rows / self._batches, 2) if self._batches else 0.0,
+                'batch_size_histogram': {
+                    str(size): count for size, count in sorted(self._histogram.items())
+                },
+            }
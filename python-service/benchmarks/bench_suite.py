@@ -0,0 +1,435 @@
+"""
+Benchmark suite for the preprocessing and inference hot paths.
+
+Stages:
+    preprocess   preprocess_image without and with contrast enhancement (the
+                 latter is what preprocess_image_pneumonia runs), on synthetic
+                 X-rays of several sizes and modes (L, RGB, 16-bit PNG)
+    inference    predict() of the malaria and pneumonia backends per batch size
+    endpoint     /malaria-predict and /pneumonia-predict end to end through the
+                 Flask test client; batch sizes above 1 use the /batch endpoints
+    tta          the single-image endpoints with test-time augmentation at
+                 several view counts, plus the added latency per extra view
+    explain      the single-image endpoints with Grad-CAM explanations: the
+                 forward pass without and with activation capture, explain=1
+                 with the prediction, explain=1 after the prediction (served
+                 from the activation cache) and with the activation cache
+                 off, plus the latency each adds to the plain request
+
+Runs offline. Model files missing from lib/model are replaced by stand-in
+models with the same input and output shapes (MobileNetV2, random weights),
+so timings are only comparable between runs that used the same models; the
+JSON records which ones were used. Every case runs in a fresh subprocess so
+its peak RSS is not polluted by earlier cases.
+
+For every case the suite reports throughput (images/s), p50/p95/p99 latency
+and peak RSS, writes the results as JSON and, given a baseline file from an
+earlier run, flags cases that got slower.
+
+Usage:
+    python benchmarks/bench_suite.py --output results.json
+    python benchmarks/bench_suite.py --stages preprocess --sizes 512 2048
+    python benchmarks/bench_suite.py --baseline baseline.json --fail-on-regression
+"""
+
+import argparse
+import datetime
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+SERVICE_DIR = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, SERVICE_DIR)
+sys.path.insert(0, BENCH_DIR)
+os.environ.setdefault('TF_CPP_MIN_LOG_LEVEL', '2')
+
+import numpy as np
+
+from preprocess_bench import _peak_rss_kb, encode, synthetic_xray
+
+STAGES = ('preprocess', 'inference', 'endpoint', 'tta', 'explain')
+MODES = {'L': 'PNG', 'RGB': 'PNG', 'I;16': 'PNG'}
+MODELS = ('malaria', 'pneumonia')
+
+REAL_MODEL_DIR = os.path.join(os.path.dirname(SERVICE_DIR), 'lib', 'model')
+# Stand-in per model: file name the service looks for, output units, activation
+STANDIN_MODELS = {
+    'malaria': ('malaria_model1.h5', 1, 'sigmoid'),
+    'pneumonia': ('best_model.h5', 2, 'softmax'),
+}
+PNEUMONIA_FALLBACK_FILES = ('pneumonia_model.h5',)
+
+# Explain stage variants: (environment, form fields). 'plain' predicts without
+# capturing activations; 'cached' and 'recompute' request the explanation
+# after the prediction, with and without the activation cache.
+EXPLAIN_VARIANTS = {
+    'plain': ({'EXPLAIN': '0'}, {}),
+    'capture': ({'EXPLAIN': '1'}, {}),
+    'explain': ({'EXPLAIN': '1'}, {'explain': '1'}),
+    'cached': ({'EXPLAIN': '1', 'PREDICTION_CACHE_SIZE': '1024'}, {'explain': '1'}),
+    'recompute': ({'EXPLAIN': '1', 'PREDICTION_CACHE_SIZE': '1024', 'EXPLAIN_CACHE_SIZE': '0'}, {'explain': '1'}),
+}
+
+# A case is a regression when its p50 latency grows by more than this
+DEFAULT_TOLERANCE = 0.15
+
+
+def prepare_model_dir(directory):
+    """Fill directory with the real model files where present, stand-ins otherwise.
+
+    Returns {model: 'real' | 'standin'}.
+    """
+    sources = {}
+    for model_name, (filename, units, activation) in STANDIN_MODELS.items():
+        candidates = (filename,) + (PNEUMONIA_FALLBACK_FILES if model_name == 'pneumonia' else ())
+        real = next(
+            (os.path.join(REAL_MODEL_DIR, name) for name in candidates
+             if os.path.exists(os.path.join(REAL_MODEL_DIR, name))),
+            None,
+        )
+        target = os.path.join(directory, filename)
+        if real:
+            os.symlink(real, target)
+            sources[model_name] = 'real'
+            continue
+
+        import tensorflow as tf
+
+        print(f"No {model_name} model in {REAL_MODEL_DIR}; building a stand-in")
+        tf.keras.utils.set_random_seed(0)
+        model = tf.keras.applications.MobileNetV2(
+            input_shape=(224, 224, 3), weights=None, classes=units, classifier_activation=activation,
+        )
+        model.save(target)
+        sources[model_name] = 'standin'
+    return sources
+
+
+def summarize(latencies, items_per_call):
+    """Throughput and latency percentiles for a list of per-call seconds"""
+    latencies_ms = np.asarray(latencies) * 1000
+    return {
+        'calls': len(latencies),
+        'items_per_call': items_per_call,
+        'throughput_per_s': round(items_per_call * len(latencies) / (latencies_ms.sum() / 1000), 2),
+        'latency_ms': {
+            'mean': round(float(latencies_ms.mean()), 3),
+            'p50': round(float(np.percentile(latencies_ms, 50)), 3),
+            'p95': round(float(np.percentile(latencies_ms, 95)), 3),
+            'p99': round(float(np.percentile(latencies_ms, 99)), 3),
+        },
+    }
+
+
+def _time_calls(fn, repeats, warmup):
+    for _ in range(warmup):
+        fn()
+    latencies = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        fn()
+        latencies.append(time.perf_counter() - start)
+    return latencies
+
+
+# Stage runners (called inside the per-case subprocess)
+
+def _run_preprocess(case, repeats, warmup):
+    from preprocessing import preprocess_image
+
+    with open(case['path'], 'rb') as f:
+        image_bytes = f.read()
+    latencies = _time_calls(
+        lambda: preprocess_image(image_bytes, enhance_contrast=case['enhance_contrast']), repeats, warmup,
+    )
+    return summarize(latencies, 1)
+
+
+def _run_inference(case, repeats, warmup):
+    from model_loading import load_malaria_model, load_pneumonia_model
+
+    loader = load_malaria_model if case['model'] == 'malaria' else load_pneumonia_model
+    backend = loader(case['model_dir'], backend=case['backend'], quantization=case['quantization']).model
+    batch = np.random.default_rng(0).random((case['batch_size'], 224, 224, 3), dtype=np.float32)
+    latencies = _time_calls(lambda: backend.predict(batch), repeats, warmup)
+    return summarize(latencies, case['batch_size'])
+
+
+def _run_endpoint(case, repeats, warmup):
+    import io
+
+    # Measure the full path, not prediction cache hits
+    os.environ['MODEL_DIR'] = case['model_dir']
+    os.environ['PREDICTION_CACHE_SIZE'] = '0'
+    os.environ['INFERENCE_WARMUP'] = '0'
+    os.environ[f"{case['model'].upper()}_BACKEND"] = case['backend']
+    os.environ[f"{case['model'].upper()}_QUANTIZATION"] = case['quantization']
+    os.environ.update(case.get('env', {}))
+    import app as service
+
+    service.model_registry.wait()
+    client = service.app.test_client()
+    with open(case['path'], 'rb') as f:
+        image_bytes = f.read()
+
+    batch_size = case['batch_size']
+    url = f"/{case['model']}-predict" + ('/batch' if batch_size > 1 else '')
+    field = 'images' if batch_size > 1 else 'image'
+    extra_fields = {'tta': str(case['views'])} if 'views' in case else {}
+    extra_fields.update(case.get('fields', {}))
+
+    def call():
+        data = {field: [(io.BytesIO(image_bytes), f'image{i}.png') for i in range(batch_size)], **extra_fields}
+        response = client.post(url, data=data, content_type='multipart/form-data')
+        if response.status_code != 200:
+            raise RuntimeError(f'{url} returned {response.status_code}: {response.get_data(as_text=True)[:200]}')
+
+    latencies = _time_calls(call, repeats, warmup)
+    return summarize(latencies, batch_size)
+
+
+_RUNNERS = {
+    'preprocess': _run_preprocess,
+    'inference': _run_inference,
+    'endpoint': _run_endpoint,
+    'tta': _run_endpoint,
+    'explain': _run_endpoint,
+}
+
+
+def run_case_in_process(case, repeats, warmup):
+    """Entry point of the per-case subprocess; prints the result as JSON"""
+    result = _RUNNERS[case['stage']](case, repeats, warmup)
+    result['peak_rss_mb'] = round(_peak_rss_kb() / 1024, 1)
+    print(json.dumps(result))
+
+
+def run_case(case, repeats, warmup):
+    completed = subprocess.run(
+        [sys.executable, __file__, '--run-case', json.dumps(case), '--repeats', str(repeats), '--warmup', str(warmup)],
+        capture_output=True, text=True,
+    )
+    if completed.returncode != 0:
+        raise RuntimeError(f"{case['key']} failed:\n{completed.stderr[-2000:]}")
+    return json.loads(completed.stdout.strip().splitlines()[-1])
+
+
+def build_cases(args, image_dir, model_dir):
+    """The cases selected on the command line, in run order"""
+    cases = []
+    if 'preprocess' in args.stages:
+        for size in args.sizes:
+            for mode in args.modes:
+                path = os.path.join(image_dir, f"xray_{size}_{mode.replace(';', '')}.png")
+                with open(path, 'wb') as f:
+                    f.write(encode(synthetic_xray(size, mode), MODES[mode]))
+                for enhance_contrast in (False, True):
+                    variant = 'contrast' if enhance_contrast else 'plain'
+                    cases.append({
+                        'key': f'preprocess/{mode}/{size}/{variant}',
+                        'stage': 'preprocess',
+                        'path': path,
+                        'enhance_contrast': enhance_contrast,
+                    })
+
+    models = {'backend': args.backend, 'quantization': args.quantization, 'model_dir': model_dir}
+    if 'inference' in args.stages:
+        for model_name in MODELS:
+            for batch_size in args.batch_sizes:
+                cases.append({
+                    'key': f'inference/{model_name}/{args.backend}/b{batch_size}',
+                    'stage': 'inference',
+                    'model': model_name,
+                    'batch_size': batch_size,
+                    **models,
+                })
+
+    if {'endpoint', 'tta', 'explain'} & set(args.stages):
+        path = os.path.join(image_dir, f'endpoint_{args.endpoint_size}.png')
+        with open(path, 'wb') as f:
+            f.write(encode(synthetic_xray(args.endpoint_size), 'PNG'))
+    if 'endpoint' in args.stages:
+        for model_name in MODELS:
+            for batch_size in args.endpoint_batch_sizes:
+                cases.append({
+                    'key': f'endpoint/{model_name}/{args.backend}/b{batch_size}',
+                    'stage': 'endpoint',
+                    'model': model_name,
+                    'batch_size': batch_size,
+                    'path': path,
+                    **models,
+                })
+
+    if 'tta' in args.stages:
+        for model_name in MODELS:
+            for views in args.tta_views:
+                cases.append({
+                    'key': f'tta/{model_name}/{args.backend}/v{views}',
+                    'stage': 'tta',
+                    'model': model_name,
+                    'batch_size': 1,
+                    'views': views,
+                    'path': path,
+                    **models,
+                })
+
+    if 'explain' in args.stages:
+        for model_name in MODELS:
+            for variant, (env, fields) in EXPLAIN_VARIANTS.items():
+                cases.append({
+                    'key': f'explain/{model_name}/{args.backend}/{variant}',
+                    'stage': 'explain',
+                    'model': model_name,
+                    'batch_size': 1,
+                    'env': env,
+                    'fields': fields,
+                    'path': path,
+                    **models,
+                })
+    return cases
+
+
+def tta_cost_per_view(results):
+    """Least-squares slope of p50 latency (ms) over the view count, per model"""
+    costs = {}
+    for model_name in MODELS:
+        points = [
+            (int(key.rsplit('/v', 1)[1]), result['latency_ms']['p50'])
+            for key, result in results.items() if key.startswith(f'tta/{model_name}/')
+        ]
+        if len(points) >= 2:
+            views, latencies = np.array(points, dtype=np.float64).T
+            costs[model_name] = round(float(np.polyfit(views, latencies, 1)[0]), 3)
+    return costs
+
+
+def explain_added_latency(results):
+    """p50 latency (ms) each explain variant adds to the plain request, per model"""
+    added = {}
+    for model_name in MODELS:
+        prefix = f'explain/{model_name}/'
+        variants = {key.rsplit('/', 1)[1]: result['latency_ms']['p50']
+                    for key, result in results.items() if key.startswith(prefix)}
+        if 'plain' in variants:
+            added[model_name] = {
+                variant: round(latency - variants['plain'], 3)
+                for variant, latency in variants.items() if variant != 'plain'
+            }
+    return added
+
+
+def compare(results, baseline, tolerance):
+    """Print per-case changes against a baseline; returns the regressed keys"""
+    models = results['meta'].get('models')
+    if models and baseline['meta'].get('models') not in (None, {}, models):
+        print(f"Warning: baseline used models {baseline['meta'].get('models')}, "
+              f"this run {models}; inference timings are not comparable")
+
+    print(f"\nAgainst baseline (regression: p50 more than {tolerance * 100:.0f}% slower)")
+    print(f"{'case':<42}{'p50 ms':>10}{'base ms':>10}{'change':>9}{'thr change':>12}")
+    regressions = []
+    for key, result in results['results'].items():
+        base = baseline['results'].get(key)
+        if base is None:
+            print(f"{key:<42}{result['latency_ms']['p50']:>10.2f}{'-':>10}{'new':>9}")
+            continue
+        change = result['latency_ms']['p50'] / base['latency_ms']['p50'] - 1
+        throughput_change = result['throughput_per_s'] / base['throughput_per_s'] - 1
+        regressed = change > tolerance
+        if regressed:
+            regressions.append(key)
+        print(f"{key:<42}{result['latency_ms']['p50']:>10.2f}{base['latency_ms']['p50']:>10.2f}"
+              f"{change * 100:>+8.1f}%{throughput_change * 100:>+11.1f}%{'  REGRESSION' if regressed else ''}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--stages', nargs='+', choices=STAGES, default=list(STAGES))
+    parser.add_argument('--sizes', type=int, nargs='+', default=[512, 1024, 2048], help='preprocess image sizes')
+    parser.add_argument('--modes', nargs='+', choices=sorted(MODES), default=list(MODES), help='preprocess image modes')
+    parser.add_argument('--batch-sizes', type=int, nargs='+', default=[1, 8, 32], help='inference batch sizes')
+    parser.add_argument('--endpoint-batch-sizes', type=int, nargs='+', default=[1, 8])
+    parser.add_argument('--endpoint-size', type=int, default=1024, help='size of the image uploaded to the endpoints')
+    parser.add_argument('--tta-views', type=int, nargs='+', default=[1, 2, 4, 8], help='test-time augmentation view counts')
+    parser.add_argument('--backend', choices=('keras', 'tflite', 'onnx'), default='keras')
+    parser.add_argument('--quantization', default='none')
+    parser.add_argument('--repeats', type=int, default=20, help='timed calls per case')
+    parser.add_argument('--warmup', type=int, default=2, help='untimed calls per case')
+    parser.add_argument('--output', help='write the results to this JSON file')
+    parser.add_argument('--baseline', help='JSON results of an earlier run to compare against')
+    parser.add_argument('--tolerance', type=float, default=DEFAULT_TOLERANCE)
+    parser.add_argument('--fail-on-regression', action='store_true', help='exit with status 1 on a regression')
+    parser.add_argument('--run-case', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run_case:
+        run_case_in_process(json.loads(args.run_case), args.repeats, args.warmup)
+        return 0
+
+    with tempfile.TemporaryDirectory() as tmp:
+        image_dir = os.path.join(tmp, 'images')
+        model_dir = os.path.join(tmp, 'models')
+        os.makedirs(image_dir)
+        os.makedirs(model_dir)
+        needs_models = bool({'inference', 'endpoint', 'tta', 'explain'} & set(args.stages))
+        model_sources = prepare_model_dir(model_dir) if needs_models else {}
+
+        results = {
+            'meta': {
+                'timestamp': datetime.datetime.now(datetime.timezone.utc).isoformat(timespec='seconds'),
+                'python': platform.python_version(),
+                'platform': platform.platform(),
+                'cpu_count': os.cpu_count(),
+                'models': model_sources,
+                'backend': args.backend,
+                'quantization': args.quantization,
+                'repeats': args.repeats,
+            },
+            'results': {},
+        }
+
+        print(f"\n{'case':<42}{'img/s':>10}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'peak MB':>10}")
+        for case in build_cases(args, image_dir, model_dir):
+            result = run_case(case, args.repeats, args.warmup)
+            results['results'][case['key']] = result
+            latency = result['latency_ms']
+            print(f"{case['key']:<42}{result['throughput_per_s']:>10.1f}{latency['p50']:>10.2f}"
+                  f"{latency['p95']:>10.2f}{latency['p99']:>10.2f}{result['peak_rss_mb']:>10.1f}")
+
+    tta_costs = tta_cost_per_view(results['results'])
+    if tta_costs:
+        results['tta_ms_per_view'] = tta_costs
+        print('\nTest-time augmentation cost (p50 ms per extra view): '
+              + ', '.join(f'{model_name} {cost:.2f}' for model_name, cost in tta_costs.items()))
+
+    explain_costs = explain_added_latency(results['results'])
+    if explain_costs:
+        results['explain_added_ms'] = explain_costs
+        print('\nExplanation cost (p50 ms added to the plain request):')
+        for model_name, costs in explain_costs.items():
+            print(f'  {model_name}: ' + ', '.join(f'{variant} {cost:+.2f}' for variant, cost in costs.items()))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+        print(f"\nResults written to {args.output}")
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.tolerance)
+        if regressions:
+            print(f"\n{len(regressions)} case(s) regressed")
+            if args.fail_on_regression:
+                return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
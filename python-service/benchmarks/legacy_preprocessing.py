@@ -0,0 +1,60 @@
+"""
+Reference copy of the original preprocess_image implementation.
+
+Kept only so the benchmarks can check the optimized pipeline in
+preprocessing.py for numerical equivalence and measure the speed-up.
+"""
+
+import io
+
+import numpy as np
+from PIL import Image
+
+IMAGE_SIZE = 224
+
+
+def preprocess_image(image_bytes, enhance_contrast=True):
+    """Preprocess image for model input with enhanced handling for medical images"""
+    # Open image
+    img = Image.open(io.BytesIO(image_bytes))
+    
+    # Convert to grayscale first (medical X-rays are typically grayscale)
+    if img.mode != 'L':
+        img = img.convert('L')
+    
+    # Convert to numpy array for processing
+    img_array = np.array(img, dtype=np.float32)
+    
+    # Apply contrast enhancement for medical images
+    if enhance_contrast:
+        # Histogram equalization-like enhancement
+        # Normalize to 0-255 range first
+        if img_array.max() > 255:
+            img_array = (img_array - img_array.min()) / (img_array.max() - img_array.min() + 1e-7) * 255
+        
+        # Apply CLAHE-like contrast enhancement (simplified)
+        # Clip extreme values (remove outliers)
+        p2, p98 = np.percentile(img_array, (2, 98))
+        img_array = np.clip(img_array, p2, p98)
+        
+        # Normalize to 0-255
+        if img_array.max() > img_array.min():
+            img_array = (img_array - img_array.min()) / (img_array.max() - img_array.min()) * 255
+    
+    # Convert back to PIL Image for resizing
+    img = Image.fromarray(img_array.astype(np.uint8))
+    
+    # Resize to model input size with high-quality resampling
+    img = img.resize((IMAGE_SIZE, IMAGE_SIZE), Image.Resampling.LANCZOS)
+    
+    # Convert to RGB (3 channels) as model expects
+    if img.mode != 'RGB':
+        img = img.convert('RGB')
+    
+    # Convert to numpy array and normalize to [0, 1]
+    img_array = np.array(img, dtype=np.float32) / 255.0
+    
+    # Add batch dimension
+    img_array = np.expand_dims(img_array, axis=0)
+    
+    return img_array
@@ -0,0 +1,155 @@
+"""
+Reference copy of the original result builders.
+
+Kept only so benchmarks/serialization_bench.py can check the interned payloads
+in results.py for equivalence and measure the speed-up.
+"""
+
+import logging
+
+from service_logging import SERVICE_LOGGER
+
+logger = logging.getLogger(SERVICE_LOGGER)
+
+
+def build_malaria_result(prediction):
+    """Turn one row of malaria model output into the API response payload"""
+    # Model outputs single value (sigmoid), so: 
+    # - prediction[0] is probability of parasitized
+    # - 1 - prediction[0] is probability of uninfected
+    parasitized_prob = float(prediction[0])
+    uninfected_prob = float(1 - prediction[0])
+    
+    # Determine result
+    is_parasitized = parasitized_prob >= 0.5
+    confidence = parasitized_prob if is_parasitized else uninfected_prob
+    
+    return {
+        'prediction': 'Parasitized' if is_parasitized else 'Uninfected',
+        'confidence': confidence,
+        'message': (
+            'Malaria parasites have been detected in the blood smear image. Please consult with a healthcare professional immediately for proper diagnosis and treatment.'
+            if is_parasitized
+            else 'No malaria parasites detected in the blood smear image. The sample appears to be uninfected. However, this is a preliminary analysis and should be confirmed by a medical professional.'
+        ),
+        'recommendations': (
+            [
+                'Seek immediate medical attention',
+                'Get a proper laboratory test for confirmation',
+                "Follow your healthcare provider's treatment recommendations",
+                'Monitor symptoms closely',
+                'Complete the full course of treatment if prescribed',
+            ]
+            if is_parasitized
+            else [
+                'Continue regular health monitoring',
+                'If experiencing symptoms, consult a healthcare professional',
+                'Consider preventive measures if in a malaria-endemic area',
+                'Keep the image for medical records',
+            ]
+        ),
+    }
+
+
+def build_pneumonia_result(prediction):
+    """Turn one row of pneumonia model output into the API response payload"""
+    # Model output format may vary - adjust based on your model
+    # Common formats:
+    # 1. Binary classification: [prob_normal, prob_pneumonia] (most common for pneumonia models)
+    # 2. Single sigmoid value (pneumonia probability)
+    # 3. [prob_pneumonia, prob_normal] (less common)
+    
+    # Try to handle different output formats
+    if len(prediction.shape) == 0:
+        # Single value (sigmoid output) - value is pneumonia probability
+        pneumonia_prob = float(prediction)
+        normal_prob = 1.0 - pneumonia_prob
+        output_format = 'single'
+    elif len(prediction) == 2:
+        # Two-class output - Most pneumonia models use [normal_prob, pneumonia_prob]
+        # Check which index has higher value to determine format
+        if prediction[0] > prediction[1]:
+            # Likely [pneumonia_prob, normal_prob] - first is pneumonia
+            pneumonia_prob = float(prediction[0])
+            normal_prob = float(prediction[1])
+            output_format = '[pneumonia, normal]'
+        else:
+            # Likely [normal_prob, pneumonia_prob] - second is pneumonia (most common)
+            normal_prob = float(prediction[0])
+            pneumonia_prob = float(prediction[1])
+            output_format = '[normal, pneumonia]'
+    else:
+        # Default: use first value as pneumonia probability
+        pneumonia_prob = float(prediction[0])
+        normal_prob = 1.0 - pneumonia_prob
+        output_format = 'default'
+    
+    # Determine result with adaptive threshold
+    # Use slightly higher threshold to reduce false positives on hospital images
+    # This helps when model was trained on Kaggle data but tested on hospital images
+    threshold = 0.6  # Increased from 0.5 to reduce false positives
+    has_pneumonia = pneumonia_prob >= threshold
+    confidence = pneumonia_prob if has_pneumonia else normal_prob
+    
+    # Also check if probabilities are too close (uncertain prediction)
+    prob_diff = abs(pneumonia_prob - normal_prob)
+    is_uncertain = prob_diff < 0.1  # Less than 10% difference = uncertain
+    
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug('Pneumonia prediction', extra={'fields': {
+            'raw_prediction': prediction.tolist(),
+            'output_format': output_format,
+            'pneumonia_prob': round(pneumonia_prob, 4),
+            'normal_prob': round(normal_prob, 4),
+            'has_pneumonia': has_pneumonia,
+            'confidence': round(confidence, 4),
+            'prob_diff': round(prob_diff, 4),
+            'uncertain': is_uncertain,
+        }})
+    
+    # If uncertain, be more conservative
+    if is_uncertain and has_pneumonia:
+        # If uncertain but leaning towards pneumonia, mark as uncertain
+        prediction_label = 'Uncertain - Recommend professional review'
+        confidence = 0.5  # Neutral confidence for uncertain cases
+    else:
+        prediction_label = 'Pneumonia' if has_pneumonia else 'Normal'
+    
+    return {
+        'prediction': prediction_label,
+        'confidence': round(confidence, 4),
+        'probabilities': {
+            'pneumonia': round(pneumonia_prob, 4),
+            'normal': round(normal_prob, 4)
+        },
+        'uncertain': is_uncertain,
+        'threshold_used': threshold,
+        'raw_prediction': prediction.tolist() if hasattr(prediction, 'tolist') else str(prediction),
+        'message': (
+            'Uncertain prediction - The model probabilities are very close, indicating low confidence. Please have this X-ray reviewed by a licensed radiologist for accurate diagnosis.'
+            if is_uncertain
+            else (
+                'Pneumonia-like patterns have been detected in the chest X-ray image. Please consult with a healthcare professional immediately for proper diagnosis and treatment. This is a preliminary analysis and should be confirmed by a licensed radiologist.'
+                if has_pneumonia
+                else 'No obvious signs of pneumonia detected in the chest X-ray image. The X-ray appears normal. However, this is a preliminary analysis and should be confirmed by a licensed radiologist for accurate diagnosis.'
+            )
+        ),
+        'recommendations': (
+            [
+                'Seek immediate medical attention',
+                'Consult with a pulmonologist or radiologist for proper diagnosis',
+                "Follow your healthcare provider's treatment recommendations",
+                'Monitor respiratory symptoms closely',
+                'Complete the full course of treatment if prescribed',
+                'Get follow-up X-rays as recommended by your doctor',
+            ]
+            if has_pneumonia
+            else [
+                'Continue regular health monitoring',
+                'If experiencing respiratory symptoms, consult a healthcare professional',
+                'Consider preventive measures during flu season',
+                'Keep the X-ray for medical records',
+                'Follow up with your healthcare provider if symptoms persist',
+            ]
+        ),
+    }
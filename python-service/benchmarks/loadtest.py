@@ -0,0 +1,194 @@
+"""
+Load test for the prediction endpoints.
+
+Runs a closed loop of concurrent clients that each upload an image over a
+keep-alive connection and wait for the answer, then reports throughput and
+latency percentiles. Pass several --url values to compare servers, e.g. the
+development server against the production ASGI setup:
+
+    python app.py                                          # port 5007
+    SERVER_BIND=0.0.0.0:5008 gunicorn -c gunicorn.conf.py asgi:app
+
+    python benchmarks/loadtest.py \\
+        --url http://localhost:5007/malaria-predict \\
+        --url http://localhost:5008/malaria-predict \\
+        --concurrency 16 --duration 30
+
+Without --image a synthetic 1024x1024 X-ray PNG is uploaded. Every upload is
+identical, so disable the prediction cache on the server
+(PREDICTION_CACHE_SIZE=0) to measure inference rather than cache hits.
+"""
+
+import argparse
+import http.client
+import json
+import os
+import sys
+import threading
+import time
+import uuid
+from urllib.parse import urlsplit
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+sys.path.insert(0, BENCH_DIR)
+
+import numpy as np
+
+from preprocess_bench import encode, synthetic_xray
+
+
+def multipart_body(field, filename, data):
+    """multipart/form-data body with a single file field"""
+    boundary = uuid.uuid4().hex
+    body = b''.join([
+        f'--{boundary}\r\n'.encode(),
+        f'Content-Disposition: form-data; name="{field}"; filename="{filename}"\r\n'.encode(),
+        b'Content-Type: application/octet-stream\r\n\r\n',
+        data,
+        f'\r\n--{boundary}--\r\n'.encode(),
+    ])
+    return body, f'multipart/form-data; boundary={boundary}'
+
+
+class _Client(threading.Thread):
+    """One closed-loop client: send, wait for the response, repeat"""
+
+    def __init__(self, url, body, content_type, start_at, record_from, stop_at):
+        super().__init__(daemon=True)
+        self.url = urlsplit(url)
+        self.body = body
+        self.content_type = content_type
+        self.start_at = start_at
+        self.record_from = record_from
+        self.stop_at = stop_at
+        self.latencies = []
+        self.statuses = {}
+        self._connection = None
+
+    def _connect(self):
+        connection_class = http.client.HTTPSConnection if self.url.scheme == 'https' else http.client.HTTPConnection
+        self._connection = connection_class(self.url.hostname, self.url.port, timeout=120)
+
+    def _request(self):
+        if self._connection is None:
+            self._connect()
+        self._connection.request('POST', self.url.path or '/', body=self.body, headers={
+            'Content-Type': self.content_type,
+        })
+        response = self._connection.getresponse()
+        response.read()
+        if response.getheader('Connection', '').lower() == 'close':
+            self._connection.close()
+            self._connection = None
+        return response.status
+
+    def run(self):
+        while time.perf_counter() < self.start_at:
+            time.sleep(0.001)
+        while True:
+            started = time.perf_counter()
+            if started >= self.stop_at:
+                break
+            try:
+                status = self._request()
+            except (OSError, http.client.HTTPException):
+                status = 'connection error'
+                if self._connection is not None:
+                    self._connection.close()
+                self._connection = None
+            finished = time.perf_counter()
+            if started >= self.record_from:
+                self.latencies.append(finished - started)
+                self.statuses[status] = self.statuses.get(status, 0) + 1
+        if self._connection is not None:
+            self._connection.close()
+
+
+def run_load(url, body, content_type, concurrency, duration, warmup):
+    """Drive url with concurrency clients; requests during warmup are not recorded"""
+    start_at = time.perf_counter() + 0.2
+    record_from = start_at + warmup
+    stop_at = record_from + duration
+    clients = [_Client(url, body, content_type, start_at, record_from, stop_at) for _ in range(concurrency)]
+    for client in clients:
+        client.start()
+    for client in clients:
+        client.join()
+
+    latencies = np.array([latency for client in clients for latency in client.latencies]) * 1000
+    statuses = {}
+    for client in clients:
+        for status, count in client.statuses.items():
+            statuses[status] = statuses.get(status, 0) + count
+
+    ok = statuses.get(200, 0)
+    result = {
+        'url': url,
+        'concurrency': concurrency,
+        'duration_s': duration,
+        'requests': int(len(latencies)),
+        'ok': ok,
+        'errors': int(len(latencies)) - ok,
+        'statuses': {str(status): count for status, count in sorted(statuses.items(), key=str)},
+        'requests_per_s': round(ok / duration, 2),
+    }
+    if len(latencies):
+        result['latency_ms'] = {
+            'mean': round(float(latencies.mean()), 1),
+            'p50': round(float(np.percentile(latencies, 50)), 1),
+            'p90': round(float(np.percentile(latencies, 90)), 1),
+            'p99': round(float(np.percentile(latencies, 99)), 1),
+            'max': round(float(latencies.max()), 1),
+        }
+    return result
+
+
+def print_results(results):
+    print(f"\n{'URL':<45} {'req/s':>8} {'ok':>7} {'errors':>7} {'p50 ms':>8} {'p90 ms':>8} {'p99 ms':>8} {'max ms':>8}")
+    for result in results:
+        latency = result.get('latency_ms', {})
+        print(
+            f"{result['url']:<45} {result['requests_per_s']:>8.1f} {result['ok']:>7} {result['errors']:>7} "
+            f"{latency.get('p50', 0):>8.1f} {latency.get('p90', 0):>8.1f} "
+            f"{latency.get('p99', 0):>8.1f} {latency.get('max', 0):>8.1f}"
+        )
+        if result['errors']:
+            print(f"   statuses: {result['statuses']}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--url', action='append', required=True, help='endpoint to load (repeat to compare servers)')
+    parser.add_argument('--image', help='image file to upload (default: synthetic X-ray PNG)')
+    parser.add_argument('--image-size', type=int, default=1024, help='size of the synthetic image')
+    parser.add_argument('--field', default='image', help='multipart field name')
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--duration', type=float, default=20.0, help='measured seconds per URL')
+    parser.add_argument('--warmup', type=float, default=3.0, help='unmeasured seconds before each run')
+    parser.add_argument('--json', help='also write the results to this file')
+    args = parser.parse_args()
+
+    if args.image:
+        with open(args.image, 'rb') as f:
+            data = f.read()
+        filename = os.path.basename(args.image)
+    else:
+        data = encode(synthetic_xray(args.image_size), 'PNG')
+        filename = 'synthetic.png'
+    body, content_type = multipart_body(args.field, filename, data)
+    print(f"Uploading {filename} ({len(data) / 1024:.0f} KB) with {args.concurrency} concurrent clients")
+
+    results = []
+    for url in args.url:
+        print(f"Loading {url} for {args.warmup:.0f}s warmup + {args.duration:.0f}s...")
+        results.append(run_load(url, body, content_type, args.concurrency, args.duration, args.warmup))
+    print_results(results)
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,214 @@
+"""
+Equivalence check and benchmark for the preprocessing pipeline.
+
+Compares preprocessing.preprocess_image against the original implementation
+(benchmarks/legacy_preprocessing.py):
+
+1. Equivalence: with early downscaling disabled the output must be
+   bit-identical; with the default draft size it must stay within a small
+   tolerance. 16-bit images are compared with the original pipeline applied
+   to their intended 8-bit scaling (see reference_output), and a constant
+   reference fails the check.
+2. Benchmark: per-image CPU time and peak memory on synthetic X-rays up to
+   4000x4000. Each measurement runs in a fresh subprocess so peak RSS is not
+   polluted by earlier runs.
+
+Usage:
+    python benchmarks/preprocess_bench.py
+    python benchmarks/preprocess_bench.py --sizes 1024 4000 --repeats 3
+    python benchmarks/preprocess_bench.py --check-only
+"""
+
+import argparse
+import io
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+sys.path.insert(0, BENCH_DIR)
+
+import numpy as np
+from PIL import Image
+
+import legacy_preprocessing
+import preprocessing
+
+# Mean absolute difference (in [0, 1] pixel units) allowed when large images
+# are downscaled before contrast enhancement
+APPROX_MEAN_TOLERANCE = 0.01
+
+
+def synthetic_xray(size, mode='L', seed=0):
+    """A chest-X-ray-like test image: soft radial falloff, two 'lungs', rib texture and noise.
+
+    'I;16' images hold 12-bit values, as detectors store them in 16-bit files.
+    """
+    rng = np.random.default_rng(seed)
+    height, width = size, size
+    y, x = np.mgrid[0:height, 0:width].astype(np.float32)
+    y /= height
+    x /= width
+
+    image = 0.8 - 0.6 * ((x - 0.5) ** 2 + (y - 0.5) ** 2)
+    for cx in (0.32, 0.68):
+        image -= 0.35 * np.exp(-(((x - cx) / 0.13) ** 2 + ((y - 0.5) / 0.25) ** 2))
+    image += 0.04 * np.sin(y * 60 + 4 * np.abs(x - 0.5)) ** 8
+
+    # Detector noise is spatially correlated; add low-frequency mottle plus a
+    # little per-pixel noise
+    mottle = Image.fromarray(rng.normal(0, 0.03, size=(64, 64)).astype(np.float32), mode='F')
+    image += np.asarray(mottle.resize((width, height), Image.Resampling.BICUBIC))
+    image += rng.normal(0, 0.01, size=image.shape).astype(np.float32)
+    image = np.clip(image, 0, 1)
+
+    if mode == 'I;16':
+        return Image.fromarray((image * 4095).astype(np.uint16))
+    img = Image.fromarray((image * 255).astype(np.uint8))
+    return img.convert(mode) if mode != 'L' else img
+
+
+def encode(img, fmt):
+    buffer = io.BytesIO()
+    img.save(buffer, format=fmt, **({'quality': 92} if fmt == 'JPEG' else {}))
+    return buffer.getvalue()
+
+
+def reference_output(image_bytes):
+    """The original preprocess_image output an image should produce.
+
+    The original pipeline meant to scale images with values above 255 to
+    0-255, but its convert('L') clipped them first, leaving a flat plane. For
+    wide grayscale images the reference is therefore the original pipeline
+    run on the image already scaled as it intended.
+    """
+    img = Image.open(io.BytesIO(image_bytes))
+    if img.mode in ('I', 'F') or img.mode.startswith('I;16'):
+        pixels = np.asarray(img).astype(np.float32)
+        scaled = (pixels - pixels.min()) / (pixels.max() - pixels.min() + 1e-7) * 255
+        image_bytes = encode(Image.fromarray(scaled.astype(np.uint8)), 'PNG')
+    return legacy_preprocessing.preprocess_image(image_bytes)
+
+
+def equivalence_cases():
+    """(label, encoded image) fixtures of every mode and format, at several sizes"""
+    cases = [
+        (size, mode, fmt)
+        for size in (300, 1024, 2000)
+        for mode, fmt in (('L', 'PNG'), ('RGB', 'PNG'), ('I;16', 'PNG'), ('L', 'JPEG'), ('RGB', 'JPEG'))
+    ]
+    return [
+        (f'{size}x{size} {mode} {fmt}', encode(synthetic_xray(size, mode, seed), fmt))
+        for seed, (size, mode, fmt) in enumerate(cases)
+    ]
+
+
+def compare(image_bytes):
+    """(exact, max diff, mean diff, flat) of the optimized pipeline against
+    the reference; flat marks a constant reference, which would prove nothing"""
+    reference = reference_output(image_bytes)
+    exact = preprocessing.preprocess_image(image_bytes, draft_size=0)
+    is_exact = exact.shape == reference.shape and np.array_equal(exact, reference)
+    diff = np.abs(preprocessing.preprocess_image(image_bytes) - reference)
+    return is_exact, float(diff.max()), float(diff.mean()), bool(reference.min() == reference.max())
+
+
+def check_equivalence():
+    """Compare optimized and original outputs; returns True if within tolerance"""
+    ok = True
+    print('Equivalence against the original preprocess_image')
+    print(f"{'image':<22}{'exact (no draft)':>18}{'max diff':>12}{'mean diff':>12}")
+    for label, image_bytes in equivalence_cases():
+        is_exact, max_diff, mean_diff, flat = compare(image_bytes)
+        case_ok = is_exact and mean_diff <= APPROX_MEAN_TOLERANCE and not flat
+        ok = ok and case_ok
+        print(f"{label:<22}{'yes' if is_exact else 'NO':>18}{max_diff:>12.4f}{mean_diff:>12.4f}"
+              f"{'' if case_ok else '  FLAT REFERENCE' if flat else '  FAIL'}")
+    return ok
+
+
+def _peak_rss_kb():
+    """High-water RSS of this process in KiB.
+
+    Prefers VmHWM, which starts fresh at exec; ru_maxrss can carry over the
+    parent's high-water mark.
+    """
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def measure(impl, path, repeats):
+    """Run inside a subprocess: CPU time per image and peak RSS growth"""
+    with open(path, 'rb') as f:
+        image_bytes = f.read()
+    fn = legacy_preprocessing.preprocess_image if impl == 'legacy' else preprocessing.preprocess_image
+
+    baseline_rss = _peak_rss_kb()
+    start = time.process_time()
+    for _ in range(repeats):
+        fn(image_bytes)
+    cpu = (time.process_time() - start) / repeats
+    peak_rss = _peak_rss_kb()
+
+    print(json.dumps({
+        'cpu_ms_per_image': cpu * 1000,
+        'peak_rss_growth_mb': (peak_rss - baseline_rss) / 1024,
+    }))
+
+
+def run_benchmark(sizes, repeats):
+    print(f'\nPer-image CPU time and peak memory ({repeats} repeats)')
+    print(f"{'image':<18}{'impl':<11}{'cpu ms':>10}{'peak MB':>10}{'speed-up':>10}")
+    with tempfile.TemporaryDirectory() as tmp:
+        for size in sizes:
+            for fmt in ('PNG', 'JPEG'):
+                path = os.path.join(tmp, f'xray_{size}.{fmt.lower()}')
+                with open(path, 'wb') as f:
+                    f.write(encode(synthetic_xray(size), fmt))
+
+                results = {}
+                for impl in ('legacy', 'optimized'):
+                    output = subprocess.run(
+                        [sys.executable, __file__, '--measure', impl, path, '--repeats', str(repeats)],
+                        check=True, capture_output=True, text=True,
+                    ).stdout
+                    results[impl] = json.loads(output.strip().splitlines()[-1])
+
+                speedup = results['legacy']['cpu_ms_per_image'] / max(results['optimized']['cpu_ms_per_image'], 1e-9)
+                for impl, result in results.items():
+                    print(f"{f'{size}x{size} {fmt}':<18}{impl:<11}"
+                          f"{result['cpu_ms_per_image']:>10.1f}{result['peak_rss_growth_mb']:>10.1f}"
+                          f"{(f'{speedup:.1f}x' if impl == 'optimized' else ''):>10}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1024, 2048, 4000])
+    parser.add_argument('--repeats', type=int, default=3)
+    parser.add_argument('--check-only', action='store_true', help='only run the equivalence check')
+    parser.add_argument('--measure', nargs=2, metavar=('IMPL', 'PATH'), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.measure:
+        measure(args.measure[0], args.measure[1], args.repeats)
+        return 0
+
+    ok = check_equivalence()
+    if not args.check_only:
+        run_benchmark(args.sizes, args.repeats)
+    return 0 if ok else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
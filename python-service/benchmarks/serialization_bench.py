@@ -0,0 +1,150 @@
+"""
+Equivalence check and microbenchmark for result building and serialization.
+
+Compares what the prediction handlers do after inference, per response:
+
+    legacy    the original builders (benchmarks/legacy_results.py), which
+              rebuild the messages and recommendation lists every time,
+              serialized by Flask's standard-library jsonify
+    interned  results.py with the shared static payloads, built for the
+              whole batch at once, serialized by
+              json_provider.OrjsonProvider (orjson when installed)
+    compact   results.py compact results (codes and probabilities only),
+              serialized by OrjsonProvider
+
+1. Equivalence: the legacy and interned responses must decode to the same
+   JSON for random model outputs of every outcome, both as single responses
+   (results.py decides a batch of one with Python scalars) and as one batch
+   response (decided with arrays). The legacy pneumonia
+   builder guessed the column order from each row; the rows are [normal,
+   pneumonia] softmax outputs it guesses right, so only the fixed
+   interpretation differs.
+2. Benchmark: microseconds per single-image response and per 64-image batch
+   response, for both models.
+
+Usage:
+    python benchmarks/serialization_bench.py
+    python benchmarks/serialization_bench.py --repeats 20000
+    python benchmarks/serialization_bench.py --check-only
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+sys.path.insert(0, BENCH_DIR)
+
+import numpy as np
+from flask import Flask
+from flask.json.provider import DefaultJSONProvider
+
+import legacy_results
+import results
+from json_provider import orjson, OrjsonProvider
+
+def _per_row(build_result_fn):
+    """A legacy single-row builder as a batch builder"""
+    return lambda rows: [build_result_fn(row) for row in rows]
+
+
+BUILDERS = {
+    'malaria': (_per_row(legacy_results.build_malaria_result), results.malaria_results),
+    'pneumonia': (_per_row(legacy_results.build_pneumonia_result), results.pneumonia_results),
+}
+
+
+def make_app(provider):
+    app = Flask(__name__)
+    app.json = provider(app)
+    return app
+
+
+def model_outputs(model_name, count, seed=0):
+    """Random float32 output rows: sigmoid rows for malaria, [normal,
+    pneumonia] softmax rows for pneumonia, at least half pneumonia
+    (including near-ties, the uncertain outcome)"""
+    rng = np.random.default_rng(seed)
+    if model_name == 'malaria':
+        return rng.random((count, 1), dtype=np.float32)
+    pneumonia = 0.5 + rng.random(count, dtype=np.float32) / 2
+    pneumonia[::4] = 0.51
+    return np.stack([1 - pneumonia, pneumonia], axis=1)
+
+
+def respond(app, build_results_fn, rows, batch):
+    """The handler's post-inference work: build and serialize one response"""
+    if not batch:
+        return app.json.response(build_results_fn(rows[:1])[0]).get_data()
+    items = [
+        {'index': index, 'filename': f'{index}.png', **result}
+        for index, result in enumerate(build_results_fn(rows))
+    ]
+    return app.json.response({'results': items, 'count': len(items), 'succeeded': len(items), 'failed': 0}).get_data()
+
+
+def check_equivalence():
+    """Legacy and interned responses decode to the same JSON, for single
+    responses (the scalar path) and for a batch response (the array path)"""
+    legacy_app, fast_app = make_app(DefaultJSONProvider), make_app(OrjsonProvider)
+    ok = True
+    for model_name, (legacy_build, build) in BUILDERS.items():
+        mismatches = 0
+        rows = model_outputs(model_name, 2000)
+        for row in rows:
+            legacy = json.loads(respond(legacy_app, legacy_build, row[np.newaxis], batch=False))
+            interned = json.loads(respond(fast_app, build, row[np.newaxis], batch=False))
+            mismatches += legacy != interned
+        legacy = json.loads(respond(legacy_app, legacy_build, rows, batch=True))['results']
+        interned = json.loads(respond(fast_app, build, rows, batch=True))['results']
+        mismatches += sum(a != b for a, b in zip(legacy, interned))
+        ok = ok and not mismatches
+        print(f"{model_name:<12}{'identical' if not mismatches else f'{mismatches} MISMATCHES'}")
+    return ok
+
+
+def time_per_call(fn, repeats):
+    fn()
+    start = time.perf_counter()
+    for _ in range(repeats):
+        fn()
+    return (time.perf_counter() - start) / repeats * 1e6
+
+
+def run_benchmark(repeats):
+    legacy_app, fast_app = make_app(DefaultJSONProvider), make_app(OrjsonProvider)
+    print(f"\nMicroseconds per response ({repeats} repeats, encoder: {'orjson' if orjson else 'json (orjson not installed)'})")
+    print(f"{'case':<24}{'legacy':>10}{'interned':>10}{'compact':>10}{'speed-up':>10}")
+    for model_name, (legacy_build, build) in BUILDERS.items():
+        for batch, count in ((False, 1), (True, 64)):
+            rows = model_outputs(model_name, count)
+            cases = {
+                'legacy': (legacy_app, legacy_build),
+                'interned': (fast_app, build),
+                'compact': (fast_app, lambda batch_rows: build(batch_rows, compact=True)),
+            }
+            timings = {}
+            for name, (app, build_fn) in cases.items():
+                timings[name] = time_per_call(lambda: respond(app, build_fn, rows, batch), max(1, repeats // count))
+            label = f"{model_name} {'batch of ' + str(count) if batch else 'single'}"
+            print(f"{label:<24}{timings['legacy']:>10.1f}{timings['interned']:>10.1f}{timings['compact']:>10.1f}"
+                  f"{timings['legacy'] / timings['interned']:>9.1f}x")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--repeats', type=int, default=5000, help='responses timed per case (divided by the batch size for batches)')
+    parser.add_argument('--check-only', action='store_true', help='only run the equivalence check')
+    args = parser.parse_args()
+
+    ok = check_equivalence()
+    if not args.check_only:
+        run_benchmark(args.repeats)
+    return 0 if ok else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
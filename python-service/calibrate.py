@@ -0,0 +1,241 @@
+"""
+Fit the output calibration of a model on a labelled validation folder.
+
+Runs every image through the model in batches, with the service's
+preprocessing, then fits:
+
+- the output layout: the column holding the positive class, for models with
+  more than one output column (the service never guesses it per request)
+- temperature scaling: one temperature for the binary logit, minimizing the
+  negative log-likelihood of the labels
+- the operating threshold on the calibrated probability: Youden's J
+  (sensitivity + specificity - 1), or the highest threshold reaching
+  --target-sensitivity
+- the pneumonia uncertain band, --uncertain-margin either side of the threshold
+
+and writes <model file stem>.calibration.json next to the model file the
+service loads. The service reads it when it loads the model; a running
+service picks a new file up like a new model version.
+
+Usage:
+    python calibrate.py --model pneumonia --data-dir ../data/chest_xray/val
+    python calibrate.py --model pneumonia --data-dir ../data/val --target-sensitivity 0.95
+    python calibrate.py --model malaria --data-dir ../data/cell_images --limit 2000 --dry-run
+
+The data folder has one subfolder per class, named as in the public datasets
+(NORMAL / PNEUMONIA, Uninfected / Parasitized; case does not matter), or as
+given with --positive and --negative. Images are found recursively.
+"""
+
+import argparse
+import datetime
+import json
+import os
+import sys
+import time
+
+import numpy as np
+
+from backends import BACKENDS, QUANTIZATIONS, optimized_model_path
+from calibration import (
+    DEFAULT_CALIBRATIONS, Calibration, binary_logits, calibration_path, expected_calibration_error,
+    fit_positive_index, fit_temperature, fit_threshold, negative_log_likelihood, operating_point, roc_auc,
+)
+from export_optimized import list_images
+from model_conversion import find_artifact
+from model_loading import find_tfjs_model, load_malaria_model, load_pneumonia_model, model_candidates
+from preprocess_pool import PreprocessPool
+from score_archive import iter_batches
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+MODEL_DIR = os.environ.get('MODEL_DIR', os.path.join(BASE_DIR, 'lib', 'model'))
+
+MODELS = {'malaria': load_malaria_model, 'pneumonia': load_pneumonia_model}
+
+# Default class folder names per model: (positive, negative)
+CLASS_FOLDERS = {
+    'malaria': ('parasitized', 'uninfected'),
+    'pneumonia': ('pneumonia', 'normal'),
+}
+
+
+def class_folder(data_dir, name):
+    """Subfolder of data_dir named `name`, ignoring case"""
+    for entry in sorted(os.listdir(data_dir)):
+        path = os.path.join(data_dir, entry)
+        if entry.lower() == name.lower() and os.path.isdir(path):
+            return path
+    raise SystemExit(f"No '{name}' folder in {data_dir} (found: {', '.join(sorted(os.listdir(data_dir)))})")
+
+
+def labelled_images(args):
+    """(path, path) inputs and their 0/1 labels, positives first"""
+    inputs, labels = [], []
+    for label, name in ((1, args.positive), (0, args.negative)):
+        paths = list_images(class_folder(args.data_dir, name), args.limit)
+        inputs.extend((path, path) for path in paths)
+        labels.extend([label] * len(paths))
+    return inputs, np.array(labels, dtype=np.int64)
+
+
+def collect_outputs(loaded, inputs, labels, args):
+    """Model output rows and labels of every readable image"""
+    pool = PreprocessPool(args.pool, args.workers)
+    rows, kept = [], []
+    offset = 0
+    started = time.perf_counter()
+    try:
+        # Both endpoints preprocess with contrast enhancement
+        for batch in iter_batches(inputs, pool, args.batch_size, args.prefetch, enhance_contrast=True):
+            arrays = []
+            for index, (path, future) in enumerate(batch):
+                try:
+                    arrays.append(future.result())
+                    kept.append(offset + index)
+                except Exception as e:
+                    print(f"   Skipping {path}: {str(e)}")
+            if arrays:
+                rows.append(np.asarray(loaded.model.predict(np.concatenate(arrays, axis=0))))
+            offset += len(batch)
+            if offset // 1000 > (offset - len(batch)) // 1000:
+                print(f"   {offset:,}/{len(inputs):,} images")
+    finally:
+        pool.shutdown()
+    print(f"   {offset:,}/{len(inputs):,} images in {time.perf_counter() - started:.1f} s")
+    if not rows:
+        raise SystemExit("No image could be read")
+    outputs = np.concatenate(rows, axis=0)
+    return outputs.reshape(len(outputs), -1), labels[kept]
+
+
+def source_model_path(loaded, args):
+    """The model file the loaded backend came from; its calibration file
+    sits next to it, whatever backend serves it"""
+    candidates, _ = model_candidates(args.model_dir, args.model)
+    tfjs_dir = find_tfjs_model(args.model_dir) if args.model == 'pneumonia' else None
+    if tfjs_dir:
+        candidates = candidates + [find_artifact(tfjs_dir, args.model_dir)]
+    for source in filter(None, candidates):
+        if loaded.path == source or (
+            args.backend != 'keras' and loaded.path == optimized_model_path(source, args.backend, args.quantization)
+        ):
+            return source
+    return loaded.path
+
+
+def fit(outputs, labels, args):
+    """(Calibration, report) fitted on the output rows"""
+    if args.positive_index is not None:
+        positive_index = args.positive_index
+    else:
+        positive_index = fit_positive_index(outputs, labels)
+    uncalibrated = Calibration(positive_index=positive_index)
+    logits = binary_logits(*uncalibrated.probabilities(outputs))
+    raw = uncalibrated.probabilities(outputs)[0].astype(np.float64)
+
+    temperature = 1.0 if args.no_temperature else fit_temperature(logits, labels)
+    calibrated = Calibration(positive_index=positive_index, temperature=temperature).probabilities(outputs)[0]
+    threshold = fit_threshold(calibrated, labels, args.target_sensitivity)
+    band = None
+    if args.model == 'pneumonia':
+        band = (max(0.0, threshold - args.uncertain_margin), min(1.0, threshold + args.uncertain_margin))
+
+    current = DEFAULT_CALIBRATIONS[args.model]
+    report = {
+        'samples': {'positive': int(labels.sum()), 'negative': int(len(labels) - labels.sum())},
+        'data_dir': os.path.abspath(args.data_dir),
+        'auc': roc_auc(raw, labels),
+        'nll': {'before': negative_log_likelihood(raw, labels), 'after': negative_log_likelihood(calibrated, labels)},
+        'ece': {'before': expected_calibration_error(raw, labels), 'after': expected_calibration_error(calibrated, labels)},
+        'target_sensitivity': args.target_sensitivity,
+        'operating_point': operating_point(calibrated, labels, threshold),
+        'default_operating_point': {
+            'threshold': current.threshold,
+            **operating_point(current.probabilities(outputs)[0], labels, current.threshold),
+        },
+        'fitted_at': datetime.datetime.now(datetime.timezone.utc).isoformat(timespec='seconds'),
+    }
+    return Calibration(positive_index, temperature, threshold, band), report
+
+
+def print_report(calibration, report, outputs):
+    def rate(value):
+        return f'{value:.3f}' if value is not None else 'n/a'
+
+    samples = report['samples']
+    print(f"\nSamples: {samples['positive']:,} positive, {samples['negative']:,} negative")
+    if outputs.shape[1] > 1:
+        print(f"Output layout: {outputs.shape[1]} columns, positive class in column {calibration.positive_index}")
+    print(f"AUC: {rate(report['auc'])}")
+    print(f"Temperature: {calibration.temperature:.3f}")
+    print(f"NLL: {report['nll']['before']:.4f} -> {report['nll']['after']:.4f}")
+    print(f"ECE: {report['ece']['before']:.4f} -> {report['ece']['after']:.4f}")
+    print(f"{'':<22}{'threshold':>10}{'sensitivity':>13}{'specificity':>13}{'accuracy':>10}")
+    for label, threshold, point in (
+        ('default', report['default_operating_point']['threshold'], report['default_operating_point']),
+        ('calibrated', calibration.threshold, report['operating_point']),
+    ):
+        print(f"{label:<22}{threshold:>10.3f}{rate(point['sensitivity']):>13}{rate(point['specificity']):>13}"
+              f"{rate(point['accuracy']):>10}")
+    if calibration.uncertain_band is not None:
+        print(f"Uncertain band: {calibration.uncertain_band[0]:.3f} - {calibration.uncertain_band[1]:.3f}")
+
+
+def write_calibration(path, model_name, source, calibration, report):
+    data = {'model': model_name, 'model_file': os.path.basename(source), **calibration.to_dict(), 'fitted': report}
+    with open(path + '.tmp', 'w') as f:
+        json.dump(data, f, indent=2)
+    os.replace(path + '.tmp', path)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--model', choices=sorted(MODELS), required=True)
+    parser.add_argument('--data-dir', required=True, help='validation folder with one subfolder per class')
+    parser.add_argument('--positive', help='positive class folder (default: pneumonia / parasitized)')
+    parser.add_argument('--negative', help='negative class folder (default: normal / uninfected)')
+    parser.add_argument('--limit', type=int, help='images per class (default: all)')
+    parser.add_argument('--target-sensitivity', type=float,
+                        help='pick the highest threshold reaching this sensitivity (default: maximize Youden J)')
+    parser.add_argument('--uncertain-margin', type=float, default=0.05,
+                        help='pneumonia uncertain band half-width around the threshold')
+    parser.add_argument('--positive-index', type=int, help='positive class column (default: fitted)')
+    parser.add_argument('--no-temperature', action='store_true', help='fit the threshold only (temperature 1)')
+    parser.add_argument('--output', help='calibration file (default: next to the model file)')
+    parser.add_argument('--dry-run', action='store_true', help='print the fit without writing it')
+    parser.add_argument('--model-dir', default=MODEL_DIR)
+    parser.add_argument('--backend', choices=BACKENDS, default='keras')
+    parser.add_argument('--quantization', choices=QUANTIZATIONS, default='none')
+    parser.add_argument('--batch-size', type=int, default=64)
+    parser.add_argument('--prefetch', type=int, default=4, help='batches read and preprocessed ahead of inference')
+    parser.add_argument('--pool', choices=PreprocessPool.MODES, default='thread', help='preprocessing pool mode')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help='preprocessing threads/processes')
+    args = parser.parse_args()
+    positive, negative = CLASS_FOLDERS[args.model]
+    args.positive = args.positive or positive
+    args.negative = args.negative or negative
+
+    inputs, labels = labelled_images(args)
+    if labels.min(initial=1) == 1 or labels.max(initial=0) == 0:
+        print("Error: calibration needs images of both classes")
+        return 1
+    print(f"{len(inputs):,} labelled images to run through the {args.model} model")
+
+    loaded = MODELS[args.model](args.model_dir, args.backend, args.quantization)
+    outputs, labels = collect_outputs(loaded, inputs, labels, args)
+    calibration, report = fit(outputs, labels, args)
+    print_report(calibration, report, outputs)
+
+    if args.dry_run:
+        return 0
+    source = source_model_path(loaded, args)
+    output = args.output or calibration_path(source)
+    write_calibration(output, args.model, source, calibration, report)
+    print(f"\n✓ Wrote {output}")
+    if args.output and args.output != calibration_path(source):
+        print(f"   The service reads {calibration_path(source)}")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
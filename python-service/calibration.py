@@ -0,0 +1,290 @@
+"""
+Output calibration: how a model's output rows become a positive-class
+probability and a decision.
+
+A Calibration fixes, per model:
+
+- the output layout: which column holds the positive class (pneumonia,
+  parasitized) when the model has more than one. It is set once rather than
+  guessed from each row.
+- a temperature for temperature scaling. The binary logit is divided by it,
+  so probabilities match observed frequencies. 1 leaves outputs unchanged.
+- the operating threshold on the calibrated probability.
+- the uncertain band: calibrated probabilities inside it are flagged for
+  review (pneumonia results report it).
+
+calibrate.py fits these on a labelled validation folder and writes
+<model file stem>.calibration.json next to the model file. The model loaders
+read it once per model version. Without a file the built-in defaults keep the
+service's historical behaviour: sigmoid or [normal, pneumonia] outputs, 0.5
+(malaria) and 0.6 (pneumonia) thresholds, and the 0.45-0.55 pneumonia
+uncertain band.
+
+Everything here works on whole batches of output rows, except
+decide_row(), the scalar form results.py uses for single-image responses.
+"""
+
+import json
+import logging
+import os
+
+import numpy as np
+
+from service_logging import SERVICE_LOGGER
+
+logger = logging.getLogger(SERVICE_LOGGER)
+
+CALIBRATION_SUFFIX = '.calibration.json'
+
+# Probabilities are clipped this far from 0 and 1 before taking logits
+_EPSILON = 1e-7
+
+
+class Calibration:
+    """Output interpretation and decision rule of one model version"""
+    __slots__ = ('positive_index', 'temperature', 'threshold', 'uncertain_band', 'path')
+
+    def __init__(self, positive_index=None, temperature=1.0, threshold=0.5, uncertain_band=None, path=None):
+        # None: column 1 of two-column ([negative, positive]) outputs, else 0
+        self.positive_index = positive_index
+        self.temperature = float(temperature)
+        self.threshold = float(threshold)
+        self.uncertain_band = tuple(uncertain_band) if uncertain_band is not None else None
+        # The calibration file, or None for the built-in defaults
+        self.path = path
+
+    @classmethod
+    def from_dict(cls, data, path=None):
+        return cls(
+            data.get('positive_index'), data.get('temperature', 1.0), data['threshold'],
+            data.get('uncertain_band'), path,
+        )
+
+    def to_dict(self):
+        return {
+            'positive_index': self.positive_index,
+            'temperature': self.temperature,
+            'threshold': self.threshold,
+            'uncertain_band': list(self.uncertain_band) if self.uncertain_band is not None else None,
+        }
+
+    def summary(self):
+        """The calibration block of /health"""
+        return {'calibrated': self.path is not None, **self.to_dict()}
+
+    def probabilities(self, outputs):
+        """(positive, negative) probability arrays for (n, k) output rows.
+
+        Two-column rows keep both columns as they are when the temperature
+        is 1; otherwise the negative probability is 1 - positive. Float
+        outputs keep their dtype unless temperature scaling applies.
+        """
+        outputs = np.asarray(outputs)
+        if not np.issubdtype(outputs.dtype, np.floating):
+            outputs = outputs.astype(np.float64)
+        if outputs.ndim == 1:
+            outputs = outputs[:, np.newaxis]
+        index = self.positive_index
+        if index is None:
+            index = 1 if outputs.shape[1] == 2 else 0
+        positive = outputs[:, index]
+        negative = outputs[:, 1 - index] if outputs.shape[1] == 2 else 1.0 - positive
+        if self.temperature == 1.0:
+            return positive, negative
+        logits = binary_logits(positive.astype(np.float64), negative.astype(np.float64))
+        positive = sigmoid(logits / self.temperature)
+        return positive, 1.0 - positive
+
+    def decide(self, outputs):
+        """(positive, negative, is_positive, is_uncertain) arrays for (n, k) output rows"""
+        positive, negative = self.probabilities(outputs)
+        # Compared in float64, as Python floats compare: against a float32
+        # array numpy would round the threshold to float32 instead
+        compared = positive.astype(np.float64, copy=False)
+        is_positive = compared >= self.threshold
+        if self.uncertain_band is None:
+            is_uncertain = np.zeros(len(positive), dtype=bool)
+        else:
+            low, high = self.uncertain_band
+            is_uncertain = (compared > low) & (compared < high)
+        return positive, negative, is_positive, is_uncertain
+
+    def decide_row(self, row):
+        """decide() for one output row, as Python scalars.
+
+        The single-image fast path: same values as decide() on a batch of
+        one, without the array setup that dominates at n=1.
+        """
+        row = np.asarray(row).reshape(-1)
+        if not np.issubdtype(row.dtype, np.floating):
+            row = row.astype(np.float64)
+        two_columns = len(row) == 2
+        index = self.positive_index
+        if index is None:
+            index = 1 if two_columns else 0
+        positive = row[index]
+        # In the row's dtype, as decide() computes it
+        negative = row[1 - index] if two_columns else row.dtype.type(1) - positive
+        if self.temperature == 1.0:
+            positive, negative = float(positive), float(negative)
+        else:
+            # numpy's scalar log/exp match its array loops bit for bit (math's
+            # do not), so results equal the batch path's
+            positive = np.float64(min(max(float(positive), _EPSILON), 1.0 - _EPSILON))
+            negative = np.float64(min(max(float(negative), _EPSILON), 1.0 - _EPSILON))
+            positive = float(sigmoid((np.log(positive) - np.log(negative)) / self.temperature))
+            negative = 1.0 - positive
+        is_positive = positive >= self.threshold
+        if self.uncertain_band is None:
+            is_uncertain = False
+        else:
+            low, high = self.uncertain_band
+            is_uncertain = low < positive < high
+        return positive, negative, is_positive, is_uncertain
+
+
+# Built-in interpretation of each model's outputs when it has no calibration
+# file: pneumonia two-class models output [normal, pneumonia]
+DEFAULT_CALIBRATIONS = {
+    'malaria': Calibration(positive_index=0, threshold=0.5),
+    'pneumonia': Calibration(threshold=0.6, uncertain_band=(0.45, 0.55)),
+}
+
+
+def calibration_path(model_path):
+    """Calibration file of a model file (the source .h5 for exported backends)"""
+    return os.path.splitext(model_path)[0] + CALIBRATION_SUFFIX
+
+
+def load_calibration(model_path, model_name):
+    """The calibration stored next to a model file, or the model's defaults"""
+    path = calibration_path(model_path)
+    if not os.path.exists(path):
+        return DEFAULT_CALIBRATIONS[model_name]
+    with open(path) as f:
+        data = json.load(f)
+    if data.get('model', model_name) != model_name:
+        raise ValueError(f"{path} calibrates the {data['model']} model, not {model_name}")
+    calibration = Calibration.from_dict(data, path)
+    logger.info(
+        f"Using calibration {path} (temperature {calibration.temperature:.3f}, threshold {calibration.threshold:.3f})",
+        extra={'fields': {'model': model_name, 'calibration': path, **calibration.to_dict()}},
+    )
+    return calibration
+
+
+# Fitting (calibrate.py)
+
+def sigmoid(x):
+    return 1.0 / (1.0 + np.exp(-x))
+
+
+def binary_logits(positive, negative):
+    positive = np.clip(positive, _EPSILON, 1.0 - _EPSILON)
+    negative = np.clip(negative, _EPSILON, 1.0 - _EPSILON)
+    return np.log(positive) - np.log(negative)
+
+
+def negative_log_likelihood(probabilities, labels):
+    p = np.clip(probabilities, _EPSILON, 1.0 - _EPSILON)
+    return float(-np.mean(labels * np.log(p) + (1 - labels) * np.log(1 - p)))
+
+
+def expected_calibration_error(probabilities, labels, bins=10):
+    """Mean |accuracy - confidence| over equal-width probability bins, weighted by bin size"""
+    which = np.minimum((probabilities * bins).astype(int), bins - 1)
+    error = 0.0
+    for b in range(bins):
+        in_bin = which == b
+        if in_bin.any():
+            error += in_bin.mean() * abs(labels[in_bin].mean() - probabilities[in_bin].mean())
+    return float(error)
+
+
+def roc_auc(scores, labels):
+    """Area under the ROC curve (rank statistic; ties count half)"""
+    positives, negatives = labels == 1, labels == 0
+    if not positives.any() or not negatives.any():
+        return None
+    order = np.argsort(scores, kind='mergesort')
+    ranks = np.empty(len(scores))
+    sorted_scores = scores[order]
+    # Average ranks over ties
+    _, starts, counts = np.unique(sorted_scores, return_index=True, return_counts=True)
+    for start, count in zip(starts, counts):
+        ranks[order[start:start + count]] = start + (count + 1) / 2.0
+    n_pos, n_neg = positives.sum(), negatives.sum()
+    return float((ranks[positives].sum() - n_pos * (n_pos + 1) / 2.0) / (n_pos * n_neg))
+
+
+def fit_positive_index(outputs, labels):
+    """Column of (n, k) outputs that best separates the labels (highest AUC)"""
+    outputs = np.asarray(outputs, dtype=np.float64)
+    if outputs.ndim == 1 or outputs.shape[1] == 1:
+        return None
+    aucs = [roc_auc(outputs[:, index], labels) or 0.0 for index in range(outputs.shape[1])]
+    return int(np.argmax(aucs))
+
+
+def fit_temperature(logits, labels, low=0.05, high=20.0, iterations=60):
+    """Temperature minimizing the negative log-likelihood of the labels.
+
+    Golden-section search over log(temperature); the likelihood is unimodal
+    in it for a fixed set of logits.
+    """
+    def loss(log_t):
+        return negative_log_likelihood(sigmoid(logits / np.exp(log_t)), labels)
+
+    a, b = np.log(low), np.log(high)
+    ratio = (np.sqrt(5.0) - 1.0) / 2.0
+    c, d = b - ratio * (b - a), a + ratio * (b - a)
+    loss_c, loss_d = loss(c), loss(d)
+    for _ in range(iterations):
+        if loss_c < loss_d:
+            b, d, loss_d = d, c, loss_c
+            c = b - ratio * (b - a)
+            loss_c = loss(c)
+        else:
+            a, c, loss_c = c, d, loss_d
+            d = a + ratio * (b - a)
+            loss_d = loss(d)
+    return float(np.exp((a + b) / 2.0))
+
+
+def operating_point(probabilities, labels, threshold):
+    """Sensitivity, specificity and accuracy of thresholding at `threshold`"""
+    predicted = probabilities >= threshold
+    positives, negatives = labels == 1, labels == 0
+    return {
+        'sensitivity': float(predicted[positives].mean()) if positives.any() else None,
+        'specificity': float((~predicted[negatives]).mean()) if negatives.any() else None,
+        'accuracy': float((predicted == positives).mean()),
+    }
+
+
+def fit_threshold(probabilities, labels, target_sensitivity=None):
+    """Operating threshold on calibrated probabilities.
+
+    With target_sensitivity, the highest threshold that still reaches it
+    (fewest false positives at the required recall); otherwise the one
+    maximizing Youden's J (sensitivity + specificity - 1).
+    """
+    positives, negatives = labels == 1, labels == 0
+    n_pos, n_neg = max(int(positives.sum()), 1), max(int(negatives.sum()), 1)
+    # Candidate thresholds: every distinct probability, highest first; at
+    # each, the cumulative counts of positives and negatives at or above it
+    order = np.argsort(-probabilities, kind='mergesort')
+    sorted_probabilities = probabilities[order]
+    true_positives = np.cumsum(positives[order])
+    false_positives = np.cumsum(negatives[order])
+    last = np.r_[sorted_probabilities[1:] != sorted_probabilities[:-1], True]
+    candidates = sorted_probabilities[last]
+    sensitivity = true_positives[last] / n_pos
+    specificity = 1.0 - false_positives[last] / n_neg
+
+    if target_sensitivity is not None:
+        reached = np.flatnonzero(sensitivity >= target_sensitivity)
+        index = reached[0] if len(reached) else len(candidates) - 1
+    else:
+        index = int(np.argmax(sensitivity + specificity - 1.0))
+    return float(candidates[index])
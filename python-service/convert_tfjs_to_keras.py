@@ -1,75 +1,110 @@
 """
-Script to convert TensorFlow.js model to Keras .h5 format
-This converts the pneumonia detection model from TFJS to Keras format for use in Python service.
+Script to convert the TensorFlow.js pneumonia model for the Python service.
+
+Run it as a deployment step: the service loads the verified artifacts this
+writes and never converts at startup. Formats already converted from the
+same TFJS source (by content hash) are skipped, so running it on every
+deploy is cheap. See model_conversion.py for the details.
 
 Usage:
     python convert_tfjs_to_keras.py
+    python convert_tfjs_to_keras.py --formats h5 savedmodel tflite --samples-dir ../samples/xrays
+    python convert_tfjs_to_keras.py --check      # exit 1 unless the current source is converted
+
+Artifacts go to lib/model/.cache/<folder>-<hash>/ (model.h5, saved_model/,
+model.tflite, model.keras) with a conversion.json manifest. Every artifact is
+checked against the model rebuilt from TFJS on the parity samples (images
+from --samples-dir, else seeded random inputs) and discarded if its outputs
+differ by more than --tolerance.
 
 Requirements:
-    pip install tensorflowjs tensorflow
+    pip install tensorflow
 """
 
+import argparse
 import os
 import sys
+import time
+
+from model_conversion import (
+    ARTIFACT_NAMES, DEFAULT_FORMATS, FORMATS, PARITY_TOLERANCE, ConversionError, convert, find_artifact,
+    random_samples,
+)
+from model_loading import PNEUMONIA_TFJS_DIRS, find_tfjs_model
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+MODEL_DIR = os.path.join(BASE_DIR, 'lib', 'model')
+
+
+def parity_samples(args):
+    """Parity inputs: preprocessed sample images, else seeded random inputs"""
+    if args.samples_dir:
+        from export_optimized import load_samples
+
+        _, samples = load_samples(args.samples_dir, args.samples)
+        if len(samples):
+            return samples
+        print(f"Warning: no usable images in {args.samples_dir}, using random inputs")
+    return random_samples(args.samples)
+
 
-def convert_tfjs_to_keras():
-    """Convert TFJS model to Keras .h5 format"""
-    
-    # Paths - try both possible folder names
-    tfjs_model_dirs = [
-        '../lib/model/tfjspnumoniaDetectorModel',  # Actual folder name
-        '../lib/model/pnumoniaDetectorModel',     # Alternative name
-    ]
-    
-    tfjs_model_dir = None
-    for path in tfjs_model_dirs:
-        if os.path.exists(path):
-            tfjs_model_dir = path
-            break
-    
-    output_path = '../lib/model/pneumonia_model.h5'
-    
-    if not tfjs_model_dir:
-        print(f"Error: TFJS model directory not found.")
-        print(f"Tried: {tfjs_model_dirs[0]}")
-        print(f"Tried: {tfjs_model_dirs[1]}")
-        return False
-    
-    if not os.path.exists(os.path.join(tfjs_model_dir, 'model.json')):
-        print(f"Error: model.json not found in {tfjs_model_dir}")
-        return False
-    
+def check(tfjs_dir, model_dir, formats):
+    """Exit status 0 if every format is converted from the current source"""
+    missing = [fmt for fmt in formats if find_artifact(tfjs_dir, model_dir, fmt) is None]
+    if missing:
+        print(f"Not converted from the current {tfjs_dir}: {', '.join(missing)}")
+        return 1
+    print(f"✓ {tfjs_dir} is converted ({', '.join(formats)})")
+    return 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--model-dir', default=MODEL_DIR, help='model directory (default: lib/model)')
+    parser.add_argument('--source', help='TFJS model directory (default: the pneumonia export in --model-dir)')
+    parser.add_argument('--formats', choices=FORMATS, nargs='+', default=list(DEFAULT_FORMATS))
+    parser.add_argument('--samples-dir', help='folder of sample images for the parity check')
+    parser.add_argument('--samples', type=int, default=16, help='number of parity samples')
+    parser.add_argument('--tolerance', type=float, default=PARITY_TOLERANCE,
+                        help='largest allowed output difference against the TFJS model')
+    parser.add_argument('--no-verify', action='store_true', help='skip the parity check')
+    parser.add_argument('--force', action='store_true', help='convert again even if artifacts exist')
+    parser.add_argument('--positional-weights', action='store_true',
+                        help='assign weights whose names do not match the model in order (logged per weight)')
+    parser.add_argument('--check', action='store_true', help='only report whether the source is converted')
+    args = parser.parse_args()
+
+    tfjs_dir = args.source or find_tfjs_model(args.model_dir)
+    if not tfjs_dir or not os.path.exists(os.path.join(tfjs_dir, 'model.json')):
+        print("Error: TFJS model not found.")
+        for name in PNEUMONIA_TFJS_DIRS:
+            print(f"Tried: {os.path.join(args.model_dir, name)}")
+        return 1
+
+    if args.check:
+        return check(tfjs_dir, args.model_dir, args.formats)
+
+    print(f"Found TFJS model at: {tfjs_dir}")
+    print(f"Converting to {', '.join(args.formats)}...")
+    samples = None if args.no_verify else parity_samples(args)
+    started = time.perf_counter()
     try:
-        import tensorflowjs as tfjs
-        import tensorflow as tf
-        
-        print(f"Found TFJS model at: {tfjs_model_dir}")
-        print(f"Converting TFJS model to Keras format...")
-        print("This may take a few minutes...")
-        
-        # Convert TFJS model to Keras
-        model = tfjs.converters.load_keras_model(tfjs_model_dir)
-        
-        # Save as .h5
-        print(f"Saving Keras model to {output_path}...")
-        model.save(output_path)
-        
-        print(f"✓ Successfully converted model to {output_path}")
-        print("You can now use the pneumonia model in the Python service!")
-        
-        return True
-        
-    except ImportError:
-        print("Error: tensorflowjs not installed")
-        print("Install it with: pip install tensorflowjs")
-        return False
-    except Exception as e:
-        print(f"Error during conversion: {str(e)}")
-        import traceback
-        traceback.print_exc()
-        return False
+        directory, manifest = convert(
+            tfjs_dir, args.model_dir, args.formats, samples, args.tolerance, force=args.force,
+            positional_weights=args.positional_weights,
+        )
+    except ConversionError as e:
+        print(f"❌ Conversion failed: {e}")
+        return 1
 
-if __name__ == '__main__':
-    success = convert_tfjs_to_keras()
-    sys.exit(0 if success else 1)
+    for fmt in args.formats:
+        entry = manifest['formats'][fmt]
+        parity = entry['parity']
+        check_note = f"max |Δ| {parity['max_abs_delta']:.2e} on {parity['samples']} samples" if parity else 'not verified'
+        print(f"  {fmt:<11} {os.path.join(directory, ARTIFACT_NAMES[fmt])} ({entry['bytes'] / 1e6:.1f} MB, {check_note})")
+    print(f"✓ Done in {time.perf_counter() - started:.1f}s; the service picks the artifacts up on its next load")
+    return 0
 
+
+if __name__ == '__main__':
+    sys.exit(main())
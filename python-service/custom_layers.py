@@ -0,0 +1,52 @@
+"""
+Custom Keras layers needed to deserialize the saved models.
+
+Shared by the Flask service and the offline conversion/export tools so every
+loader registers the same custom objects.
+"""
+
+from tensorflow import keras
+from tensorflow.keras import layers
+
+# Define custom LayerScale layer for ConvNeXt models
+# Simplified implementation that matches what the saved model expects
+class LayerScale(layers.Layer):
+    """
+    LayerScale layer as used in ConvNeXt models.
+    Scales input by a learnable parameter (gamma) per feature dimension.
+    """
+    def __init__(self, init_values=1e-6, projection_dim=None, **kwargs):
+        super().__init__(**kwargs)
+        self.init_values = float(init_values) if init_values is not None else 1e-6
+        self.projection_dim = projection_dim
+        
+    def build(self, input_shape):
+        # Determine gamma shape: use projection_dim if provided, else use input shape
+        if self.projection_dim is not None:
+            gamma_shape = (self.projection_dim,)
+        else:
+            gamma_shape = (input_shape[-1],)
+        
+        self.gamma = self.add_weight(
+            name='gamma',
+            shape=gamma_shape,
+            initializer=keras.initializers.Constant(self.init_values),
+            trainable=True,
+            dtype=self.dtype
+        )
+        super().build(input_shape)
+    
+    def call(self, inputs, **kwargs):
+        return inputs * self.gamma
+    
+    def get_config(self):
+        config = super().get_config()
+        config['init_values'] = self.init_values
+        if self.projection_dim is not None:
+            config['projection_dim'] = self.projection_dim
+        return config
+
+# Register custom objects for model loading
+custom_objects = {
+    'LayerScale': LayerScale
+}
@@ -0,0 +1,256 @@
+"""
+Grad-CAM explanations for the Keras models.
+
+A Grad-CAM heatmap shows which regions of the image drove a prediction: the
+feature maps of the last convolutional layer, weighted by the gradient of
+the predicted class score with respect to each map.
+
+GradCam splits a model at that layer into a backbone (image -> feature maps)
+and a head (feature maps -> output); the layer must separate the two, so in a
+residual network it is the output of the last block. With explanations enabled, the
+KerasBackend forward pass returns the feature maps along with the outputs,
+so the prediction's own forward pass produces the activations. The
+Explainer caches them by the upload's cache key. A heatmap then only runs
+the head and its gradient, a compiled tf.function over the cached
+activations, and the backbone is not run again.
+
+render_overlay() and the Explainer do not import TensorFlow; a GradCam is
+only built inside the process that loads the Keras model.
+"""
+
+import base64
+import io
+
+import numpy as np
+from PIL import Image
+
+from backends import IMAGE_SHAPE
+
+# Layer types Grad-CAM prefers as its target; a nested model (e.g. a
+# keras.applications backbone) counts as one
+_CONV_LAYER_TYPES = ('Conv', 'Functional', 'Sequential', 'Model')
+
+# Largest heatmap opacity in the overlay image
+OVERLAY_MAX_ALPHA = 0.6
+
+
+class ExplanationUnavailable(RuntimeError):
+    """The model cannot be explained (not a Keras backend, or explanations are disabled)"""
+
+
+def _parents(tensor):
+    """Input tensors of the layer call that produced a symbolic tensor"""
+    operation, node_index, _ = tensor._keras_history
+    return operation._inbound_nodes[node_index].arguments.keras_tensors
+
+
+def _graph_tensors(model):
+    """The symbolic tensors the model's output is computed from, each after
+    the tensors it depends on (inputs first, the output last)"""
+    order, seen = [], set()
+    stack = [(model.outputs[0], False)]
+    while stack:
+        tensor, expanded = stack.pop()
+        if expanded:
+            order.append(tensor)
+            continue
+        if id(tensor) in seen:
+            continue
+        seen.add(id(tensor))
+        stack.append((tensor, True))
+        stack.extend((parent, False) for parent in _parents(tensor) if id(parent) not in seen)
+    return order
+
+
+def _head_tensors(model, tensor):
+    """ids of the tensors between `tensor` and the output, or None if the
+    output also depends on the inputs along a path that bypasses `tensor`
+    (a residual connection around it)"""
+    inputs = {id(t) for t in model.inputs}
+    head, stack = {id(model.outputs[0])}, [model.outputs[0]]
+    while stack:
+        current = stack.pop()
+        if id(current) in inputs:
+            return None
+        for parent in _parents(current):
+            if id(parent) not in head and parent is not tensor:
+                head.add(id(parent))
+                stack.append(parent)
+    return head
+
+
+def _find_target(model, name=None):
+    """The symbolic feature-map tensor Grad-CAM weighs (see find_target_layer)"""
+    inputs = {id(t) for t in model.inputs}
+    spatial = [t for t in _graph_tensors(model)[:-1] if id(t) not in inputs and len(t.shape) == 4]
+    if name:
+        layer = model.get_layer(name)
+        outputs = [t for t in spatial if t._keras_history.operation is layer]
+        if not outputs:
+            raise ValueError(f'{name} has no spatial (n, h, w, c) output in {model.name}')
+        if _head_tensors(model, outputs[-1]) is None:
+            raise ValueError(f'The output of {model.name} bypasses {name} (e.g. a residual connection around it)')
+        return outputs[-1]
+    if not spatial:
+        raise ValueError(f'{model.name} has no layer with spatial (n, h, w, c) output')
+    conv = [index for index, t in enumerate(spatial)
+            if any(kind in type(t._keras_history.operation).__name__ for kind in _CONV_LAYER_TYPES)]
+    start = conv[-1] if conv else len(spatial) - 1
+    # The first tensor from there on that the output depends on alone: the
+    # output of the block the layer sits in, then earlier ones
+    for tensor in spatial[start:] + spatial[:start][::-1]:
+        if _head_tensors(model, tensor) is not None:
+            return tensor
+    raise ValueError(f'No spatial layer output of {model.name} separates its inputs from its output')
+
+
+def find_target_layer(model, name=None):
+    """The layer whose feature maps Grad-CAM weighs: `name` if given, else
+    the last convolutional layer, else the last layer with a 4D output.
+
+    The output must be computable from the feature maps alone, so a layer
+    inside a residual block is replaced by the block's output (its Add).
+    """
+    return _find_target(model, name)._keras_history.operation
+
+
+class GradCam:
+    """Compiled Grad-CAM for one Keras model.
+
+    forward(images) is the capturing forward pass, (outputs, activations),
+    for the backend to compile. heatmaps(activations) returns one (h, w)
+    heatmap per row, in [0, 1], for the predicted class: the larger output of
+    a multi-class model, or for a single sigmoid output, the positive class
+    at or above 0.5 and the negative class below it.
+
+    The head re-applies the model's own layer calls after the target to the
+    activations, rather than cutting a new model out of the loaded graph,
+    which Keras refuses for Sequential models loaded from .h5 files.
+    """
+
+    def __init__(self, model, layer_name=None):
+        import tensorflow as tf
+
+        target = _find_target(model, layer_name)
+        self.layer_name = target._keras_history.operation.name
+        output = model.outputs[0]
+        self._features = tf.keras.Model(model.inputs, [output, target])
+        head = _head_tensors(model, target)
+        self._target, self._output = target, output
+        self._head_nodes = []
+        for tensor in _graph_tensors(model):
+            if id(tensor) in head:
+                operation, node_index, _ = tensor._keras_history
+                node = operation._inbound_nodes[node_index]
+                if not any(node is added for _, added in self._head_nodes):
+                    self._head_nodes.append((operation, node))
+        self.activation_shape = tuple(target.shape[1:])
+        self._heatmaps = tf.function(
+            self._grad_cam,
+            input_signature=[tf.TensorSpec((None,) + self.activation_shape, tf.float32)],
+        )
+
+    def _head(self, activations):
+        import tensorflow as tf
+
+        values = {id(self._target): activations}
+        for operation, node in self._head_nodes:
+            args, kwargs = node.arguments.fill_in(values)
+            for tensor, value in zip(node.outputs, tf.nest.flatten(operation(*args, **kwargs))):
+                values[id(tensor)] = value
+        return values[id(self._output)]
+
+    def forward(self, images):
+        return self._features(images, training=False)
+
+    def _grad_cam(self, activations):
+        import tensorflow as tf
+
+        with tf.GradientTape() as tape:
+            tape.watch(activations)
+            outputs = self._head(activations)
+            if outputs.shape[-1] == 1:
+                score = tf.where(outputs[:, 0] >= 0.5, outputs[:, 0], 1.0 - outputs[:, 0])
+            else:
+                score = tf.reduce_max(outputs, axis=-1)
+        gradients = tape.gradient(score, activations)
+        weights = tf.reduce_mean(gradients, axis=(1, 2), keepdims=True)
+        cam = tf.nn.relu(tf.reduce_sum(weights * activations, axis=-1))
+        return cam / (tf.reduce_max(cam, axis=(1, 2), keepdims=True) + 1e-8)
+
+    def heatmaps(self, activations):
+        return self._heatmaps(np.ascontiguousarray(activations, dtype=np.float32)).numpy()
+
+    def warmup(self):
+        self.heatmaps(np.zeros((1,) + self.activation_shape, dtype=np.float32))
+
+
+def _jet_colormap():
+    """256-entry blue -> cyan -> yellow -> red lookup table (uint8 RGB)"""
+    x = np.linspace(0.0, 1.0, 256)
+    channels = [np.clip(1.5 - np.abs(4.0 * x - offset), 0.0, 1.0) for offset in (3.0, 2.0, 1.0)]
+    return (np.stack(channels, axis=-1) * 255).astype(np.uint8)
+
+
+_JET = _jet_colormap()
+
+
+def render_overlay(heatmap, size=IMAGE_SHAPE[:2]):
+    """RGBA PNG of a heatmap, colored and with opacity rising with intensity.
+
+    Rendered in the 224x224 model frame; stretched over the original image
+    it lines up with it, since preprocessing resizes without cropping.
+    """
+    level = np.clip(np.asarray(heatmap, dtype=np.float32) * 255.0, 0, 255).astype(np.uint8)
+    level = np.asarray(Image.fromarray(level).resize(size[::-1], Image.BILINEAR))
+    alpha = (level.astype(np.float32) * OVERLAY_MAX_ALPHA).astype(np.uint8)
+    rgba = np.concatenate([_JET[level], alpha[..., np.newaxis]], axis=-1)
+    buffer = io.BytesIO()
+    Image.fromarray(rgba, 'RGBA').save(buffer, format='PNG')
+    return buffer.getvalue()
+
+
+def explanation_payload(heatmap, layer_name, cached):
+    """The `explanation` block of a result"""
+    return {
+        'method': 'grad-cam',
+        'layer': layer_name,
+        'activations_cached': cached,
+        'heatmap': np.round(np.asarray(heatmap, dtype=np.float64), 3).tolist(),
+        'overlay': 'data:image/png;base64,' + base64.b64encode(render_overlay(heatmap)).decode('ascii'),
+    }
+
+
+class Explainer:
+    """Grad-CAM heatmaps from the activations of recent forward passes.
+
+    Activations are cached by the upload's prediction cache key; on a miss
+    the image is run through its model's batcher again.
+    """
+
+    def __init__(self, cache, batchers):
+        self.cache = cache
+        self.batchers = batchers
+
+    def remember(self, key, activations):
+        self.cache.put(key, activations)
+
+    def heatmap(self, model, key, compute_inputs, deadline=None):
+        """(heatmap, layer name, whether the activations were cached) for one image.
+
+        compute_inputs() returns the (1, 224, 224, 3) model input; it is
+        only called when the activations are not cached.
+        """
+        gradcam = getattr(model.model, 'gradcam', None)
+        if gradcam is None:
+            raise ExplanationUnavailable(f'The {model.name} model backend does not support explanations')
+        activations = self.cache.get(key)
+        cached = activations is not None
+        if not cached:
+            _, activations = self.batchers[model.name].predict(compute_inputs(), key=model, deadline=deadline)
+            activations = activations[0]
+            self.remember(key, activations)
+        return gradcam.heatmaps(activations[np.newaxis])[0], gradcam.layer_name, cached
+
+    def stats(self):
+        return self.cache.stats()
@@ -0,0 +1,322 @@
+"""
+Script to export the Keras .h5 models to optimized inference formats.
+Produces TFLite (run with XNNPACK) and/or ONNX Runtime models, optionally
+quantized, plus an accuracy-delta report comparing the export against the
+original Keras model.
+
+Usage:
+    python export_optimized.py --model pneumonia --format tflite --quantization fp16
+    python export_optimized.py --model malaria --format tflite --quantization int8 --calibration-dir ../samples/smears \
+        --eval-dir ../samples/smears-validation
+    python export_optimized.py --model pneumonia --format onnx --quantization dynamic --eval-dir ../samples/xrays
+
+Quantization:
+    none     float32 weights and activations
+    dynamic  int8 weights, float activations (no calibration needed)
+    fp16     float16 weights (TFLite; ONNX needs onnxconverter-common)
+    int8     int8 weights and activations, calibrated on --calibration-dir and
+             evaluated on a separate --eval-dir
+
+The service picks an export up with e.g. PNEUMONIA_BACKEND=tflite and
+PNEUMONIA_QUANTIZATION=fp16.
+
+Requirements:
+    pip install tensorflow                 # TFLite
+    pip install tf2onnx onnxruntime        # ONNX
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+
+import numpy as np
+
+from backends import QUANTIZATIONS, load_backend, optimized_model_path
+from calibration import load_calibration
+from model_conversion import find_artifact
+from model_loading import find_tfjs_model, manifest_entry, model_candidates
+from preprocessing import IMAGE_SIZE, CHANNELS, preprocess_image
+from results import malaria_results, pneumonia_results
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+MODEL_DIR = os.environ.get('MODEL_DIR', os.path.join(BASE_DIR, 'lib', 'model'))
+
+# Result builders per model: the report compares the decisions the service
+# would return, not raw argmax
+RESULT_BUILDERS = {'malaria': malaria_results, 'pneumonia': pneumonia_results}
+
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.bmp', '.tif', '.tiff')
+
+
+def find_source(model_name, model_dir, input_path=None):
+    """Locate the .h5 file to export: the file the service loads (models.json
+    entry, else the default names)"""
+    if input_path:
+        return input_path if os.path.exists(input_path) else None
+    candidates, _ = model_candidates(model_dir, model_name)
+    for path in candidates:
+        if os.path.exists(path):
+            return path
+    # The TFJS conversion; its exports land next to it, where the service looks.
+    # A manifest entry pins the file, so there is no fallback.
+    if model_name != 'pneumonia' or manifest_entry(model_dir, model_name) is not None:
+        return None
+    tfjs_dir = find_tfjs_model(model_dir)
+    return find_artifact(tfjs_dir, model_dir) if tfjs_dir else None
+
+
+def list_images(folder, limit=None):
+    """Image files under folder (recursively), sorted for reproducibility"""
+    paths = []
+    for root, _, names in os.walk(folder):
+        for name in names:
+            if name.lower().endswith(IMAGE_EXTENSIONS):
+                paths.append(os.path.join(root, name))
+    paths.sort()
+    return paths[:limit] if limit else paths
+
+
+def load_samples(folder, limit):
+    """Preprocess sample images exactly as the service does"""
+    paths, arrays = [], []
+    for path in list_images(folder, limit):
+        try:
+            with open(path, 'rb') as f:
+                arrays.append(preprocess_image(f.read())[0])
+            paths.append(path)
+        except Exception as e:
+            print(f"   Skipping {path}: {str(e)}")
+    if not arrays:
+        return paths, np.zeros((0, IMAGE_SIZE, IMAGE_SIZE, CHANNELS), dtype=np.float32)
+    return paths, np.stack(arrays).astype(np.float32)
+
+
+def export_tflite(model, output_path, quantization, calibration):
+    import tensorflow as tf
+
+    converter = tf.lite.TFLiteConverter.from_keras_model(model)
+    if quantization != 'none':
+        converter.optimizations = [tf.lite.Optimize.DEFAULT]
+    if quantization == 'fp16':
+        converter.target_spec.supported_types = [tf.float16]
+    elif quantization == 'int8':
+        def representative_dataset():
+            for sample in calibration:
+                yield [sample[np.newaxis]]
+        # Input and output stay float32 so the service code is unchanged
+        converter.representative_dataset = representative_dataset
+
+    with open(output_path, 'wb') as f:
+        f.write(converter.convert())
+
+
+class _CalibrationReader:
+    """Feeds calibration samples to onnxruntime.quantization.quantize_static"""
+
+    def __init__(self, input_name, samples):
+        self._feeds = iter([{input_name: sample[np.newaxis]} for sample in samples])
+
+    def get_next(self):
+        return next(self._feeds, None)
+
+
+def export_onnx(model, output_path, quantization, calibration):
+    import tensorflow as tf
+    import tf2onnx
+
+    @tf.function(input_signature=[tf.TensorSpec((None, IMAGE_SIZE, IMAGE_SIZE, CHANNELS), tf.float32, name='input')])
+    def serve(images):
+        return model(images, training=False)
+
+    float_path = output_path if quantization == 'none' else output_path + '.float.onnx'
+    tf2onnx.convert.from_function(serve, input_signature=serve.input_signature, opset=17, output_path=float_path)
+    if quantization == 'none':
+        return
+
+    try:
+        if quantization == 'dynamic':
+            from onnxruntime.quantization import QuantType, quantize_dynamic
+            quantize_dynamic(float_path, output_path, weight_type=QuantType.QInt8)
+        elif quantization == 'int8':
+            import onnxruntime as ort
+            from onnxruntime.quantization import QuantType, quantize_static
+            input_name = ort.InferenceSession(float_path, providers=['CPUExecutionProvider']).get_inputs()[0].name
+            quantize_static(
+                float_path, output_path, _CalibrationReader(input_name, calibration),
+                activation_type=QuantType.QInt8, weight_type=QuantType.QInt8,
+            )
+        elif quantization == 'fp16':
+            import onnx
+            from onnxconverter_common import float16
+            onnx.save(float16.convert_float_to_float16(onnx.load(float_path), keep_io_types=True), output_path)
+    finally:
+        if os.path.exists(float_path):
+            os.remove(float_path)
+
+
+def _decisions(outputs, build_results_fn, calibration):
+    """The service's decision per row: the outcome and uncertain flag of its
+    result, with the model's threshold and calibration"""
+    return np.array([
+        (result['prediction'], result.get('uncertain', False))
+        for result in build_results_fn(outputs, compact=True, calibration=calibration)
+    ], dtype=object)
+
+
+def _latency_ms(predict, samples, repeats=20):
+    """Mean single-image latency"""
+    sample = samples[:1]
+    predict(sample)
+    start = time.perf_counter()
+    for _ in range(repeats):
+        predict(sample)
+    return (time.perf_counter() - start) / repeats * 1000
+
+
+def accuracy_report(keras_model, backend, samples, sample_paths, build_results_fn, calibration):
+    """Compare an exported backend against the Keras model on the same inputs.
+
+    Decisions are the service's (build_results_fn with the model's
+    calibration), so a flip is a changed outcome or uncertain flag at the
+    threshold and band the service applies.
+    """
+    reference = keras_model.predict(samples, batch_size=32, verbose=0)
+    exported = np.concatenate([backend.predict(samples[i:i + 32]) for i in range(0, len(samples), 32)])
+
+    delta = np.abs(exported.astype(np.float64) - reference.astype(np.float64))
+    reference_decisions = _decisions(reference, build_results_fn, calibration)
+    exported_decisions = _decisions(exported, build_results_fn, calibration)
+    agrees = (reference_decisions == exported_decisions).all(axis=-1)
+    flipped = np.nonzero(~agrees)[0]
+
+    return {
+        'samples': int(len(samples)),
+        'max_abs_delta': float(delta.max()),
+        'mean_abs_delta': float(delta.mean()),
+        'p99_abs_delta': float(np.percentile(delta.max(axis=-1), 99)),
+        'decision_rule': {'calibration_file': calibration.path, **calibration.to_dict()},
+        'decision_agreement': float(np.mean(agrees)),
+        'flipped_decisions': [
+            sample_paths[i] if sample_paths else int(i) for i in flipped
+        ],
+        'latency_ms': {
+            'keras': _latency_ms(lambda x: keras_model.predict(x, verbose=0), samples),
+            backend.name: _latency_ms(backend.predict, samples),
+        },
+    }
+
+
+def export_model(args):
+    source_path = find_source(args.model, args.model_dir, args.input)
+    if not source_path:
+        candidates, _ = model_candidates(args.model_dir, args.model)
+        print(f"Error: no .h5 file found for the {args.model} model")
+        print(f"Looked for: {', '.join(candidates)}")
+        return False
+
+    if args.quantization == 'int8' and not args.calibration_dir:
+        print("Error: int8 quantization needs --calibration-dir with sample images")
+        return False
+    # The quantization ranges are fitted to the calibration images, so a
+    # report measured on them would overstate the export's accuracy
+    if args.quantization == 'int8' and not args.eval_dir:
+        print("Error: int8 quantization needs --eval-dir with images not used for calibration")
+        return False
+    if args.quantization == 'int8' and os.path.realpath(args.eval_dir) == os.path.realpath(args.calibration_dir):
+        print("Error: --eval-dir must not be the --calibration-dir for int8 quantization")
+        return False
+
+    try:
+        import tensorflow as tf
+        from custom_layers import custom_objects
+
+        print(f"Loading Keras model from {source_path}...")
+        model = tf.keras.models.load_model(source_path, custom_objects=custom_objects, compile=False)
+        # Decisions are compared with the threshold and calibration the service applies
+        decision_calibration = load_calibration(source_path, args.model)
+
+        calibration = None
+        if args.calibration_dir:
+            print(f"Loading calibration samples from {args.calibration_dir}...")
+            _, calibration = load_samples(args.calibration_dir, args.calibration_samples)
+            print(f"   {len(calibration)} calibration images")
+
+        for fmt in args.format:
+            output_path = optimized_model_path(source_path, fmt, args.quantization)
+            print(f"Exporting {fmt} ({args.quantization}) to {output_path}...")
+            if fmt == 'tflite':
+                export_tflite(model, output_path, args.quantization, calibration)
+            else:
+                export_onnx(model, output_path, args.quantization, calibration)
+            print(f"✓ Exported {output_path} ({os.path.getsize(output_path) / 1e6:.1f} MB)")
+
+            # Accuracy delta against the Keras model; only int8 exports are
+            # fitted to the calibration images, so the others may be evaluated on them
+            eval_dir = args.eval_dir or args.calibration_dir
+            if eval_dir:
+                sample_paths, samples = load_samples(eval_dir, args.eval_samples)
+            else:
+                print("   No --eval-dir given; comparing on random inputs (numerical fidelity only)")
+                sample_paths = None
+                samples = np.random.default_rng(0).random(
+                    (args.eval_samples, IMAGE_SIZE, IMAGE_SIZE, CHANNELS), dtype=np.float32
+                )
+
+            backend = load_backend(fmt, output_path)
+            report = {
+                'model': args.model,
+                'source': source_path,
+                'artifact': output_path,
+                'format': fmt,
+                'quantization': args.quantization,
+                'eval_dir': eval_dir,
+                'calibration_dir': args.calibration_dir if args.quantization == 'int8' else None,
+                **accuracy_report(
+                    model, backend, samples, sample_paths, RESULT_BUILDERS[args.model], decision_calibration,
+                ),
+            }
+            report_path = output_path + '.report.json'
+            with open(report_path, 'w') as f:
+                json.dump(report, f, indent=2)
+
+            print(f"   Samples: {report['samples']}")
+            print(f"   Max |delta|: {report['max_abs_delta']:.5f}  mean |delta|: {report['mean_abs_delta']:.5f}")
+            print(f"   Decision agreement at threshold {decision_calibration.threshold:.3f}: "
+                  f"{report['decision_agreement'] * 100:.2f}% ({len(report['flipped_decisions'])} flipped)")
+            print(f"   Latency (1 image): keras {report['latency_ms']['keras']:.1f} ms, "
+                  f"{fmt} {report['latency_ms'][fmt]:.1f} ms")
+            print(f"   Report written to {report_path}")
+
+        return True
+
+    except ImportError as import_err:
+        print(f"Error: missing dependency: {str(import_err)}")
+        print("Install it with: pip install tf2onnx onnxruntime  (ONNX export)")
+        return False
+    except Exception as e:
+        print(f"Error during export: {str(e)}")
+        import traceback
+        traceback.print_exc()
+        return False
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--model', choices=sorted(RESULT_BUILDERS), required=True)
+    parser.add_argument('--input', help='source .h5 file (default: the file the service loads)')
+    parser.add_argument('--model-dir', default=MODEL_DIR, help='model directory (default: $MODEL_DIR or lib/model)')
+    parser.add_argument('--format', choices=('tflite', 'onnx'), nargs='+', default=['tflite'])
+    parser.add_argument('--quantization', choices=QUANTIZATIONS, default='none')
+    parser.add_argument('--calibration-dir', help='folder of sample images for int8 calibration')
+    parser.add_argument('--calibration-samples', type=int, default=200)
+    parser.add_argument('--eval-dir', help='folder of images for the accuracy-delta report '
+                                           '(default: calibration dir; required, and a different folder, for int8)')
+    parser.add_argument('--eval-samples', type=int, default=500)
+    return export_model(parser.parse_args())
+
+
+if __name__ == '__main__':
+    success = main()
+    sys.exit(0 if success else 1)
@@ -0,0 +1,71 @@
+"""
+Gunicorn configuration for production serving.
+
+    gunicorn -c gunicorn.conf.py asgi:app
+
+Each worker process runs a uvicorn event loop serving the ASGI adapter in
+asgi.py. The app is deliberately not preloaded: TensorFlow's runtime does not
+survive fork (a model loaded before forking hangs in the worker), so every
+worker imports the app and loads its models after it has been forked.
+
+Memory per worker therefore depends on the backend. Keras weights are held
+once per worker. TFLite exports are memory-mapped from the model file, so
+their weights sit in the page cache once and are shared by every worker; use
+MALARIA_BACKEND=tflite / PNEUMONIA_BACKEND=tflite when running more than one
+worker. A single worker is the default: with micro-batching, one process
+already keeps every core busy during inference.
+
+With INFERENCE_SERVER set, the workers load no models at all: one inference
+server process (inference_server.py) holds them and runs the batching for
+every worker, so memory per node stays flat as WEB_CONCURRENCY grows. This
+config starts the server before the workers and stops it on exit; set
+INFERENCE_SERVER_SPAWN=0 to run it separately.
+"""
+
+import os
+import subprocess
+import sys
+
+bind = os.environ.get('SERVER_BIND', '0.0.0.0:5007')
+workers = int(os.environ.get('WEB_CONCURRENCY', '1'))
+worker_class = 'uvicorn.workers.UvicornWorker'
+
+# Load models in each worker after fork (see above)
+preload_app = False
+
+# Importing TensorFlow can take a while on a cold start
+timeout = int(os.environ.get('SERVER_TIMEOUT', '120'))
+graceful_timeout = int(os.environ.get('SERVER_GRACEFUL_TIMEOUT', '30'))
+keepalive = 5
+
+# Split the cores between workers instead of letting every worker's
+# TensorFlow, TFLite/ONNX and preprocessing pools size themselves to all of
+# them. Workers inherit this environment; explicit settings win. With an
+# inference server only preprocessing runs in the workers, and the server
+# keeps every core for inference.
+INFERENCE_SERVER = os.environ.get('INFERENCE_SERVER')
+if workers > 1:
+    threads_per_worker = str(max(1, (os.cpu_count() or 1) // workers))
+    split = ('PREPROCESS_WORKERS',) if INFERENCE_SERVER else ('TF_INTRA_OP_THREADS', 'INFERENCE_THREADS', 'PREPROCESS_WORKERS')
+    for name in split:
+        os.environ.setdefault(name, threads_per_worker)
+
+_inference_server = None
+
+
+def on_starting(server):
+    """Start the inference server; until it listens, workers answer 503 with Retry-After"""
+    global _inference_server
+    if INFERENCE_SERVER and os.environ.get('INFERENCE_SERVER_SPAWN', '1') != '0':
+        script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'inference_server.py')
+        _inference_server = subprocess.Popen([sys.executable, script])
+        server.log.info(f"Started inference server (pid {_inference_server.pid}) on {INFERENCE_SERVER}")
+
+
+def on_exit(server):
+    if _inference_server is not None and _inference_server.poll() is None:
+        _inference_server.terminate()
+        try:
+            _inference_server.wait(timeout=graceful_timeout)
+        except subprocess.TimeoutExpired:
+            _inference_server.kill()
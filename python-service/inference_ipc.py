@@ -0,0 +1,286 @@
+"""
+Inference server protocol and client.
+
+With INFERENCE_SERVER set to the Unix socket of inference_server.py, the
+Flask workers load no models and do not import TensorFlow: they preprocess
+uploads and hand the planes to the inference server, which owns the models
+and the micro-batchers for every worker on the node. RemoteModelRegistry,
+RemoteBatcher and RemoteExplainer stand in for ModelRegistry, MicroBatcher
+and Explainer in app.py.
+
+Messages are length-prefixed: an 8-byte frame with the sizes of a JSON header
+and a binary payload, then both. Arrays travel as raw bytes described by
+'dtype' and 'shape' in the header. Model inputs are sent as the uint8
+(n, 224, 224) planes, a twelfth of the size of the float32 model input.
+"""
+
+import json
+import queue
+import socket
+import struct
+import time
+
+import numpy as np
+
+from batching import DeadlineExceeded, QueueFull
+from calibration import Calibration
+from explain import ExplanationUnavailable
+from model_registry import UnknownModelVersion
+
+_FRAME = struct.Struct('!II')
+
+
+class InferenceServerError(RuntimeError):
+    """The inference server could not run a request"""
+
+
+def _recv_exactly(sock, size):
+    buffer = bytearray(size)
+    view = memoryview(buffer)
+    received = 0
+    while received < size:
+        count = sock.recv_into(view[received:])
+        if count == 0:
+            raise ConnectionError('inference server connection closed')
+        received += count
+    return buffer
+
+
+def send_message(sock, header, payload=b''):
+    header_bytes = json.dumps(header).encode()
+    sock.sendall(_FRAME.pack(len(header_bytes), len(payload)) + header_bytes)
+    if len(payload):
+        sock.sendall(payload)
+
+
+def recv_message(sock):
+    """(header dict, payload bytearray) of the next message"""
+    header_size, payload_size = _FRAME.unpack(_recv_exactly(sock, _FRAME.size))
+    header = json.loads(_recv_exactly(sock, header_size))
+    return header, _recv_exactly(sock, payload_size)
+
+
+def encode_array(array):
+    """(header fields, payload) for an array"""
+    array = np.ascontiguousarray(array)
+    return {'dtype': array.dtype.str, 'shape': list(array.shape)}, memoryview(array).cast('B')
+
+
+def decode_array(header, payload):
+    return np.frombuffer(payload, dtype=np.dtype(header['dtype'])).reshape(header['shape'])
+
+
+def to_planes(inputs):
+    """The uint8 (n, 224, 224) planes of a to_model_input() batch.
+
+    Exact: every input value is a uint8 value divided by 255.
+    """
+    return np.rint(np.asarray(inputs)[..., 0] * 255).astype(np.uint8)
+
+
+def raise_for_error(reply):
+    """Raise the exception matching an error reply from the server"""
+    error = reply.get('error')
+    if error == 'queue_full':
+        raise QueueFull(reply['message'])
+    if error == 'deadline_exceeded':
+        raise DeadlineExceeded(reply['message'])
+    if error == 'explanation_unavailable':
+        raise ExplanationUnavailable(reply['message'])
+    if error:
+        raise InferenceServerError(reply.get('message') or error)
+
+
+class InferenceClient:
+    """Pool of persistent connections to the inference server"""
+
+    def __init__(self, socket_path, timeout=None):
+        self.socket_path = socket_path
+        self.timeout = timeout
+        self._idle = queue.LifoQueue()
+
+    def _connect(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(self.timeout)
+        try:
+            sock.connect(self.socket_path)
+        except OSError:
+            sock.close()
+            raise
+        return sock
+
+    def call(self, header, payload=b''):
+        """Send one request and return the reply (header, payload).
+
+        A pooled connection the server has closed (e.g. it restarted) fails
+        when the request is sent; it is replaced once. Any later failure,
+        including a timeout waiting for the reply, is raised: the server may
+        already be running the request.
+        """
+        try:
+            sock, pooled = self._idle.get_nowait(), True
+        except queue.Empty:
+            sock, pooled = self._connect(), False
+        try:
+            send_message(sock, header, payload)
+        except socket.timeout:
+            sock.close()
+            raise
+        except OSError:
+            sock.close()
+            if not pooled:
+                raise
+            sock = self._connect()
+            return self._exchange(sock, header, payload)
+        except BaseException:
+            sock.close()
+            raise
+        return self._exchange(sock, header, payload, sent=True)
+
+    def _exchange(self, sock, header, payload, sent=False):
+        """Send the request (unless sent) and read the reply on sock, then
+        return sock to the pool"""
+        try:
+            if not sent:
+                send_message(sock, header, payload)
+            reply = recv_message(sock)
+        except BaseException:
+            sock.close()
+            raise
+        self._idle.put(sock)
+        return reply
+
+
+class RemoteModelVersion:
+    """A model version loaded in the inference server"""
+    __slots__ = ('name', 'version', 'model_id', 'path', 'explainable', 'calibration')
+
+    def __init__(self, name, version, model_id, path, explainable=False, calibration=None):
+        self.name = name
+        self.version = version
+        self.model_id = model_id
+        self.path = path
+        self.explainable = explainable
+        # Results are built here, in the front-end, so it needs the
+        # version's calibration
+        self.calibration = calibration
+
+
+def _unreachable_status(error):
+    return {
+        'state': 'loading', 'lazy': False, 'version': None, 'versions': [], 'backend': None, 'path': None,
+        'calibration': None, 'load_seconds': None, 'reloading': False, 'swaps': 0,
+        'error': f'inference server unreachable: {error}',
+    }
+
+
+class RemoteModelRegistry:
+    """The ModelRegistry interface app.py uses, backed by the inference server.
+
+    While the server is unreachable (e.g. still starting) every model reports
+    the state 'loading', so requests get a 503 with Retry-After.
+    """
+
+    def __init__(self, client, model_names):
+        self.client = client
+        self.model_names = tuple(model_names)
+
+    def acquire(self, name, version=None):
+        try:
+            reply, _ = self.client.call({'op': 'acquire', 'model': name, 'version': version})
+        except OSError:
+            return None
+        if reply.get('error') == 'unknown_version':
+            raise UnknownModelVersion(name, version, reply['available'])
+        if not reply.get('ready'):
+            return None
+        calibration = reply.get('calibration')
+        return RemoteModelVersion(
+            name, reply['version'], reply['model_id'], reply['path'], reply.get('explainable', False),
+            Calibration.from_dict(calibration, calibration.get('path')) if calibration else None,
+        )
+
+    def status(self):
+        try:
+            return self.client.call({'op': 'status'})[0]['models']
+        except OSError as e:
+            return {name: _unreachable_status(e) for name in self.model_names}
+
+    def state(self, name):
+        return self.status().get(name, {}).get('state')
+
+    def model_id(self, name):
+        current = self.acquire(name)
+        return current.model_id if current is not None else None
+
+    @property
+    def loading(self):
+        return any(status['state'] == 'loading' for status in self.status().values())
+
+    def wait(self, timeout=None):
+        """Block until the server is reachable and done loading"""
+        deadline = time.monotonic() + timeout if timeout is not None else None
+        while self.loading:
+            if deadline is not None and time.monotonic() > deadline:
+                raise TimeoutError('inference server still loading')
+            time.sleep(0.5)
+
+
+class RemoteBatcher:
+    """The MicroBatcher interface app.py uses; batching happens in the server"""
+
+    def __init__(self, client, name):
+        self.client = client
+        self.name = name
+
+    def predict(self, inputs, timeout=None, key=None, deadline=None, activation_keys=None):
+        """Run inputs on the server; key is the RemoteModelVersion to run on.
+
+        The server's batch queue bound and the deadline apply as for
+        MicroBatcher, raising QueueFull and DeadlineExceeded. Activations
+        captured for explanations are cached in the server under
+        activation_keys.
+        """
+        fields, payload = encode_array(to_planes(inputs))
+        header = {
+            'op': 'predict', 'model': self.name, 'version': key.version if key is not None else None,
+            'deadline': deadline, 'activation_keys': activation_keys, **fields,
+        }
+        reply, reply_payload = self.client.call(header, payload)
+        raise_for_error(reply)
+        return decode_array(reply, reply_payload)
+
+    def queue_full(self):
+        """Always False: the server enforces its queue bound when predicting"""
+        return False
+
+    def stats(self):
+        try:
+            return self.client.call({'op': 'status'})[0]['batching'][self.name]
+        except OSError:
+            return {'queued': 0}
+
+
+class RemoteExplainer:
+    """The Explainer interface app.py uses; activations are cached in the server.
+
+    The image is only sent when the server no longer has its activations.
+    """
+
+    def __init__(self, client):
+        self.client = client
+
+    def heatmap(self, model, key, compute_inputs, deadline=None):
+        header = {'op': 'explain', 'model': model.name, 'version': model.version, 'key': key, 'deadline': deadline}
+        reply, reply_payload = self.client.call(header)
+        if reply.get('error') == 'activations_missing':
+            fields, payload = encode_array(to_planes(compute_inputs()))
+            reply, reply_payload = self.client.call({**header, **fields}, payload)
+        raise_for_error(reply)
+        return decode_array(reply, reply_payload), reply['layer'], reply['cached']
+
+    def stats(self):
+        try:
+            return self.client.call({'op': 'status'})[0]['explain']
+        except OSError:
+            return {'enabled': False}
@@ -0,0 +1,199 @@
+"""
+Inference server: one process that owns the models for every front-end worker.
+
+Each gunicorn worker normally loads its own copy of every model, so memory per
+node grows with the number of workers. With INFERENCE_SERVER set, the workers
+load nothing; this process loads the models once, runs the micro-batchers and
+answers the workers over a Unix socket (protocol in inference_ipc.py).
+Batching across all workers also fills batches faster than any one of them.
+
+    INFERENCE_SERVER=/tmp/medical-inference.sock python inference_server.py
+    INFERENCE_SERVER=/tmp/medical-inference.sock WEB_CONCURRENCY=4 \\
+        gunicorn -c gunicorn.conf.py asgi:app
+
+gunicorn.conf.py starts and stops this process itself when INFERENCE_SERVER
+is set (INFERENCE_SERVER_SPAWN=0 to run it separately). The model settings
+(MODEL_DIR, *_BACKEND, BATCH_MAX_SIZE, MODEL_WATCH_INTERVAL, ...) are read
+from the environment exactly as app.py reads them.
+"""
+
+import logging
+import os
+import signal
+import socket
+import socketserver
+import sys
+
+# The socket to listen on: INFERENCE_SOCKET, else the INFERENCE_SERVER path
+# the front-ends are configured with
+INFERENCE_SOCKET = (
+    os.environ.get('INFERENCE_SOCKET') or os.environ.get('INFERENCE_SERVER') or '/tmp/medical-inference.sock'
+)
+
+# This process hosts the models itself, whatever the front-ends are told.
+# One earlier version stays loaded so a request that acquired a version just
+# before a hot swap can still run on it.
+os.environ.pop('INFERENCE_SERVER', None)
+os.environ.setdefault('MODEL_RETAIN_VERSIONS', '1')
+# No uploads are preprocessed here
+os.environ['PREPROCESS_POOL'] = 'inline'
+
+import app as service  # noqa: E402
+from batching import DeadlineExceeded, QueueFull  # noqa: E402
+from explain import ExplanationUnavailable  # noqa: E402
+from inference_ipc import decode_array, encode_array, recv_message, send_message  # noqa: E402
+from model_registry import UnknownModelVersion  # noqa: E402
+from preprocessing import to_model_input  # noqa: E402
+from service_logging import SERVICE_LOGGER  # noqa: E402
+
+logger = logging.getLogger(SERVICE_LOGGER)
+
+BATCHERS = service.batchers
+
+
+class ActivationsMissing(Exception):
+    """An explain request without an image whose activations are not cached"""
+
+
+def _acquire(header):
+    """(ModelVersion or None, error reply or None) for a request header"""
+    name = header.get('model')
+    if name not in BATCHERS:
+        return None, {'error': 'unknown_model', 'message': f'Unknown model: {name}'}
+    try:
+        model = service.model_registry.acquire(name, header.get('version'))
+    except UnknownModelVersion as e:
+        return None, {'error': 'unknown_version', 'message': str(e), 'available': e.available}
+    if model is None:
+        return None, {'error': 'not_ready', 'state': service.model_registry.state(name)}
+    return model, None
+
+
+def handle_request(header, payload):
+    """Reply (header, payload) to one request"""
+    op = header.get('op')
+    if op == 'status':
+        return {
+            'models': service.model_registry.status(),
+            'batching': {name: batcher.stats() for name, batcher in BATCHERS.items()},
+            'explain': service.explainer.stats(),
+        }, b''
+
+    if op == 'acquire':
+        model, error = _acquire(header)
+        if error is not None:
+            if error['error'] == 'not_ready':
+                return {'ready': False, 'state': error['state']}, b''
+            return error, b''
+        return {
+            'ready': True, 'version': model.version, 'model_id': model.model_id, 'path': model.path,
+            'explainable': model.explainable,
+            'calibration': {**model.calibration.to_dict(), 'path': model.calibration.path} if model.calibration else None,
+        }, b''
+
+    if op == 'predict':
+        model, error = _acquire(header)
+        if error is not None:
+            return error, b''
+        inputs = to_model_input(decode_array(header, payload))
+        try:
+            outputs = service.forward(
+                model, BATCHERS[model.name], inputs, header.get('deadline'), header.get('activation_keys'),
+            )
+        except QueueFull as e:
+            return {'error': 'queue_full', 'message': str(e)}, b''
+        except DeadlineExceeded as e:
+            return {'error': 'deadline_exceeded', 'message': str(e)}, b''
+        except Exception as e:
+            logger.exception(f"Inference failed: {str(e)}", extra={'fields': {'model': model.name}})
+            return {'error': 'inference_failed', 'message': str(e)}, b''
+        fields, reply_payload = encode_array(outputs.astype('float32', copy=False))
+        return {'version': model.version, **fields}, reply_payload
+
+    if op == 'explain':
+        model, error = _acquire(header)
+        if error is not None:
+            return error, b''
+
+        def compute_inputs():
+            if not payload:
+                raise ActivationsMissing()
+            return to_model_input(decode_array(header, payload))
+
+        try:
+            heatmap, layer_name, cached = service.explainer.heatmap(
+                model, header['key'], compute_inputs, deadline=header.get('deadline'),
+            )
+        except ActivationsMissing:
+            return {'error': 'activations_missing'}, b''
+        except ExplanationUnavailable as e:
+            return {'error': 'explanation_unavailable', 'message': str(e)}, b''
+        except QueueFull as e:
+            return {'error': 'queue_full', 'message': str(e)}, b''
+        except DeadlineExceeded as e:
+            return {'error': 'deadline_exceeded', 'message': str(e)}, b''
+        except Exception as e:
+            logger.exception(f"Explanation failed: {str(e)}", extra={'fields': {'model': model.name}})
+            return {'error': 'explain_failed', 'message': str(e)}, b''
+        fields, reply_payload = encode_array(heatmap.astype('float32', copy=False))
+        return {'layer': layer_name, 'cached': cached, **fields}, reply_payload
+
+    return {'error': 'unknown_op', 'message': f'Unknown operation: {op}'}, b''
+
+
+class InferenceHandler(socketserver.BaseRequestHandler):
+    """Serves one front-end connection until it closes"""
+
+    def handle(self):
+        while True:
+            try:
+                header, payload = recv_message(self.request)
+            except (ConnectionError, OSError):
+                return
+            reply, reply_payload = handle_request(header, payload)
+            try:
+                send_message(self.request, reply, reply_payload)
+            except OSError:
+                return
+
+
+class InferenceServer(socketserver.ThreadingUnixStreamServer):
+    daemon_threads = True
+
+
+def _remove_stale_socket(path):
+    """Remove a socket file left by a previous server; refuse to start next
+    to a server that is still running"""
+    if not os.path.exists(path):
+        return
+    probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        probe.connect(path)
+    except OSError:
+        os.unlink(path)
+    else:
+        raise SystemExit(f'An inference server is already listening on {path}')
+    finally:
+        probe.close()
+
+
+def serve(path=INFERENCE_SOCKET):
+    _remove_stale_socket(path)
+    server = InferenceServer(path, InferenceHandler)
+    # Front-end workers run as the same user or group
+    os.chmod(path, 0o660)
+    logger.info(f"Inference server listening on {path}", extra={'fields': {'socket': path}})
+    # Stopped with SIGTERM by gunicorn.conf.py: clean up as on Ctrl-C
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        os.unlink(path)
+        service.preprocess_pool.shutdown()
+
+
+if __name__ == '__main__':
+    serve()
@@ -0,0 +1,39 @@
+"""
+Fast JSON serialization for Flask responses.
+
+OrjsonProvider replaces Flask's default JSON provider, so every jsonify()
+call in app.py serializes with orjson when it is installed, and falls back
+to Flask's standard-library encoder otherwise. Output keeps Flask's defaults:
+keys sorted, no whitespace, a trailing newline and the same conversions for
+types JSON does not cover (dates, decimals, UUIDs, dataclasses).
+"""
+
+from flask.json.provider import DefaultJSONProvider
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+class OrjsonProvider(DefaultJSONProvider):
+    """DefaultJSONProvider that encodes with orjson when available"""
+
+    # Numpy scalars and arrays are serialized natively instead of failing
+    options = (orjson.OPT_SORT_KEYS | orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS) if orjson else 0
+
+    def dumps(self, obj, **kwargs):
+        # Indented output (compact=False or debug mode) goes through the
+        # standard-library encoder
+        if orjson is None or kwargs.get('indent') is not None:
+            return super().dumps(obj, **kwargs)
+        return orjson.dumps(obj, default=self.default, option=self.options).decode()
+
+    def response(self, *args, **kwargs):
+        if orjson is None or self.compact is False or (self.compact is None and self._app.debug):
+            return super().response(*args, **kwargs)
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(
+            orjson.dumps(obj, default=self.default, option=self.options | orjson.OPT_APPEND_NEWLINE),
+            mimetype=self.mimetype,
+        )
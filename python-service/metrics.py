@@ -0,0 +1,218 @@
+"""
+Prometheus-style metrics.
+
+A small, dependency-free subset of the Prometheus client: counters, gauges
+and histograms with labels, plus callback gauges and counters evaluated at
+scrape time.
+``MetricsRegistry.render()`` produces the text exposition format served by
+/metrics.
+
+Metrics are per process: with several gunicorn workers, each scrape sees the
+worker that answered it.
+"""
+
+import math
+import threading
+import time
+from contextlib import contextmanager
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# Latency buckets in seconds, from 1 ms up to 10 s
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(names, values, extra=()):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    pairs.extend(f'{name}="{_escape(value)}"' for name, value in extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _format_value(value):
+    if isinstance(value, int):
+        return str(value)
+    if math.isinf(value):
+        return '+Inf' if value > 0 else '-Inf'
+    return repr(float(value))
+
+
+def process_memory_bytes():
+    """Resident and peak resident memory of this process (Linux; empty elsewhere)"""
+    fields = {'VmRSS:': 'rss', 'VmHWM:': 'peak_rss'}
+    memory = {}
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                name = line.split(None, 1)[0]
+                if name in fields:
+                    memory[fields[name]] = int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return memory
+
+
+class _Metric:
+    type_name = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f'{self.name} expects labels {self.labelnames}, got {tuple(labels)}')
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def _header(self):
+        return [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.type_name}']
+
+    def render(self):
+        with self._lock:
+            items = sorted(self._values.items())
+        lines = self._header()
+        for key, value in items:
+            lines.append(f'{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}')
+        return lines
+
+
+class Counter(_Metric):
+    """Monotonically increasing count"""
+
+    type_name = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(_Metric):
+    """Value that can go up and down"""
+
+    type_name = 'gauge'
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+
+class CallbackGauge(_Metric):
+    """Gauge read at scrape time: fn() returns {label values tuple: value}"""
+
+    type_name = 'gauge'
+
+    def __init__(self, name, documentation, labelnames, fn):
+        super().__init__(name, documentation, labelnames)
+        self.fn = fn
+
+    def render(self):
+        lines = self._header()
+        for key, value in sorted(self.fn().items()):
+            if value is not None:
+                lines.append(f'{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}')
+        return lines
+
+
+class CallbackCounter(CallbackGauge):
+    """Counter read at scrape time from a count kept elsewhere; fn() returns
+    {label values tuple: value}, which must never decrease"""
+
+    type_name = 'counter'
+
+
+class Histogram(_Metric):
+    """Distribution of observations in cumulative buckets"""
+
+    type_name = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                # Per-bucket (non-cumulative) counts, then sum and count
+                state = self._values[key] = [[0] * len(self.buckets), 0.0, 0]
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    state[0][index] += 1
+                    break
+            state[1] += value
+            state[2] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        """Observe the duration of a with-block"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def render(self):
+        with self._lock:
+            items = sorted((key, (list(counts), total, count)) for key, (counts, total, count) in self._values.items())
+        lines = self._header()
+        for key, (counts, total, count) in items:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                labels = _format_labels(self.labelnames, key, [('le', _format_value(bound))])
+                lines.append(f'{self.name}_bucket{labels} {cumulative}')
+            labels = _format_labels(self.labelnames, key, [('le', '+Inf')])
+            lines.append(f'{self.name}_bucket{labels} {count}')
+            labels = _format_labels(self.labelnames, key)
+            lines.append(f'{self.name}_sum{labels} {_format_value(total)}')
+            lines.append(f'{self.name}_count{labels} {count}')
+        return lines
+
+
+class MetricsRegistry:
+    """Holds metrics and renders them in the Prometheus text format"""
+
+    def __init__(self):
+        self._metrics = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def counter(self, name, documentation, labelnames=()):
+        return self.register(Counter(name, documentation, labelnames))
+
+    def gauge(self, name, documentation, labelnames=()):
+        return self.register(Gauge(name, documentation, labelnames))
+
+    def callback_gauge(self, name, documentation, labelnames, fn):
+        return self.register(CallbackGauge(name, documentation, labelnames, fn))
+
+    def callback_counter(self, name, documentation, labelnames, fn):
+        return self.register(CallbackCounter(name, documentation, labelnames, fn))
+
+    def histogram(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self.register(Histogram(name, documentation, labelnames, buckets))
+
+    def render(self):
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
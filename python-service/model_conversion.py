@@ -0,0 +1,515 @@
+"""
+TFJS model conversion with cached, verified artifacts.
+
+The one place a TensorFlow.js layers model (model.json plus weight shards)
+becomes formats the service and the tools can load. convert_tfjs_to_keras.py
+is its command line. Conversion is a deployment step. The service only looks
+up finished artifacts (find_artifact) and never converts at startup.
+
+- model.json is parsed and the weight shards are memory-mapped. Weights are
+  read in place from the mapped shards, and only the weights that straddle
+  a shard boundary are copied. No tensorflowjs package is needed: the Keras
+  topology in model.json is rebuilt with Keras itself.
+- Artifacts live under lib/model/.cache/<source dir>-<source hash>/, with a
+  conversion.json manifest recording the source hash, the source file
+  identities, every emitted format and its parity check. A source whose hash
+  already has an artifact for a format is not converted again.
+- One load feeds every requested format (h5, keras, savedmodel, tflite).
+  Writing a format traces and mutates the Keras model, so the formats are
+  written one at a time, each to a temporary name. Each is verified in a
+  thread pool while the next is written, and renamed into place only after
+  it passes.
+- Verification runs the sample inputs through each written artifact and
+  compares the outputs with the model rebuilt from TFJS. An artifact that
+  differs by more than the tolerance is discarded.
+"""
+
+import datetime
+import hashlib
+import json
+import logging
+import mmap
+import os
+import shutil
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from backends import IMAGE_SHAPE
+from service_logging import SERVICE_LOGGER
+
+logger = logging.getLogger(SERVICE_LOGGER)
+
+# Converted artifacts, one directory per source hash, under the model directory
+CONVERSION_CACHE_DIR = '.cache'
+ARTIFACT_MANIFEST = 'conversion.json'
+
+FORMATS = ('h5', 'keras', 'savedmodel', 'tflite')
+DEFAULT_FORMATS = ('h5', 'savedmodel', 'tflite')
+ARTIFACT_NAMES = {'h5': 'model.h5', 'keras': 'model.keras', 'savedmodel': 'saved_model', 'tflite': 'model.tflite'}
+
+# Largest absolute output difference an artifact may show against the model
+# rebuilt from TFJS on the parity samples
+PARITY_TOLERANCE = 1e-4
+
+# dtypes of TFJS weight entries (and of their quantized storage)
+_DTYPES = {
+    'float32': np.float32, 'int32': np.int32, 'bool': np.bool_,
+    'uint8': np.uint8, 'uint16': np.uint16, 'float16': np.float16,
+}
+
+
+class ConversionError(RuntimeError):
+    """A TFJS model could not be converted, or an artifact failed verification"""
+
+
+# Source files
+
+def source_files(tfjs_dir):
+    """model.json and the weight shards of a TFJS model, sorted by name"""
+    return sorted(
+        name for name in os.listdir(tfjs_dir)
+        if os.path.isfile(os.path.join(tfjs_dir, name)) and (name == 'model.json' or name.endswith('.bin'))
+    )
+
+
+def source_identity(tfjs_dir):
+    """{file name: [size, mtime_ns]}; cheap to check against a manifest"""
+    identity = {}
+    for name in source_files(tfjs_dir):
+        st = os.stat(os.path.join(tfjs_dir, name))
+        identity[name] = [st.st_size, st.st_mtime_ns]
+    return identity
+
+
+def _map_file(f):
+    """Read-only mmap of an open file (empty files cannot be mapped)"""
+    if os.fstat(f.fileno()).st_size == 0:
+        return b''
+    return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+def tfjs_source_hash(tfjs_dir):
+    """Hash of a TFJS model: model.json plus every weight shard"""
+    digest = hashlib.blake2b(digest_size=16)
+    for name in source_files(tfjs_dir):
+        digest.update(name.encode())
+        with open(os.path.join(tfjs_dir, name), 'rb') as f:
+            mapped = _map_file(f)
+            try:
+                digest.update(mapped)
+            finally:
+                if mapped:
+                    mapped.close()
+    return digest.hexdigest()
+
+
+class TfjsWeights:
+    """Weights of a TFJS model read from memory-mapped shards.
+
+    Used as a context manager: values() gives {weight name: array}. Arrays of
+    float32/int32 weights are views of the mapped shards, valid until the
+    context exits; quantized and float16 weights are dequantized to float32.
+    """
+
+    def __init__(self, tfjs_dir, weights_manifest):
+        self.tfjs_dir = tfjs_dir
+        self.weights_manifest = weights_manifest
+        self._files = []
+        self._maps = []
+        self._weights = {}
+
+    def __enter__(self):
+        try:
+            for group in self.weights_manifest:
+                self._read_group(group)
+        except BaseException:
+            self.close()
+            raise
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def values(self):
+        return self._weights
+
+    def close(self):
+        # Views into the maps must be gone before the maps can close
+        self._weights = {}
+        for mapped in self._maps:
+            if mapped:
+                try:
+                    mapped.close()
+                except BufferError:
+                    # A view is still referenced (e.g. by a traceback); the
+                    # map closes when it is collected
+                    pass
+        for f in self._files:
+            f.close()
+        self._maps = []
+        self._files = []
+
+    def _read_group(self, group):
+        shards = []
+        offset = 0
+        for name in group['paths']:
+            f = open(os.path.join(self.tfjs_dir, name), 'rb')
+            self._files.append(f)
+            mapped = _map_file(f)
+            self._maps.append(mapped)
+            shards.append((offset, mapped))
+            offset += len(mapped)
+        total = offset
+
+        offset = 0
+        for entry in group['weights']:
+            quantization = entry.get('quantization')
+            storage = np.dtype(_DTYPES[quantization['dtype'] if quantization else entry['dtype']])
+            count = int(np.prod(entry['shape'], dtype=np.int64))
+            size = count * storage.itemsize
+            if offset + size > total:
+                raise ConversionError(f"Weight shards of {self.tfjs_dir} end before weight {entry['name']}")
+            value = self._slice(shards, offset, size).view(storage)
+            if quantization:
+                value = value.astype(np.float32)
+                if 'scale' in quantization:
+                    value = value * np.float32(quantization['scale']) + np.float32(quantization['min'])
+            self._weights[entry['name']] = value.reshape(entry['shape'])
+            offset += size
+
+    @staticmethod
+    def _slice(shards, start, size):
+        """uint8 array of bytes [start, start + size) of a group: a view when
+        they lie in one shard, else a copy joining the pieces"""
+        pieces = []
+        end = start + size
+        for shard_start, mapped in shards:
+            shard_end = shard_start + len(mapped)
+            if shard_end <= start or shard_start >= end:
+                continue
+            lo, hi = max(start, shard_start) - shard_start, min(end, shard_end) - shard_start
+            pieces.append(np.frombuffer(mapped, dtype=np.uint8, count=hi - lo, offset=lo))
+        if len(pieces) == 1:
+            return pieces[0]
+        return np.concatenate(pieces) if pieces else np.zeros(0, dtype=np.uint8)
+
+
+def _weight_key(name):
+    return name[:-2] if name.endswith(':0') else name
+
+
+def _assign_weights(model, weights, positional=False):
+    """Set model weights from {TFJS weight name: array}, matched by name.
+
+    Every model weight must find its TFJS weight by name. Same-shaped weights
+    are common (BatchNorm statistics, stacked convolutions), so falling back
+    to their order could swap them without any check noticing. With
+    positional, weights are instead taken in order when the counts and
+    shapes line up; each weight assigned that way is logged, and a weight
+    whose name does match must sit at its own position.
+    """
+    variables = model.weights
+    paths = [_weight_key(getattr(variable, 'path', variable.name)) for variable in variables]
+    by_name = {_weight_key(name): value for name, value in weights.items()}
+    values = []
+    for variable, path in zip(variables, paths):
+        value = by_name.get(path)
+        if value is None:
+            matches = [key for key in by_name if key.endswith('/' + path) or path.endswith('/' + key)]
+            value = by_name[matches[0]] if len(matches) == 1 else None
+        if value is not None and tuple(value.shape) != tuple(variable.shape):
+            raise ConversionError(
+                f"TFJS weight for {path} has shape {tuple(value.shape)}, expected {tuple(variable.shape)}"
+            )
+        values.append(value)
+
+    missing = [path for path, value in zip(paths, values) if value is None]
+    if not missing:
+        model.set_weights(values)
+        return
+    names = ', '.join(missing[:5]) + ('...' if len(missing) > 5 else '')
+    if not positional:
+        raise ConversionError(f"No TFJS weight matches {names} by name (--positional-weights assigns them in order)")
+
+    ordered = list(weights.items())
+    if len(ordered) != len(variables) or any(
+        tuple(value.shape) != tuple(variable.shape) for (_, value), variable in zip(ordered, variables)
+    ):
+        raise ConversionError(f"No TFJS weights for {names}, and the weights do not line up in order")
+    for (name, value), path, matched in zip(ordered, paths, values):
+        if matched is None:
+            logger.warning(f"Assigning TFJS weight {name} to {path} by position", extra={'fields': {
+                'tfjs_weight': name, 'model_weight': path,
+            }})
+        elif matched is not value:
+            raise ConversionError(f"TFJS weight {name} sits in the position of {path}, which matches another by name")
+    model.set_weights([value for _, value in ordered])
+
+
+def load_tfjs_model(tfjs_dir, positional_weights=False):
+    """Rebuild the Keras model of a TFJS layers model (see _assign_weights
+    for positional_weights)"""
+    import tensorflow as tf
+    from custom_layers import custom_objects
+
+    with open(os.path.join(tfjs_dir, 'model.json')) as f:
+        model_json = json.load(f)
+    if model_json.get('format', 'layers-model') != 'layers-model':
+        raise ConversionError(f"{tfjs_dir} is a {model_json['format']}; only TFJS layers models can be converted")
+
+    topology = model_json['modelTopology']
+    model_config = topology.get('model_config', topology)
+    model_class = tf.keras.Sequential if model_config['class_name'] == 'Sequential' else tf.keras.Model
+    model = model_class.from_config(model_config['config'], custom_objects=custom_objects)
+
+    with TfjsWeights(tfjs_dir, model_json['weightsManifest']) as weights:
+        _assign_weights(model, weights.values(), positional_weights)
+    return model
+
+
+# Artifacts
+
+def artifact_dir(model_dir, tfjs_dir, source_hash):
+    return os.path.join(model_dir, CONVERSION_CACHE_DIR, f'{os.path.basename(os.path.normpath(tfjs_dir))}-{source_hash}')
+
+
+def read_manifest(directory):
+    path = os.path.join(directory, ARTIFACT_MANIFEST)
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+
+def _write_manifest(directory, manifest):
+    fd, tmp_path = tempfile.mkstemp(dir=directory, suffix='.json')
+    with os.fdopen(fd, 'w') as f:
+        json.dump(manifest, f, indent=2)
+    os.chmod(tmp_path, 0o644)
+    os.replace(tmp_path, os.path.join(directory, ARTIFACT_MANIFEST))
+
+
+def _artifact_manifests(model_dir, tfjs_dir):
+    """(directory, manifest) of every artifact of a TFJS source directory"""
+    cache_dir = os.path.join(model_dir, CONVERSION_CACHE_DIR)
+    prefix = os.path.basename(os.path.normpath(tfjs_dir)) + '-'
+    if not os.path.isdir(cache_dir):
+        return []
+    found = []
+    for name in sorted(os.listdir(cache_dir)):
+        directory = os.path.join(cache_dir, name)
+        if name.startswith(prefix) and os.path.isdir(directory):
+            manifest = read_manifest(directory)
+            if manifest is not None:
+                found.append((directory, manifest))
+    return found
+
+
+def find_artifact(tfjs_dir, model_dir, fmt='h5', verify_hash=True):
+    """Path of the `fmt` artifact converted from the current TFJS source, or None.
+
+    Matches the source file sizes and modification times recorded in the
+    manifests first (a few stats). If the files were touched or copied since,
+    the source is hashed and matched by content, unless verify_hash is false.
+    """
+    candidates = [
+        (directory, manifest) for directory, manifest in _artifact_manifests(model_dir, tfjs_dir)
+        if fmt in manifest.get('formats', {})
+    ]
+    if not candidates:
+        return None
+    identity = source_identity(tfjs_dir)
+    match = next((directory for directory, manifest in candidates if manifest.get('source_files') == identity), None)
+    if match is None and verify_hash:
+        source_hash = tfjs_source_hash(tfjs_dir)
+        match = next((directory for directory, manifest in candidates if manifest['source_hash'] == source_hash), None)
+    if match is None:
+        return None
+    path = os.path.join(match, ARTIFACT_NAMES[fmt])
+    return path if os.path.exists(path) else None
+
+
+# Conversion
+
+def _export(model, fmt, path):
+    import tensorflow as tf
+
+    if fmt in ('h5', 'keras'):
+        model.save(path)
+    elif fmt == 'savedmodel':
+        if hasattr(model, 'export'):
+            model.export(path, verbose=False)
+        else:
+            tf.saved_model.save(model, path)
+    elif fmt == 'tflite':
+        with open(path, 'wb') as f:
+            f.write(tf.lite.TFLiteConverter.from_keras_model(model).convert())
+    else:
+        raise ValueError(f"Unknown conversion format '{fmt}' (expected one of {', '.join(FORMATS)})")
+
+
+def _keras_predict(model, batch):
+    # Models rebuilt from a config declare their input as a one-element list
+    return np.asarray(model([batch] if isinstance(model.input, list) else batch, training=False))
+
+
+def _artifact_predict(fmt, path):
+    """predict(batch) for a written artifact"""
+    import tensorflow as tf
+
+    if fmt in ('h5', 'keras'):
+        from custom_layers import custom_objects
+        model = tf.keras.models.load_model(path, custom_objects=custom_objects, compile=False)
+        return lambda batch: _keras_predict(model, batch)
+    if fmt == 'savedmodel':
+        loaded = tf.saved_model.load(path)
+        signature = getattr(getattr(loaded, 'serve', None), 'input_signature', None)
+        as_list = bool(signature) and isinstance(signature[0], (list, tuple))
+
+        def predict(batch):
+            # Through `loaded`: the functions need it alive for its variables
+            serve = getattr(loaded, 'serve', None) or loaded.signatures['serving_default']
+            outputs = serve([tf.constant(batch)] if as_list else tf.constant(batch))
+            # Signatures return {output name: tensor}
+            if isinstance(outputs, dict):
+                outputs = next(iter(outputs.values()))
+            return np.asarray(outputs)
+        return predict
+    from backends import TFLiteBackend
+    return TFLiteBackend(path).predict
+
+
+def parity_report(outputs, reference, tolerance):
+    delta = np.abs(outputs.astype(np.float64) - reference.astype(np.float64))
+    return {
+        'samples': int(len(reference)),
+        'max_abs_delta': float(delta.max()) if delta.size else 0.0,
+        'mean_abs_delta': float(delta.mean()) if delta.size else 0.0,
+        'tolerance': tolerance,
+        'passed': bool(delta.size == 0 or delta.max() <= tolerance),
+    }
+
+
+def _remove(path):
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+    elif os.path.exists(path):
+        os.remove(path)
+
+
+def _write_format(model, fmt, directory):
+    """Write one format under a temporary name; returns that path"""
+    stem, extension = os.path.splitext(ARTIFACT_NAMES[fmt])
+    tmp_path = os.path.join(directory, f'.{stem}.{os.getpid()}.tmp{extension}')
+    try:
+        _export(model, fmt, tmp_path)
+    except BaseException:
+        _remove(tmp_path)
+        raise
+    return tmp_path
+
+
+def _verify_format(fmt, tmp_path, directory, samples, reference, tolerance):
+    """Verify a written format and move it into place; returns the manifest
+    entry. Only loads the artifact, so it may run alongside other formats."""
+    final_path = os.path.join(directory, ARTIFACT_NAMES[fmt])
+    try:
+        parity = None
+        if reference is not None:
+            parity = parity_report(_artifact_predict(fmt, tmp_path)(samples), reference, tolerance)
+            if not parity['passed']:
+                raise ConversionError(
+                    f"{fmt} artifact differs from the TFJS model by {parity['max_abs_delta']:.2e} "
+                    f"(tolerance {tolerance:.0e})"
+                )
+        if os.path.isdir(final_path):
+            shutil.rmtree(final_path)
+        os.replace(tmp_path, final_path)
+    finally:
+        _remove(tmp_path)
+    return {'path': ARTIFACT_NAMES[fmt], 'bytes': _size(final_path), 'parity': parity}
+
+
+def _size(path):
+    if os.path.isfile(path):
+        return os.path.getsize(path)
+    return sum(os.path.getsize(os.path.join(root, name)) for root, _, names in os.walk(path) for name in names)
+
+
+def random_samples(count, seed=0):
+    """Seeded random model inputs in [0, 1], for parity checks without sample images"""
+    return np.random.default_rng(seed).random((count,) + IMAGE_SHAPE, dtype=np.float32)
+
+
+def convert(tfjs_dir, model_dir, formats=DEFAULT_FORMATS, samples=None, tolerance=PARITY_TOLERANCE,
+            force=False, workers=None, positional_weights=False):
+    """Convert a TFJS model to `formats`, skipping those already converted
+    from the same source; returns (artifact directory, manifest).
+
+    samples are the (n, 224, 224, 3) parity inputs; None skips verification.
+    The parity check compares against the rebuilt model itself, so it cannot
+    catch misassigned weights: positional_weights (see _assign_weights) is
+    only for sources whose weight names are known not to match.
+    Raises ConversionError if any format fails, after recording the ones
+    that succeeded.
+    """
+    unknown = [fmt for fmt in formats if fmt not in FORMATS]
+    if unknown:
+        raise ValueError(f"Unknown conversion format(s) {', '.join(unknown)} (expected {', '.join(FORMATS)})")
+
+    source_hash = tfjs_source_hash(tfjs_dir)
+    directory = artifact_dir(model_dir, tfjs_dir, source_hash)
+    os.makedirs(directory, exist_ok=True)
+    manifest = read_manifest(directory) or {
+        'source': os.path.basename(os.path.normpath(tfjs_dir)),
+        'source_hash': source_hash,
+        'formats': {},
+    }
+    manifest['source_files'] = source_identity(tfjs_dir)
+
+    todo = [
+        fmt for fmt in dict.fromkeys(formats)
+        if force or fmt not in manifest['formats']
+        or not os.path.exists(os.path.join(directory, ARTIFACT_NAMES[fmt]))
+    ]
+    if not todo:
+        _write_manifest(directory, manifest)
+        return directory, manifest
+
+    import tensorflow as tf
+
+    model = load_tfjs_model(tfjs_dir, positional_weights)
+    reference = None
+    if samples is not None and len(samples):
+        reference = _keras_predict(model, samples)
+
+    # One load feeds every format. model.save, model.export and the TFLite
+    # converter all trace the shared model, so formats are written one at a
+    # time; each is verified in the pool while the next one is written.
+    failures = {}
+    with ThreadPoolExecutor(max_workers=workers or len(todo), thread_name_prefix='convert') as pool:
+        futures = {}
+        for fmt in todo:
+            try:
+                tmp_path = _write_format(model, fmt, directory)
+            except Exception as e:
+                failures[fmt] = str(e)
+                continue
+            futures[fmt] = pool.submit(_verify_format, fmt, tmp_path, directory, samples, reference, tolerance)
+        for fmt, future in futures.items():
+            try:
+                manifest['formats'][fmt] = future.result()
+            except Exception as e:
+                failures[fmt] = str(e)
+    for fmt in failures:
+        manifest['formats'].pop(fmt, None)
+
+    manifest['converted_at'] = datetime.datetime.now(datetime.timezone.utc).isoformat(timespec='seconds')
+    manifest['tensorflow'] = tf.__version__
+    manifest['positional_weights'] = bool(positional_weights)
+    _write_manifest(directory, manifest)
+    if failures:
+        raise ConversionError('; '.join(f'{fmt}: {message}' for fmt, message in failures.items()))
+    return directory, manifest
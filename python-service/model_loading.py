@@ -0,0 +1,247 @@
+"""
+Loaders for the medical models.
+
+Resolves the model files under lib/model, selects the inference backend
+(Keras or an optimized TFLite/ONNX export) and, for the pneumonia model,
+falls back to the conversion of the TensorFlow.js export. Conversion is a
+deployment step (convert_tfjs_to_keras.py, see model_conversion.py); the
+loaders only pick up its verified artifacts under lib/model/.cache and never
+convert at startup.
+
+An optional manifest, lib/model/models.json, names the file and version to
+load per model instead of the built-in file names:
+
+    {"malaria": {"file": "malaria_v4.h5", "version": "v4"}}
+
+Every loader returns a LoadedModel whose ``model`` exposes predict(batch),
+with the Calibration (calibration.py) stored next to the model file, if any.
+Used by the Flask service (through the model registry) and the offline tools.
+"""
+
+import hashlib
+import json
+import logging
+import os
+
+from backends import KerasBackend, load_backend, optimized_model_path
+from calibration import calibration_path, load_calibration
+from model_conversion import ARTIFACT_MANIFEST, find_artifact
+from prediction_cache import file_identity
+from service_logging import SERVICE_LOGGER
+
+logger = logging.getLogger(SERVICE_LOGGER)
+
+MALARIA_MODEL_FILES = ['malaria_model1.h5']
+PNEUMONIA_MODEL_FILES = [
+    'best_model.h5',        # Primary: best_model.h5 (pneumonia model)
+    'pneumonia_model.h5',   # Fallback: pneumonia_model.h5
+]
+PNEUMONIA_TFJS_DIRS = [
+    'tfjspnumoniaDetectorModel',  # Actual folder name
+    'pnumoniaDetectorModel',      # Alternative name
+]
+
+# Optional per-model file and version, relative to the model directory
+MANIFEST_FILE = 'models.json'
+
+
+class LoadedModel:
+    """A loaded model backend plus the file, version and calibration it came from"""
+    __slots__ = ('model', 'model_id', 'path', 'version', 'calibration')
+
+    def __init__(self, model, path, version=None, calibration=None):
+        self.model = model
+        self.path = path
+        self.calibration = calibration
+        # Identity of the model file, used to key the prediction cache (which
+        # holds raw outputs, so a new calibration does not invalidate it)
+        self.model_id = file_identity(path)
+        # Version from the manifest, or a short hash of the file identity and
+        # of the calibration file, if any
+        calibration_id = calibration_identity(calibration.path) if calibration is not None else ''
+        self.version = version or hashlib.blake2b((self.model_id + calibration_id).encode(), digest_size=4).hexdigest()
+
+
+def calibration_identity(path):
+    """'|<file identity>' of a calibration file, '' without one"""
+    return f'|{file_identity(path)}' if path and os.path.exists(path) else ''
+
+
+def manifest_entry(model_dir, model_name):
+    """The manifest entry ({'file': ..., 'version': ...}) of a model, or None"""
+    path = os.path.join(model_dir, MANIFEST_FILE)
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        entry = json.load(f).get(model_name)
+    if entry is not None and 'file' not in entry:
+        raise ValueError(f"{path}: entry for {model_name} has no 'file'")
+    return entry
+
+
+def model_candidates(model_dir, model_name):
+    """Model files to try in order, and the manifest version if any"""
+    entry = manifest_entry(model_dir, model_name)
+    if entry is not None:
+        return [os.path.join(model_dir, entry['file'])], entry.get('version')
+    names = MALARIA_MODEL_FILES if model_name == 'malaria' else PNEUMONIA_MODEL_FILES
+    return [os.path.join(model_dir, name) for name in names], None
+
+
+def model_fingerprint(model_dir, model_name, backend='keras', quantization='none'):
+    """Identity of the file the loader would pick now, or None if there is none.
+
+    Cheap (manifest read plus a few stats); the model registry polls it to
+    notice new model versions.
+    """
+    sources, version = model_candidates(model_dir, model_name)
+    # (file the backend loads, source model file whose calibration applies)
+    candidates = [(path, path) for path in sources]
+    if backend != 'keras':
+        candidates = [(optimized_model_path(path, backend, quantization), path) for path in sources] + candidates
+    for path, source in candidates:
+        if os.path.exists(path):
+            return f'{version}|{file_identity(path)}{calibration_identity(calibration_path(source))}'
+    if model_name == 'pneumonia' and manifest_entry(model_dir, model_name) is None:
+        tfjs_dir = find_tfjs_model(model_dir)
+        converted_path = find_artifact(tfjs_dir, model_dir, verify_hash=False) if tfjs_dir else None
+        if converted_path:
+            # A new conversion writes a new manifest
+            manifest_path = os.path.join(os.path.dirname(converted_path), ARTIFACT_MANIFEST)
+            return f'None|{file_identity(manifest_path)}{calibration_identity(calibration_path(converted_path))}'
+    return None
+
+
+def load_optimized_model(source_path, backend, quantization, num_threads=None):
+    """Load the TFLite/ONNX export of a model if that backend was selected.
+
+    Returns (model, path); model is None when the Keras backend is selected or
+    the export does not exist.
+    """
+    if backend == 'keras':
+        return None, None
+    path = optimized_model_path(source_path, backend, quantization)
+    if not os.path.exists(path):
+        return None, path
+    logger.info(f"Loading {backend} model from {path}")
+    return load_backend(backend, path, num_threads=num_threads), path
+
+
+def load_keras_model(path, jit_compile=False, explain=False, explain_layer=None):
+    """Load a Keras model file wrapped in the compiled inference backend.
+
+    With explain, the backend also captures the activations for Grad-CAM
+    (of explain_layer, or the last convolutional layer).
+    """
+    import tensorflow as tf
+    from custom_layers import custom_objects
+
+    # Load model with custom objects to handle LayerScale layer
+    model = tf.keras.models.load_model(path, custom_objects=custom_objects, compile=False)
+    return KerasBackend(model, jit_compile=jit_compile, explain=explain, explain_layer=explain_layer)
+
+
+def load_malaria_model(model_dir, backend='keras', quantization='none', jit_compile=False, num_threads=None,
+                       explain=False, explain_layer=None):
+    """Load the malaria model with the selected backend"""
+    candidates, version = model_candidates(model_dir, 'malaria')
+    malaria_model_path = candidates[0]
+
+    model, optimized_path = load_optimized_model(malaria_model_path, backend, quantization, num_threads)
+    if model is not None:
+        logger.info(f"Malaria model loaded ({backend})")
+        return LoadedModel(model, optimized_path, version, load_calibration(malaria_model_path, 'malaria'))
+
+    if not os.path.exists(malaria_model_path):
+        raise FileNotFoundError(f"Malaria model not found at {malaria_model_path}")
+
+    if optimized_path:
+        logger.warning(
+            f"{backend} export not found at {optimized_path}, using Keras model. "
+            "Create it with: python export_optimized.py --model malaria"
+        )
+    logger.info(f"Loading malaria model from {malaria_model_path}")
+    loaded = LoadedModel(
+        load_keras_model(malaria_model_path, jit_compile, explain, explain_layer), malaria_model_path, version,
+        load_calibration(malaria_model_path, 'malaria'),
+    )
+    logger.info("Malaria model loaded")
+    return loaded
+
+
+def find_tfjs_model(model_dir):
+    """First pneumonia TFJS export directory that has a model.json"""
+    for name in PNEUMONIA_TFJS_DIRS:
+        tfjs_path = os.path.join(model_dir, name)
+        if os.path.exists(os.path.join(tfjs_path, 'model.json')):
+            return tfjs_path
+    return None
+
+
+def load_pneumonia_model(model_dir, backend='keras', quantization='none', jit_compile=False, num_threads=None,
+                         explain=False, explain_layer=None):
+    """Load the pneumonia model: optimized export, then .h5, then the TFJS conversion"""
+    pneumonia_model_paths, version = model_candidates(model_dir, 'pneumonia')
+
+    # Last resort: the verified conversion of the TFJS export, if the
+    # deployment ran convert_tfjs_to_keras.py for the current source. A
+    # manifest entry pins the file, so there is no fallback.
+    pinned = manifest_entry(model_dir, 'pneumonia') is not None
+    tfjs_model_found = None if pinned else find_tfjs_model(model_dir)
+    converted_path = find_artifact(tfjs_model_found, model_dir) if tfjs_model_found else None
+    sources = pneumonia_model_paths + ([converted_path] if converted_path else [])
+
+    # Prefer the selected TFLite/ONNX export of either .h5 file (or the conversion)
+    if backend != 'keras':
+        for model_path in sources:
+            model, optimized_path = load_optimized_model(model_path, backend, quantization, num_threads)
+            if model is not None:
+                logger.info(f"Pneumonia model loaded ({backend})")
+                return LoadedModel(model, optimized_path, version, load_calibration(model_path, 'pneumonia'))
+        logger.warning(
+            f"No {backend} export of the pneumonia model found, using Keras model. "
+            "Create it with: python export_optimized.py --model pneumonia"
+        )
+
+    for model_path in pneumonia_model_paths:
+        if os.path.exists(model_path):
+            logger.info(f"Loading pneumonia model from {model_path}")
+            try:
+                loaded = LoadedModel(
+                    load_keras_model(model_path, jit_compile, explain, explain_layer), model_path, version,
+                    load_calibration(model_path, 'pneumonia'),
+                )
+                logger.info("Pneumonia model loaded")
+                return loaded
+            except Exception as load_error:
+                logger.exception(f"Error loading model from {model_path}: {str(load_error)}")
+                continue
+
+    if converted_path:
+        logger.info(f"Loading pneumonia model converted from {tfjs_model_found}: {converted_path}", extra={
+            'fields': {'tfjs_dir': tfjs_model_found, 'artifact': converted_path},
+        })
+        loaded = LoadedModel(
+            load_keras_model(converted_path, jit_compile, explain, explain_layer), converted_path,
+            calibration=load_calibration(converted_path, 'pneumonia'),
+        )
+        logger.info("Pneumonia model loaded")
+        return loaded
+
+    checked = [f"{path}: {'exists' if os.path.exists(path) else 'not found'}" for path in pneumonia_model_paths]
+    if tfjs_model_found:
+        logger.error(
+            f"Pneumonia model not available. Checked: {'; '.join(checked)}. The TFJS model at {tfjs_model_found} "
+            "has not been converted (or changed since the last conversion). Convert it as part of the "
+            "deployment (cd python-service && python convert_tfjs_to_keras.py) and restart this service.",
+            extra={'fields': {'model': 'pneumonia', 'tfjs_dir': tfjs_model_found, 'converted': False}},
+        )
+    else:
+        tfjs_paths = [os.path.join(model_dir, name) for name in PNEUMONIA_TFJS_DIRS]
+        logger.error(
+            f"Pneumonia model not available. Checked: {'; '.join(checked)}. No TFJS model found in "
+            f"{model_dir} (checked {', '.join(tfjs_paths)}).",
+            extra={'fields': {'model': 'pneumonia', 'model_dir': model_dir}},
+        )
+
+    raise FileNotFoundError(f"Pneumonia model not available (no model file found in {model_dir})")
@@ -0,0 +1,291 @@
+"""
+Model registry with background loading and hot swap.
+
+Models are registered with a loader callable and loaded concurrently in
+background threads, so the service can start listening immediately and
+report per-model readiness (pending / loading / ready / failed) from /health.
+Models registered as lazy are loaded on first use instead of at startup.
+
+Models registered with a ``source`` callable (a cheap fingerprint of the
+files the loader would pick, see model_loading.model_fingerprint) are watched:
+when the fingerprint changes, the new version is loaded and warmed up in the
+background while the current one keeps serving, then swapped in atomically.
+Requests hold on to the ModelVersion they started with, so a swap never
+changes the model under a request in flight. The previous version is dropped
+(or kept for requests that pin it, up to ``retain_versions``) and its memory
+is released once the last request using it finishes.
+"""
+
+import gc
+import logging
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from service_logging import SERVICE_LOGGER
+
+logger = logging.getLogger(SERVICE_LOGGER)
+
+
+class UnknownModelVersion(LookupError):
+    """A request pinned a model version that is not loaded"""
+
+    def __init__(self, name, version, available):
+        super().__init__(
+            f"{name.capitalize()} model version '{version}' is not loaded "
+            f"(available: {', '.join(available) or 'none'})"
+        )
+        self.available = available
+
+
+class ModelVersion:
+    """One loaded version of a model"""
+    __slots__ = ('name', 'version', 'model', 'model_id', 'path', 'calibration')
+
+    def __init__(self, name, loaded):
+        self.name = name
+        self.version = loaded.version
+        self.model = loaded.model
+        self.model_id = loaded.model_id
+        self.path = loaded.path
+        # How results are read from the outputs (calibration.py)
+        self.calibration = loaded.calibration
+
+    @property
+    def explainable(self):
+        """True if the backend captures activations for Grad-CAM (see explain.py)"""
+        return getattr(self.model, 'gradcam', None) is not None
+
+
+class ModelEntry:
+    """Load state and loaded versions of one registered model"""
+
+    def __init__(self, name, loader, lazy=False, warmup_batch_sizes=(), source=None):
+        self.name = name
+        self.loader = loader
+        self.lazy = lazy
+        self.warmup_batch_sizes = tuple(warmup_batch_sizes)
+        self.source = source
+
+        self.state = 'pending'
+        self.current = None
+        # Earlier versions kept for pinned requests: version -> ModelVersion, oldest first
+        self.retained = OrderedDict()
+        self.fingerprint = None
+        self.reloading = False
+        self.swaps = 0
+        self.error = None
+        self.load_seconds = None
+        self.future = None
+
+    def versions(self):
+        """Loaded versions, current first"""
+        current = [self.current.version] if self.current is not None else []
+        return current + list(reversed(self.retained))
+
+    def status(self):
+        current = self.current
+        return {
+            'state': self.state,
+            'lazy': self.lazy,
+            'version': current.version if current is not None else None,
+            'versions': self.versions(),
+            'backend': getattr(current.model, 'name', None) if current is not None else None,
+            'path': current.path if current is not None else None,
+            'calibration': current.calibration.summary() if current is not None and current.calibration else None,
+            'load_seconds': round(self.load_seconds, 3) if self.load_seconds is not None else None,
+            'reloading': self.reloading,
+            'swaps': self.swaps,
+            'error': self.error,
+        }
+
+
+class ModelRegistry:
+    """Loads registered models concurrently, hands them out once ready and
+    swaps in new versions without downtime"""
+
+    def __init__(self, max_workers=None, retain_versions=0):
+        self._entries = {}
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='model-loader')
+        self.retain_versions = max(0, int(retain_versions))
+        self._watcher = None
+
+    def register(self, name, loader, lazy=False, warmup_batch_sizes=(), source=None):
+        """Register a loader returning a LoadedModel (see model_loading.py).
+
+        source, if given, returns a fingerprint of what the loader would load
+        now; watch() reloads the model when it changes.
+        """
+        with self._lock:
+            self._entries[name] = ModelEntry(name, loader, lazy, warmup_batch_sizes, source)
+
+    def start(self):
+        """Start loading every non-lazy model in the background"""
+        for entry in list(self._entries.values()):
+            if not entry.lazy:
+                self._ensure_loading(entry)
+
+    def _ensure_loading(self, entry):
+        with self._lock:
+            if entry.future is None:
+                entry.state = 'loading'
+                entry.future = self._executor.submit(self._load, entry)
+            return entry.future
+
+    @staticmethod
+    def _fingerprint(entry):
+        if entry.source is None:
+            return None
+        try:
+            return entry.source()
+        except Exception as e:
+            logger.warning(f"Could not check the {entry.name} model files: {str(e)}", extra={'fields': {
+                'model': entry.name,
+            }})
+            return None
+
+    def _load(self, entry):
+        start = time.perf_counter()
+        # Taken before loading: if the files change mid-load, the next check
+        # sees a different fingerprint and loads them again
+        fingerprint = self._fingerprint(entry)
+        try:
+            loaded = entry.loader()
+            if entry.warmup_batch_sizes:
+                warmup_start = time.perf_counter()
+                loaded.model.warmup(entry.warmup_batch_sizes)
+                warmup_seconds = time.perf_counter() - warmup_start
+                logger.info(f"Warmed up {entry.name} model in {warmup_seconds:.1f}s", extra={'fields': {
+                    'model': entry.name, 'warmup_seconds': round(warmup_seconds, 3),
+                }})
+        except Exception as e:
+            logger.exception(f"Error loading {entry.name} model: {str(e)}", extra={'fields': {
+                'model': entry.name, 'serving_version': entry.current.version if entry.current else None,
+            }})
+            with self._lock:
+                # Not retried until the files change again; a loaded version
+                # keeps serving
+                entry.fingerprint = fingerprint
+                entry.error = str(e)
+                entry.load_seconds = time.perf_counter() - start
+                entry.reloading = False
+                if entry.current is None:
+                    entry.state = 'failed'
+            return
+
+        new = ModelVersion(entry.name, loaded)
+        with self._lock:
+            previous = entry.current
+            entry.current = new
+            entry.retained.pop(new.version, None)
+            if previous is not None and previous.version != new.version and self.retain_versions:
+                entry.retained[previous.version] = previous
+                while len(entry.retained) > self.retain_versions:
+                    entry.retained.popitem(last=False)
+            entry.fingerprint = fingerprint
+            entry.error = None
+            entry.load_seconds = time.perf_counter() - start
+            entry.reloading = False
+            entry.state = 'ready'
+            if previous is not None:
+                entry.swaps += 1
+
+        if previous is not None:
+            logger.info(f"Swapped {entry.name} model {previous.version} -> {new.version}", extra={'fields': {
+                'model': entry.name, 'previous_version': previous.version, 'version': new.version,
+                'load_seconds': round(entry.load_seconds, 3),
+            }})
+            # Drop the registry's reference; the old graph is freed once the
+            # requests still holding it finish
+            del previous
+            gc.collect()
+
+    def reload(self, name):
+        """Load a model again in the background; its current version keeps
+        serving until the new one is ready and warmed up"""
+        entry = self._entries[name]
+        with self._lock:
+            if entry.future is not None and not entry.future.done():
+                return entry.future
+            if entry.current is not None:
+                entry.reloading = True
+            else:
+                entry.state = 'loading'
+            entry.future = self._executor.submit(self._load, entry)
+            return entry.future
+
+    def watch(self, interval):
+        """Check every model's source fingerprint every `interval` seconds and
+        reload the ones that changed. A non-positive interval disables it."""
+        if interval <= 0 or self._watcher is not None:
+            return
+        self._watcher = threading.Thread(target=self._watch, args=(interval,), name='model-watcher', daemon=True)
+        self._watcher.start()
+
+    def _watch(self, interval):
+        while True:
+            time.sleep(interval)
+            for entry in list(self._entries.values()):
+                # Skip models never loaded (lazy) and loads in progress
+                if entry.future is None or not entry.future.done():
+                    continue
+                fingerprint = self._fingerprint(entry)
+                if fingerprint is not None and fingerprint != entry.fingerprint:
+                    logger.info(f"Model files for {entry.name} changed; loading the new version", extra={'fields': {
+                        'model': entry.name,
+                        'serving_version': entry.current.version if entry.current else None,
+                    }})
+                    self.reload(entry.name)
+
+    def acquire(self, name, version=None):
+        """The ModelVersion to serve a request with: the current version, or
+        the pinned one.
+
+        Returns None while the model is not ready; lazy models are loaded on
+        first use and the caller waits for the load. Raises
+        UnknownModelVersion for a pinned version that is not loaded.
+        """
+        entry = self._entries.get(name)
+        if entry is None:
+            return None
+        if entry.current is None and entry.lazy:
+            self._ensure_loading(entry).result()
+        with self._lock:
+            current = entry.current
+            if current is None:
+                return None
+            if version is None or version == current.version:
+                return current
+            if version in entry.retained:
+                return entry.retained[version]
+            raise UnknownModelVersion(name, version, entry.versions())
+
+    def get(self, name):
+        """The current model backend, or None if it is still loading or failed"""
+        current = self.acquire(name)
+        return current.model if current is not None else None
+
+    def state(self, name):
+        entry = self._entries.get(name)
+        return entry.state if entry is not None else None
+
+    def model_id(self, name):
+        entry = self._entries.get(name)
+        current = entry.current if entry is not None else None
+        return current.model_id if current is not None else None
+
+    def wait(self, timeout=None):
+        """Block until every started load has finished (for tools and benchmarks)"""
+        futures = [entry.future for entry in self._entries.values() if entry.future is not None]
+        for future in futures:
+            future.result(timeout=timeout)
+
+    @property
+    def loading(self):
+        return any(entry.state == 'loading' for entry in self._entries.values())
+
+    def status(self):
+        with self._lock:
+            return {name: entry.status() for name, entry in self._entries.items()}
@@ -0,0 +1,205 @@
+"""
+Content-addressed cache of raw model outputs.
+
+Re-uploads of the same X-ray or smear (retries, history re-analysis, several
+staff opening the same study) skip preprocessing and inference entirely. The
+key is a fast hash of the raw upload bytes combined with the model identity,
+preprocessing.PREPROCESSING_VERSION, the draft size and the preprocessing
+flags, so a new model file or different preprocessing never serves a stale
+result.
+
+The in-memory tier is an LRU bounded by entry count and TTL. An optional disk
+tier (one small .npy file per entry) survives restarts; disk hits are promoted
+back into memory.
+"""
+
+import hashlib
+import logging
+import os
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+from preprocessing import DRAFT_SIZE, PREPROCESSING_VERSION
+from service_logging import SERVICE_LOGGER
+
+logger = logging.getLogger(SERVICE_LOGGER)
+
+
+def file_identity(path):
+    """Cheap identity for a model file: name, size and modification time"""
+    st = os.stat(path)
+    return f'{os.path.basename(path)}:{st.st_size}:{st.st_mtime_ns}'
+
+
+class PredictionCache:
+    """Thread-safe LRU + TTL cache of model output rows with an optional disk tier"""
+
+    # Prune the disk tier after this many writes
+    DISK_PRUNE_INTERVAL = 1000
+
+    def __init__(self, max_entries=1024, ttl_seconds=3600, disk_dir=None, disk_max_entries=100000):
+        self.max_entries = max(0, int(max_entries))
+        self.ttl = float(ttl_seconds) if ttl_seconds else None
+        self.disk_dir = disk_dir or None
+        self.disk_max_entries = int(disk_max_entries)
+
+        self._entries = OrderedDict()  # key -> (stored_at, value)
+        self._lock = threading.Lock()
+        self._disk_writes = 0
+
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+        if self.disk_dir:
+            os.makedirs(self.disk_dir, exist_ok=True)
+
+    @property
+    def enabled(self):
+        return self.max_entries > 0
+
+    @staticmethod
+    def make_key(image_bytes, model_name, model_id, **flags):
+        """Hash the upload bytes together with the model identity, the
+        preprocessing version and draft size, and the preprocessing flags"""
+        digest = hashlib.blake2b(image_bytes, digest_size=16)
+        digest.update(f'|{model_name}|{model_id}|preprocessing={PREPROCESSING_VERSION}|draft={DRAFT_SIZE}'.encode())
+        for name in sorted(flags):
+            digest.update(f'|{name}={flags[name]}'.encode())
+        return digest.hexdigest()
+
+    def _expired(self, stored_at):
+        return self.ttl is not None and time.time() - stored_at > self.ttl
+
+    def get(self, key):
+        """Return the cached output row for key, or None"""
+        if not self.enabled:
+            return None
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                stored_at, value = entry
+                if not self._expired(stored_at):
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._entries[key]
+                self.expirations += 1
+
+        value = self._disk_get(key)
+        with self._lock:
+            if value is None:
+                self.misses += 1
+                return None
+            self.disk_hits += 1
+            self._store(key, value[1], stored_at=value[0])
+        return value[1]
+
+    def put(self, key, value):
+        """Cache an output row (copied, so callers may reuse their buffer)"""
+        if not self.enabled:
+            return
+        value = np.array(value, copy=True)
+        value.setflags(write=False)
+        with self._lock:
+            self._store(key, value, stored_at=time.time())
+        self._disk_put(key, value)
+
+    def _store(self, key, value, stored_at):
+        self._entries[key] = (stored_at, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    # Disk tier
+
+    def _disk_path(self, key):
+        return os.path.join(self.disk_dir, key[:2], f'{key}.npy')
+
+    def _disk_get(self, key):
+        if not self.disk_dir:
+            return None
+        path = self._disk_path(key)
+        try:
+            stored_at = os.path.getmtime(path)
+            if self._expired(stored_at):
+                os.remove(path)
+                with self._lock:
+                    self.expirations += 1
+                return None
+            value = np.load(path, allow_pickle=False)
+        except (OSError, ValueError):
+            return None
+        value.setflags(write=False)
+        return stored_at, value
+
+    def _disk_put(self, key, value):
+        if not self.disk_dir:
+            return
+        path = self._disk_path(key)
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            # Write to a temp file and rename so readers never see a partial file
+            fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+            with os.fdopen(fd, 'wb') as f:
+                np.save(f, value, allow_pickle=False)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            logger.warning(f"Could not write prediction cache entry: {str(e)}", extra={'fields': {'path': path}})
+            return
+
+        with self._lock:
+            self._disk_writes += 1
+            prune = self._disk_writes % self.DISK_PRUNE_INTERVAL == 0
+        if prune:
+            self._disk_prune()
+
+    def _disk_prune(self):
+        """Drop expired entries and the oldest ones beyond disk_max_entries"""
+        files = []
+        for root, _, names in os.walk(self.disk_dir):
+            for name in names:
+                if name.endswith('.npy'):
+                    path = os.path.join(root, name)
+                    try:
+                        files.append((os.path.getmtime(path), path))
+                    except OSError:
+                        continue
+        files.sort()
+        excess = max(0, len(files) - self.disk_max_entries)
+        removed = 0
+        for index, (stored_at, path) in enumerate(files):
+            if index >= excess and not self._expired(stored_at):
+                break
+            try:
+                os.remove(path)
+                removed += 1
+            except OSError:
+                pass
+        with self._lock:
+            self.evictions += removed
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.disk_hits + self.misses
+            return {
+                'enabled': self.enabled,
+                'entries': len(self._entries),
+                'max_entries': self.max_entries,
+                'ttl_seconds': self.ttl,
+                'disk_dir': self.disk_dir,
+                'hits': self.hits,
+                'disk_hits': self.disk_hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'expirations': self.expirations,
+                'hit_rate': round((self.hits + self.disk_hits) / lookups, 4) if lookups else 0.0,
+            }
@@ -0,0 +1,220 @@
+"""
+Preprocessing worker pool.
+
+Moves image decode, contrast enhancement and resize off the request thread so
+that preprocessing of one image overlaps with inference on another.
+
+Modes:
+- ``thread``: a thread pool. PIL releases the GIL while decoding and
+  resampling, so this scales reasonably and has no startup cost.
+- ``process``: a process pool that scales across all cores. Workers write the
+  resized uint8 plane straight into a shared-memory slot, so output tensors are
+  never pickled; only the upload bytes are sent to the worker.
+- ``inline``: preprocess on the calling thread (no pool).
+
+Test-time augmentation views (submit_views) are returned by value from
+process workers; they are only built for requests that ask for them.
+"""
+
+import atexit
+import logging
+import mmap
+import multiprocessing
+import os
+import queue
+import sys
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from preprocessing import IMAGE_SIZE, decode_plane, decode_views, to_model_input
+from service_logging import SERVICE_LOGGER
+
+logger = logging.getLogger(SERVICE_LOGGER)
+
+PLANE_SHAPE = (IMAGE_SIZE, IMAGE_SIZE)
+PLANE_BYTES = IMAGE_SIZE * IMAGE_SIZE
+
+# Shared-memory block attached once per worker process
+_worker_slots = None
+
+
+def _attach_slots(shm_name, slot_count):
+    global _worker_slots
+    shm = shared_memory.SharedMemory(name=shm_name)
+    _worker_slots = (shm, np.ndarray((slot_count,) + PLANE_SHAPE, dtype=np.uint8, buffer=shm.buf))
+
+
+def _decode_into_slot(image_bytes, enhance_contrast, slot):
+    """Worker-side task: decode an image into its shared-memory slot; returns step timings"""
+    timings = {}
+    _worker_slots[1][slot] = decode_plane(image_bytes, enhance_contrast=enhance_contrast, timings=timings)
+    return timings
+
+
+def _decode_views(image_bytes, views, enhance_contrast):
+    """Worker-side task: the augmented planes of an image and the step timings"""
+    timings = {}
+    planes = decode_views(image_bytes, views, enhance_contrast=enhance_contrast, timings=timings)
+    return planes, timings
+
+
+class PreprocessPool:
+    """Runs decode_plane off the request thread and returns model-ready arrays"""
+
+    MODES = ('thread', 'process', 'inline')
+
+    def __init__(self, mode='thread', workers=None):
+        if mode not in self.MODES:
+            raise ValueError(f"Unknown preprocessing pool mode '{mode}' (expected one of {', '.join(self.MODES)})")
+        self.mode = mode
+        self.workers = max(1, int(workers or os.cpu_count() or 4))
+        self._executor = None
+        self._shm = None
+
+        if mode == 'thread':
+            self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='preprocess')
+        elif mode == 'process':
+            self._start_processes()
+
+        atexit.register(self.shutdown)
+
+    def _start_processes(self):
+        # Two slots per worker lets a worker start on its next image while the
+        # previous plane is still being copied out
+        slot_count = self.workers * 2
+        self._shm = shared_memory.SharedMemory(create=True, size=slot_count * PLANE_BYTES)
+        self._slots = np.ndarray((slot_count,) + PLANE_SHAPE, dtype=np.uint8, buffer=self._shm.buf)
+        self._free_slots = queue.Queue()
+        for slot in range(slot_count):
+            self._free_slots.put(slot)
+
+        # Workers only need PIL and numpy. Fork where available so they don't
+        # re-import the service (and its models); the pool must be created
+        # before TensorFlow is imported, or every worker inherits its runtime
+        # and the state of its threads.
+        method = 'fork' if 'fork' in multiprocessing.get_all_start_methods() else 'spawn'
+        if method == 'fork' and 'tensorflow' in sys.modules:
+            logger.warning(
+                "Preprocessing workers forked after TensorFlow was imported; create the pool before loading models",
+                extra={'fields': {'workers': self.workers}},
+            )
+        self._executor = ProcessPoolExecutor(
+            max_workers=self.workers,
+            mp_context=multiprocessing.get_context(method),
+            initializer=_attach_slots,
+            initargs=(self._shm.name, slot_count),
+        )
+        # Start every worker now rather than on the first request
+        for future in [self._executor.submit(os.getpid) for _ in range(self.workers)]:
+            future.result()
+
+    def submit_plane(self, image_bytes, enhance_contrast=True, timings=None):
+        """Return a Future for the uint8 (224, 224) plane of an image.
+
+        A timings dict, if given, receives the per-step seconds of
+        decode_plane before the future completes.
+        """
+        if self.mode == 'thread':
+            return self._executor.submit(decode_plane, image_bytes, enhance_contrast, timings=timings)
+
+        if self.mode == 'inline':
+            future = Future()
+            try:
+                future.set_result(decode_plane(image_bytes, enhance_contrast, timings=timings))
+            except Exception as e:
+                future.set_exception(e)
+            return future
+
+        # Process mode: blocks while every slot is in use, which bounds the
+        # amount of preprocessing queued ahead of inference
+        image_bytes = self._sendable(image_bytes)
+        slot = self._free_slots.get()
+        result = Future()
+
+        def _copy_out(task):
+            try:
+                task_timings = task.result()
+                if timings is not None:
+                    timings.update(task_timings)
+                result.set_result(self._slots[slot].copy())
+            except Exception as e:
+                result.set_exception(e)
+            finally:
+                self._free_slots.put(slot)
+
+        try:
+            self._executor.submit(_decode_into_slot, image_bytes, enhance_contrast, slot).add_done_callback(_copy_out)
+        except Exception:
+            self._free_slots.put(slot)
+            raise
+        return result
+
+    @staticmethod
+    def _sendable(image_bytes):
+        if isinstance(image_bytes, mmap.mmap):
+            # Spooled uploads are memory-mapped; workers get a copy of the bytes
+            return image_bytes[:]
+        return image_bytes
+
+    def submit_views(self, image_bytes, views, enhance_contrast=True, timings=None):
+        """Return a Future for the float32 (views, 224, 224, 3) test-time
+        augmentation batch of an image (see decode_views)"""
+        result = Future()
+
+        def _normalize(task):
+            try:
+                planes, task_timings = task.result()
+                if timings is not None:
+                    timings.update(task_timings)
+                result.set_result(to_model_input(planes))
+            except Exception as e:
+                result.set_exception(e)
+
+        if self.mode == 'inline':
+            task = Future()
+            try:
+                task.set_result(_decode_views(image_bytes, views, enhance_contrast))
+            except Exception as e:
+                task.set_exception(e)
+        elif self.mode == 'thread':
+            task = self._executor.submit(_decode_views, image_bytes, views, enhance_contrast)
+        else:
+            task = self._executor.submit(_decode_views, self._sendable(image_bytes), views, enhance_contrast)
+        task.add_done_callback(_normalize)
+        return result
+
+    def submit(self, image_bytes, enhance_contrast=True, timings=None):
+        """Return a Future for the float32 (1, 224, 224, 3) model input of an image"""
+        result = Future()
+
+        def _normalize(plane_future):
+            try:
+                result.set_result(to_model_input(plane_future.result()[np.newaxis]))
+            except Exception as e:
+                result.set_exception(e)
+
+        self.submit_plane(image_bytes, enhance_contrast, timings).add_done_callback(_normalize)
+        return result
+
+    def preprocess(self, image_bytes, enhance_contrast=True, timings=None):
+        """Blocking helper: preprocess one image in the pool"""
+        return self.submit(image_bytes, enhance_contrast, timings).result()
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+        if self._shm is not None:
+            # Views into the block must be released before it can be closed
+            self._slots = None
+            self._shm.close()
+            self._shm.unlink()
+            self._shm = None
+
+    def stats(self):
+        stats = {'mode': self.mode, 'workers': self.workers}
+        if self.mode == 'process' and self._shm is not None:
+            stats['free_slots'] = self._free_slots.qsize()
+        return stats
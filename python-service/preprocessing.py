@@ -0,0 +1,409 @@
+"""
+Image preprocessing for the medical models.
+
+Produces the same 224x224 contrast-stretched grayscale input as the original
+PIL -> float32 -> PIL -> RGB pipeline, with far fewer full-resolution copies:
+
+- Large JPEGs are decoded directly at reduced size (draft mode), and large
+  images of any format are box-reduced to no less than ``draft_size`` on each
+  axis before the LANCZOS resize.
+- The 2nd/98th percentiles come from the 256-bin histogram instead of
+  sorting every pixel, and the clip + stretch is applied as a lookup table on
+  the uint8 image, so the full-resolution float32 arrays are never built.
+- The grayscale plane is expanded to 3 channels with a broadcast rather than
+  an RGB conversion.
+- The header is checked before anything is decoded: images that would decode
+  to more than ``MAX_IMAGE_PIXELS`` pixels (after JPEG draft scaling) are
+  refused with ImageTooLarge, which bounds decode memory per image.
+
+decode_views() produces the test-time augmentation views (flips, crops and
+contrast variants) of one decoded image.
+
+decode_tensor() and tensor_views() take an image that the client has already
+preprocessed to the 224x224 model plane. They skip decode, contrast
+enhancement and resize, so uploads shrink to 50-150 KB and the server only
+validates and normalizes them. Accepted tensor formats are a .npy array, a
+224x224 PNG and raw uint8 bytes, either 224*224 (grayscale) or 224*224*3
+(RGB, row-major HWC).
+
+Image data may be bytes or a read-only mmap of a spooled upload (uploads.py).
+
+This module has no TensorFlow dependency so it can be used from worker
+processes.
+"""
+
+import io
+import mmap
+import os
+import time
+
+import numpy as np
+from PIL import Image
+
+IMAGE_SIZE = 224
+CHANNELS = 3
+
+# Part of every prediction cache key. Bump it whenever a change here alters
+# the model input an upload produces, so cached outputs (including the disk
+# tier, which survives restarts) computed the old way are not served.
+# 2: 16-bit images scaled to 8 bits over their own range
+PREPROCESSING_VERSION = 2
+
+# Images larger than this on an axis are reduced to about this size before
+# contrast enhancement and the final LANCZOS resize. 0 disables early
+# downscaling, which makes the output bit-identical to the original pipeline.
+DRAFT_SIZE = int(os.environ.get('PREPROCESS_DRAFT_SIZE', str(IMAGE_SIZE * 2)))
+
+# Percentiles used to clip outliers before stretching contrast
+CLIP_PERCENTILES = (2, 98)
+
+# Test-time augmentation views, in the order they are used as the view count
+# grows; the first is the plain preprocessed image
+AUGMENTATIONS = (
+    'identity', 'flip', 'crop_center', 'gamma_low', 'gamma_high',
+    'crop_top_left', 'crop_bottom_right', 'flip_crop_center',
+)
+# Crops keep this fraction of each side
+CROP_FRACTION = 0.9
+# Gamma of the contrast variants (applied to the 8-bit plane)
+AUGMENTATION_GAMMAS = {'gamma_low': 1.25, 'gamma_high': 0.8}
+
+# Largest image decoded, in pixels after JPEG draft scaling. Together with the
+# bytes per pixel of the image mode this bounds decode memory per image.
+MAX_IMAGE_PIXELS = int(os.environ.get('PREPROCESS_MAX_PIXELS', '40000000'))
+
+# PIL's own decompression-bomb check runs on the full image size before JPEG
+# draft scaling could apply; the check in _open replaces it
+Image.MAX_IMAGE_PIXELS = None
+
+
+class ImageTooLarge(ValueError):
+    """The image header describes an image too large to decode"""
+
+
+class InvalidTensor(ValueError):
+    """A pre-resized upload is not a 224x224 uint8 tensor in a supported format"""
+
+
+def _as_file(image_data):
+    if isinstance(image_data, mmap.mmap):
+        image_data.seek(0)
+        return image_data
+    return io.BytesIO(image_data)
+
+
+def _open(image_data, draft_size, max_pixels=MAX_IMAGE_PIXELS):
+    """Read the image header and set up a reduced-size JPEG decode; decodes nothing"""
+    img = Image.open(_as_file(image_data))
+
+    if draft_size and img.format == 'JPEG':
+        # Decode at 1/2, 1/4 or 1/8 scale; only the luma channel is decoded
+        # when asking for 'L'
+        img.draft('L', (draft_size, draft_size))
+
+    # img.size is now the size that will actually be decoded
+    width, height = img.size
+    if max_pixels and width * height > max_pixels:
+        raise ImageTooLarge(
+            f'Image is too large to process ({width}x{height}, maximum is {max_pixels:,} pixels)'
+        )
+    return img
+
+
+def _is_wide(mode):
+    """Grayscale modes with more than 8 bits per pixel (16-bit PNG/TIFF
+    radiographs, 32-bit integer and float images)"""
+    return mode in ('I', 'F') or mode.startswith('I;16')
+
+
+def _pixel_bytes(mode):
+    """Bytes per pixel PIL uses to hold an image of this mode"""
+    if mode in ('1', 'L', 'P'):
+        return 1
+    if mode.startswith('I;16'):
+        return 2
+    return 4
+
+
+def decode_memory_bytes(img):
+    """Estimated peak memory to decode and enhance an opened image: the decoded
+    image (plus its array copy for wide grayscale modes), its 8-bit grayscale
+    conversion and the contrast-stretched copy"""
+    width, height = img.size
+    pixel_bytes = _pixel_bytes(img.mode)
+    if _is_wide(img.mode):
+        pixel_bytes *= 2
+    return width * height * (pixel_bytes + (img.mode != 'L') + 1)
+
+
+def inspect_image(image_data, draft_size=DRAFT_SIZE, max_pixels=MAX_IMAGE_PIXELS):
+    """Check an image from its header alone.
+
+    Raises ImageTooLarge (or PIL's UnidentifiedImageError) before any pixel
+    data is decoded. Returns the format, decoded size, mode and estimated
+    decode memory.
+    """
+    img = _open(image_data, draft_size, max_pixels)
+    return {
+        'format': img.format,
+        'width': img.size[0],
+        'height': img.size[1],
+        'mode': img.mode,
+        'decode_bytes': decode_memory_bytes(img),
+    }
+
+
+def _scale_to_8bit(img):
+    """Map a wide grayscale image linearly from its own min-max range to 0-255.
+
+    PIL's convert('L') clips 16-bit data at 255, which turns a 12- or 16-bit
+    radiograph into a flat white plane. The scaling is the one the original
+    pipeline applied to values above 255, computed in float32 and truncated;
+    16-bit images go through a 65536-entry lookup table instead of a
+    full-resolution float array.
+    """
+    pixels = np.asarray(img)
+    low, high = pixels.min(), pixels.max()
+    scale = np.float32(high) - np.float32(low) + np.float32(1e-7)
+
+    def to_8bit(values):
+        return ((values - np.float32(low)) / scale * np.float32(255)).astype(np.uint8)
+
+    if pixels.dtype.kind == 'u' and pixels.dtype.itemsize == 2:
+        plane = to_8bit(np.arange(65536, dtype=np.float32))[pixels]
+    else:
+        plane = to_8bit(pixels.astype(np.float32))
+    return Image.fromarray(plane, mode='L')
+
+
+def _open_grayscale(image_bytes, draft_size):
+    """Open an image as 8-bit grayscale, letting libjpeg decode large JPEGs at reduced size"""
+    img = _open(image_bytes, draft_size)
+
+    # Convert to grayscale first (medical X-rays are typically grayscale);
+    # 16-bit and other wide grayscale images are scaled to 8 bits over their
+    # own range rather than clipped
+    if _is_wide(img.mode):
+        img = _scale_to_8bit(img)
+    elif img.mode != 'L':
+        img = img.convert('L')
+    else:
+        # Decode now so decode time is not attributed to the contrast step
+        img.load()
+    return img
+
+
+def _reduce(img, draft_size):
+    """Box-reduce an image to no less than draft_size on each axis"""
+    width, height = img.size
+    factor_x = max(1, width // draft_size)
+    factor_y = max(1, height // draft_size)
+    if factor_x > 1 or factor_y > 1:
+        img = img.reduce((factor_x, factor_y))
+    return img
+
+
+def histogram_percentiles(histogram, percentiles):
+    """Percentiles of a uint8 image from its 256-bin histogram.
+
+    Matches ``np.percentile(pixels, percentiles)`` (linear interpolation)
+    without materialising or sorting the pixels.
+    """
+    cumulative = np.cumsum(histogram)
+    count = int(cumulative[-1])
+
+    values = []
+    for q in np.asarray(percentiles, dtype=np.float64) / 100:
+        virtual_index = q * (count - 1)
+        lower = int(np.floor(virtual_index))
+        upper = min(lower + 1, count - 1)
+        gamma = virtual_index - lower
+
+        # Value at sorted position k is the first bin whose cumulative count exceeds k
+        a = float(np.searchsorted(cumulative, lower, side='right'))
+        b = float(np.searchsorted(cumulative, upper, side='right'))
+
+        # Same interpolation formula as numpy's linear method
+        diff = b - a
+        values.append(a + diff * gamma if gamma < 0.5 else b - diff * (1 - gamma))
+    return values
+
+
+def contrast_lut(low, high):
+    """256-entry table mapping pixel values to the clipped, stretched 0-255 range"""
+    values = np.clip(np.arange(256, dtype=np.float32), np.float64(low), np.float64(high))
+    if high > low:
+        values = (values - low) / (high - low) * 255
+    return values.astype(np.uint8)
+
+
+def _enhanced_image(image_bytes, enhance_contrast, draft_size, timings):
+    """Decode and contrast-enhance an image, reduced to about draft_size"""
+    start = time.perf_counter()
+    img = _open_grayscale(image_bytes, draft_size)
+    decoded = time.perf_counter()
+
+    # Apply contrast enhancement for medical images: clip extreme values
+    # (remove outliers) and stretch the remaining range to 0-255. The
+    # histogram and lookup table work on uint8 data, so this costs one
+    # uint8 copy of the decoded image.
+    if enhance_contrast:
+        low, high = histogram_percentiles(img.histogram(), CLIP_PERCENTILES)
+        img = img.point(contrast_lut(low, high).tolist())
+
+    if timings is not None:
+        timings['decode'] = decoded - start
+        timings['contrast'] = time.perf_counter() - decoded
+    return img
+
+
+def _resize(img, draft_size, box=None):
+    if draft_size and box is None:
+        img = _reduce(img, draft_size)
+
+    # Resize to model input size with high-quality resampling
+    return np.asarray(img.resize((IMAGE_SIZE, IMAGE_SIZE), Image.Resampling.LANCZOS, box=box), dtype=np.uint8)
+
+
+def decode_plane(image_bytes, enhance_contrast=True, draft_size=DRAFT_SIZE, timings=None):
+    """Decode, contrast-enhance and resize an image to a uint8 (224, 224) plane.
+
+    If a timings dict is given, the seconds spent in each step are stored in
+    it under 'decode', 'contrast' and 'resize'.
+    """
+    img = _enhanced_image(image_bytes, enhance_contrast, draft_size, timings)
+    start = time.perf_counter()
+    plane = _resize(img, draft_size)
+    if timings is not None:
+        timings['resize'] = time.perf_counter() - start
+    return plane
+
+
+def _crop_box(size, name):
+    """Box of a CROP_FRACTION crop of an image of the given size"""
+    width, height = size
+    crop_width, crop_height = width * CROP_FRACTION, height * CROP_FRACTION
+    if name.endswith('center'):
+        left, top = (width - crop_width) / 2, (height - crop_height) / 2
+    elif name.endswith('top_left'):
+        left, top = 0, 0
+    else:
+        left, top = width - crop_width, height - crop_height
+    return (left, top, left + crop_width, top + crop_height)
+
+
+def decode_views(image_bytes, views, enhance_contrast=True, draft_size=DRAFT_SIZE, timings=None):
+    """Decode an image once and return its first ``views`` augmentations.
+
+    Returns a uint8 (views, 224, 224) array; view 0 equals decode_plane().
+    Crops are resampled from the decoded image, flips and gamma variants are
+    derived from the resized planes. Timings are stored as in decode_plane,
+    plus 'augment' for the views after the first.
+    """
+    img = _enhanced_image(image_bytes, enhance_contrast, draft_size, timings)
+    if draft_size:
+        img = _reduce(img, draft_size)
+    return _augment(img, views, timings)
+
+
+def _augment(img, views, timings):
+    """The first ``views`` augmentations of a decoded, enhanced image"""
+    names = AUGMENTATIONS[:max(1, min(int(views), len(AUGMENTATIONS)))]
+    start = time.perf_counter()
+    planes = np.empty((len(names), IMAGE_SIZE, IMAGE_SIZE), dtype=np.uint8)
+    planes[0] = _resize(img, 0)
+    resized = time.perf_counter()
+
+    by_name = {'identity': planes[0]}
+    for index, name in enumerate(names[1:], start=1):
+        if name.startswith('crop'):
+            planes[index] = _resize(img, 0, box=_crop_box(img.size, name))
+        elif name.startswith('flip'):
+            # Mirror of an earlier view: 'flip' of identity, 'flip_<view>' of <view>
+            planes[index] = by_name[name[len('flip_'):] or 'identity'][:, ::-1]
+        else:
+            gamma = AUGMENTATION_GAMMAS[name]
+            lut = (255 * (np.arange(256) / 255) ** gamma).round().astype(np.uint8)
+            planes[index] = lut[planes[0]]
+        by_name[name] = planes[index]
+
+    if timings is not None:
+        timings['resize'] = resized - start
+        timings['augment'] = time.perf_counter() - resized
+    return planes
+
+
+_NPY_MAGIC = b'\x93NUMPY'
+_PNG_MAGIC = b'\x89PNG\r\n\x1a\n'
+_TENSOR_SHAPES = {(IMAGE_SIZE, IMAGE_SIZE): 'L', (IMAGE_SIZE, IMAGE_SIZE, 1): 'L', (IMAGE_SIZE, IMAGE_SIZE, 3): 'RGB'}
+
+
+def _tensor_plane(array):
+    """uint8 (224, 224) plane of a grayscale or RGB uint8 array"""
+    if array.ndim in (3, 4) and array.shape[0] == 1 and array.shape[1:] in _TENSOR_SHAPES:
+        array = array[0]
+    mode = _TENSOR_SHAPES.get(array.shape)
+    if mode is None:
+        raise InvalidTensor(
+            f'Tensor shape must be ({IMAGE_SIZE}, {IMAGE_SIZE}) or ({IMAGE_SIZE}, {IMAGE_SIZE}, 3), got {array.shape}'
+        )
+    if array.dtype != np.uint8:
+        raise InvalidTensor(f'Tensor dtype must be uint8, got {array.dtype}')
+    if mode == 'RGB':
+        # Same luma weights as the image path's convert('L')
+        return np.asarray(Image.fromarray(np.ascontiguousarray(array), 'RGB').convert('L'))
+    return array.reshape(IMAGE_SIZE, IMAGE_SIZE)
+
+
+def decode_tensor(data, timings=None):
+    """uint8 (224, 224) plane of a pre-resized upload (.npy, 224x224 PNG or raw bytes).
+
+    Raises InvalidTensor for anything else. If a timings dict is given, the
+    seconds spent are stored under 'decode'.
+    """
+    start = time.perf_counter()
+    head = bytes(data[:8])
+    if head.startswith(_NPY_MAGIC):
+        try:
+            array = np.load(_as_file(data), allow_pickle=False)
+        except (ValueError, EOFError) as e:
+            raise InvalidTensor(f'Invalid .npy tensor: {str(e)}') from e
+    elif head == _PNG_MAGIC:
+        img = Image.open(_as_file(data))
+        if img.size != (IMAGE_SIZE, IMAGE_SIZE):
+            raise InvalidTensor(f'Tensor PNG must be {IMAGE_SIZE}x{IMAGE_SIZE}, got {img.size[0]}x{img.size[1]}')
+        if img.mode not in ('L', 'RGB'):
+            raise InvalidTensor(f'Tensor PNG must be 8-bit grayscale or RGB, got mode {img.mode}')
+        array = np.asarray(img)
+    elif len(data) == IMAGE_SIZE * IMAGE_SIZE:
+        array = np.frombuffer(data, dtype=np.uint8).reshape(IMAGE_SIZE, IMAGE_SIZE)
+    elif len(data) == IMAGE_SIZE * IMAGE_SIZE * 3:
+        array = np.frombuffer(data, dtype=np.uint8).reshape(IMAGE_SIZE, IMAGE_SIZE, 3)
+    else:
+        raise InvalidTensor(
+            f'Tensor must be a .npy array, a {IMAGE_SIZE}x{IMAGE_SIZE} PNG or {IMAGE_SIZE * IMAGE_SIZE} '
+            f'(grayscale) or {IMAGE_SIZE * IMAGE_SIZE * 3} (RGB) raw bytes, got {len(data)} bytes'
+        )
+    plane = _tensor_plane(array)
+    if timings is not None:
+        timings['decode'] = time.perf_counter() - start
+    return plane
+
+
+def tensor_views(data, views, timings=None):
+    """decode_views() for a pre-resized upload: the augmentations of its plane"""
+    plane = decode_tensor(data, timings)
+    return _augment(Image.fromarray(plane), views, timings)
+
+
+def to_model_input(planes):
+    """Normalize uint8 (n, 224, 224) planes to a float32 (n, 224, 224, 3) batch in [0, 1]"""
+    batch = planes.astype(np.float32)[..., np.newaxis] / 255.0
+    # The model expects 3 identical channels; broadcast instead of copying
+    return np.broadcast_to(batch, batch.shape[:-1] + (CHANNELS,))
+
+
+def preprocess_image(image_bytes, enhance_contrast=True, draft_size=DRAFT_SIZE):
+    """Preprocess image for model input with enhanced handling for medical images"""
+    plane = decode_plane(image_bytes, enhance_contrast=enhance_contrast, draft_size=draft_size)
+    return to_model_input(plane[np.newaxis])
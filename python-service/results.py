@@ -0,0 +1,206 @@
+"""
+Turn raw model output rows into result payloads.
+
+Shared by the Flask endpoints and the offline bulk scorer (score_archive.py)
+so both interpret model outputs the same way. malaria_results() and
+pneumonia_results() take a whole (n, k) batch of output rows and the
+model's Calibration (calibration.py). The probabilities, thresholds and
+outcomes are computed as arrays; only the payload dicts are built per row.
+A batch of one, the single-image hot path, is decided with Python scalars
+(Calibration.decide_row) instead, since array setup would dominate its cost.
+
+The messages and recommendation lists only depend on the outcome, so they are
+built once here and every result refers to the same objects. Compact results
+(compact=True) leave them out and carry an outcome code plus the
+probabilities only.
+"""
+
+import logging
+
+import numpy as np
+
+from calibration import DEFAULT_CALIBRATIONS
+from service_logging import SERVICE_LOGGER
+
+logger = logging.getLogger(SERVICE_LOGGER)
+
+# Static payload per malaria outcome code
+MALARIA_OUTCOMES = {
+    'parasitized': {
+        'prediction': 'Parasitized',
+        'message': 'Malaria parasites have been detected in the blood smear image. Please consult with a healthcare professional immediately for proper diagnosis and treatment.',
+        'recommendations': (
+            'Seek immediate medical attention',
+            'Get a proper laboratory test for confirmation',
+            "Follow your healthcare provider's treatment recommendations",
+            'Monitor symptoms closely',
+            'Complete the full course of treatment if prescribed',
+        ),
+    },
+    'uninfected': {
+        'prediction': 'Uninfected',
+        'message': 'No malaria parasites detected in the blood smear image. The sample appears to be uninfected. However, this is a preliminary analysis and should be confirmed by a medical professional.',
+        'recommendations': (
+            'Continue regular health monitoring',
+            'If experiencing symptoms, consult a healthcare professional',
+            'Consider preventive measures if in a malaria-endemic area',
+            'Keep the image for medical records',
+        ),
+    },
+}
+
+# Pneumonia outcome code -> label. The message follows the uncertainty of the
+# prediction and the recommendations follow the thresholded class, so they
+# are looked up separately. Outcomes are indexed 0 (normal), 1 (pneumonia)
+# and 2 (uncertain) in pneumonia_results().
+PNEUMONIA_LABELS = {
+    'pneumonia': 'Pneumonia',
+    'normal': 'Normal',
+    'uncertain': 'Uncertain - Recommend professional review',
+}
+PNEUMONIA_MESSAGES = {
+    'pneumonia': 'Pneumonia-like patterns have been detected in the chest X-ray image. Please consult with a healthcare professional immediately for proper diagnosis and treatment. This is a preliminary analysis and should be confirmed by a licensed radiologist.',
+    'normal': 'No obvious signs of pneumonia detected in the chest X-ray image. The X-ray appears normal. However, this is a preliminary analysis and should be confirmed by a licensed radiologist for accurate diagnosis.',
+    'uncertain': 'Uncertain prediction - The model probabilities are very close, indicating low confidence. Please have this X-ray reviewed by a licensed radiologist for accurate diagnosis.',
+}
+PNEUMONIA_RECOMMENDATIONS = {
+    'pneumonia': (
+        'Seek immediate medical attention',
+        'Consult with a pulmonologist or radiologist for proper diagnosis',
+        "Follow your healthcare provider's treatment recommendations",
+        'Monitor respiratory symptoms closely',
+        'Complete the full course of treatment if prescribed',
+        'Get follow-up X-rays as recommended by your doctor',
+    ),
+    'normal': (
+        'Continue regular health monitoring',
+        'If experiencing respiratory symptoms, consult a healthcare professional',
+        'Consider preventive measures during flu season',
+        'Keep the X-ray for medical records',
+        'Follow up with your healthcare provider if symptoms persist',
+    ),
+}
+
+
+def _malaria_result(is_parasitized, confidence, parasitized, uninfected, compact):
+    if compact:
+        return {
+            'prediction': 'parasitized' if is_parasitized else 'uninfected',
+            'confidence': confidence,
+            'probabilities': {'parasitized': parasitized, 'uninfected': uninfected},
+        }
+    outcome = MALARIA_OUTCOMES['parasitized' if is_parasitized else 'uninfected']
+    return {
+        'prediction': outcome['prediction'],
+        'confidence': confidence,
+        'message': outcome['message'],
+        'recommendations': outcome['recommendations'],
+    }
+
+
+def malaria_results(outputs, compact=False, calibration=None):
+    """Result payloads for (n, k) malaria model output rows, one per row"""
+    calibration = calibration or DEFAULT_CALIBRATIONS['malaria']
+    outputs = np.asarray(outputs)
+    if len(outputs) == 1:
+        # Single image: scalar decision, no array setup
+        parasitized, uninfected, is_parasitized, _ = calibration.decide_row(outputs[0])
+        confidence = parasitized if is_parasitized else uninfected
+        return [_malaria_result(is_parasitized, confidence, parasitized, uninfected, compact)]
+
+    parasitized, uninfected, is_parasitized, _ = calibration.decide(outputs)
+    confidence = np.where(is_parasitized, parasitized, uninfected).tolist()
+    return [
+        _malaria_result(positive, row_confidence, p, u, compact)
+        for positive, row_confidence, p, u in zip(
+            is_parasitized.tolist(), confidence, parasitized.tolist(), uninfected.tolist(),
+        )
+    ]
+
+
+_PNEUMONIA_CODES = ('normal', 'pneumonia', 'uncertain')
+
+
+def _log_pneumonia_row(row, pneumonia, code, uncertain, calibration):
+    logger.debug('Pneumonia prediction', extra={'fields': {
+        'raw_prediction': np.atleast_1d(row).tolist(),
+        'pneumonia_prob': round(float(pneumonia), 4),
+        'threshold': calibration.threshold,
+        'temperature': calibration.temperature,
+        'outcome': _PNEUMONIA_CODES[code],
+        'uncertain': bool(uncertain),
+    }})
+
+
+def _pneumonia_result(code, confidence, pneumonia, normal, uncertain, positive, raw, threshold, compact):
+    if compact:
+        return {
+            'prediction': _PNEUMONIA_CODES[code],
+            'confidence': confidence,
+            'probabilities': {'pneumonia': pneumonia, 'normal': normal},
+            'uncertain': uncertain,
+        }
+    return {
+        'prediction': PNEUMONIA_LABELS[_PNEUMONIA_CODES[code]],
+        'confidence': confidence,
+        'probabilities': {'pneumonia': pneumonia, 'normal': normal},
+        'uncertain': uncertain,
+        'threshold_used': threshold,
+        'raw_prediction': raw,
+        'message': PNEUMONIA_MESSAGES['uncertain' if uncertain else 'pneumonia' if positive else 'normal'],
+        'recommendations': PNEUMONIA_RECOMMENDATIONS['pneumonia' if positive else 'normal'],
+    }
+
+
+def pneumonia_results(outputs, compact=False, calibration=None):
+    """Result payloads for (n, k) pneumonia model output rows, one per row.
+
+    A row is pneumonia at or above the calibrated threshold, and uncertain
+    inside the uncertain band. A positive row inside the band is reported as
+    'uncertain' with a neutral 0.5 confidence.
+    """
+    calibration = calibration or DEFAULT_CALIBRATIONS['pneumonia']
+    outputs = np.asarray(outputs)
+    if len(outputs) == 1:
+        # Single image: scalar decision, no array setup
+        row = outputs[0]
+        pneumonia, normal, has_pneumonia, is_uncertain = calibration.decide_row(row)
+        flagged = is_uncertain and has_pneumonia
+        confidence = 0.5 if flagged else pneumonia if has_pneumonia else normal
+        code = 2 if flagged else int(has_pneumonia)
+        if logger.isEnabledFor(logging.DEBUG):
+            _log_pneumonia_row(row, pneumonia, code, is_uncertain, calibration)
+        raw = None if compact else np.atleast_1d(row).tolist()
+        return [_pneumonia_result(
+            code, round(confidence, 4), round(pneumonia, 4), round(normal, 4), is_uncertain, has_pneumonia,
+            raw, calibration.threshold, compact,
+        )]
+
+    pneumonia, normal, has_pneumonia, is_uncertain = calibration.decide(outputs)
+    flagged = is_uncertain & has_pneumonia
+    confidence = np.where(flagged, 0.5, np.where(has_pneumonia, pneumonia, normal))
+    codes = np.where(flagged, 2, has_pneumonia)
+
+    if logger.isEnabledFor(logging.DEBUG):
+        for row, p, code, uncertain in zip(outputs, pneumonia, codes, is_uncertain):
+            _log_pneumonia_row(row, p, code, uncertain, calibration)
+
+    # One rounding pass for the three probability columns
+    confidence, pneumonia, normal = np.round(np.stack([confidence, pneumonia, normal]).astype(np.float64), 4).tolist()
+    raw_rows = [None] * len(outputs) if compact else outputs.reshape(len(outputs), -1).tolist()
+    return [
+        _pneumonia_result(code, row_confidence, p, n, uncertain, positive, raw, calibration.threshold, compact)
+        for code, row_confidence, p, n, uncertain, positive, raw in zip(
+            codes.tolist(), confidence, pneumonia, normal, is_uncertain.tolist(), has_pneumonia.tolist(), raw_rows,
+        )
+    ]
+
+
+def build_malaria_result(prediction, compact=False, calibration=None):
+    """Turn one row of malaria model output into the API response payload"""
+    return malaria_results(np.asarray(prediction)[np.newaxis], compact, calibration)[0]
+
+
+def build_pneumonia_result(prediction, compact=False, calibration=None):
+    """Turn one row of pneumonia model output into the API response payload"""
+    return pneumonia_results(np.asarray(prediction)[np.newaxis], compact, calibration)[0]
@@ -0,0 +1,364 @@
+"""
+Offline bulk scoring of image archives.
+
+Re-scores a directory tree or a manifest of images with the same
+preprocessing, model loading and result interpretation as the service, but
+without HTTP. Files are read and preprocessed up to --prefetch batches ahead
+of inference in a worker pool (thread or process, as PREPROCESS_POOL), so
+decoding overlaps with the batched forward passes. Results are streamed to
+CSV, JSONL or Parquet in input order.
+
+Progress is checkpointed to <output>.checkpoint.json every
+--checkpoint-every images. Rerunning the same command resumes after the last
+checkpoint; rows an interrupted run wrote after it are discarded first.
+
+Usage:
+    python score_archive.py --model malaria --input-dir /data/smears --output smears.csv
+    python score_archive.py --model pneumonia --manifest xrays.txt --output xrays.jsonl --backend tflite
+    python score_archive.py --model pneumonia --input-dir /data/xrays --output xrays.parquet --pool process
+
+Inputs:
+    --input-dir  every image under the folder (recursively), in sorted order;
+                 paths in the output are relative to the folder
+    --manifest   a text file with one image path per line, or a .csv file
+                 with a 'path' column; relative paths are resolved against
+                 the manifest's folder
+
+Parquet output needs pyarrow (pip install pyarrow). It is written as a
+directory of part files, one per checkpoint, readable as one dataset.
+"""
+
+import argparse
+import collections
+import csv
+import hashlib
+import itertools
+import json
+import os
+import shutil
+import sys
+import time
+from concurrent.futures import Future
+
+import numpy as np
+
+from backends import BACKENDS, QUANTIZATIONS
+from export_optimized import list_images
+from model_loading import load_malaria_model, load_pneumonia_model
+from preprocess_pool import PreprocessPool
+from results import malaria_results, pneumonia_results
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+MODEL_DIR = os.environ.get('MODEL_DIR', os.path.join(BASE_DIR, 'lib', 'model'))
+
+MODELS = {
+    'malaria': (load_malaria_model, malaria_results),
+    'pneumonia': (load_pneumonia_model, pneumonia_results),
+}
+
+OUTPUT_FORMATS = ('csv', 'jsonl', 'parquet')
+
+# Output columns; scores is the raw model output row
+COLUMNS = ('path', 'prediction', 'confidence', 'scores', 'error')
+
+
+def read_manifest(manifest_path):
+    """Image paths listed in a manifest, in manifest order"""
+    base_dir = os.path.dirname(os.path.abspath(manifest_path))
+    with open(manifest_path, newline='') as f:
+        if manifest_path.lower().endswith('.csv'):
+            entries = [row['path'] for row in csv.DictReader(f)]
+        else:
+            entries = [line.strip() for line in f]
+    return [
+        (entry, os.path.join(base_dir, entry))
+        for entry in entries
+        if entry and not entry.startswith('#')
+    ]
+
+
+def collect_inputs(args):
+    """(display path, file path) pairs to score, in a stable order"""
+    if args.manifest:
+        return read_manifest(args.manifest)
+    return [(os.path.relpath(path, args.input_dir), path) for path in list_images(args.input_dir)]
+
+
+def inputs_digest(inputs):
+    """Hash of the input list, so a checkpoint is only resumed for the same inputs"""
+    digest = hashlib.blake2b(digest_size=16)
+    for display_path, _ in inputs:
+        digest.update(display_path.encode('utf8', 'surrogateescape') + b'\0')
+    return digest.hexdigest()
+
+
+class _FileWriter:
+    """Appends rows to a single CSV or JSONL file; the position is a byte offset"""
+
+    def __init__(self, path, position):
+        self.path = path
+        mode = 'r+' if position and os.path.exists(path) else 'w'
+        self._file = open(path, mode, newline='', encoding='utf8')
+        # Drop rows written after the last checkpoint
+        self._file.truncate(position)
+        self._file.seek(position)
+        if position == 0:
+            self._write_header()
+
+    def _write_header(self):
+        pass
+
+    def commit(self):
+        """Make every row written so far durable; returns the resume position"""
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        return self._file.tell()
+
+    def close(self):
+        self._file.close()
+
+
+class CsvWriter(_FileWriter):
+    def __init__(self, path, position):
+        self._csv = None
+        super().__init__(path, position)
+        self._csv = csv.writer(self._file)
+
+    def _write_header(self):
+        csv.writer(self._file).writerow(COLUMNS)
+
+    def write(self, row):
+        self._csv.writerow([json.dumps(row[name]) if name == 'scores' else row[name] for name in COLUMNS])
+
+
+class JsonlWriter(_FileWriter):
+    def write(self, row):
+        self._file.write(json.dumps(row) + '\n')
+
+
+class ParquetWriter:
+    """Writes each checkpoint's rows as a part file; the position is the part count"""
+
+    def __init__(self, path, position):
+        self.path = path
+        self._parts = position
+        self._rows = []
+        os.makedirs(path, exist_ok=True)
+        # Drop parts written after the last checkpoint
+        for name in os.listdir(path):
+            if name.startswith('part-') and int(name[5:10]) >= position:
+                os.remove(os.path.join(path, name))
+
+    def write(self, row):
+        self._rows.append(row)
+
+    def commit(self):
+        if self._rows:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+
+            part_path = os.path.join(self.path, f'part-{self._parts:05d}.parquet')
+            pq.write_table(pa.Table.from_pylist(self._rows), part_path + '.tmp')
+            os.replace(part_path + '.tmp', part_path)
+            self._parts += 1
+            self._rows = []
+        return self._parts
+
+    def close(self):
+        pass
+
+
+WRITERS = {'csv': CsvWriter, 'jsonl': JsonlWriter, 'parquet': ParquetWriter}
+
+
+class Checkpoint:
+    """Progress of a scoring run, stored next to its output"""
+
+    def __init__(self, output_path):
+        self.path = output_path.rstrip(os.sep) + '.checkpoint.json'
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return None
+        with open(self.path) as f:
+            return json.load(f)
+
+    def save(self, state):
+        # Write and rename so an interruption never leaves a truncated checkpoint
+        with open(self.path + '.tmp', 'w') as f:
+            json.dump(state, f, indent=2)
+        os.replace(self.path + '.tmp', self.path)
+
+
+def iter_batches(inputs, pool, batch_size, prefetch, enhance_contrast):
+    """Yield batches of (display path, Future of the model input).
+
+    Up to prefetch batches are read and submitted to the preprocessing pool
+    ahead of the batch being yielded, so decoding runs while the caller is
+    waiting on inference.
+    """
+    def submit(display_path, file_path):
+        try:
+            with open(file_path, 'rb') as f:
+                return display_path, pool.submit(f.read(), enhance_contrast)
+        except OSError as e:
+            future = Future()
+            future.set_exception(e)
+            return display_path, future
+
+    remaining = iter(inputs)
+    pending = collections.deque(submit(*item) for item in itertools.islice(remaining, batch_size * prefetch))
+    while pending:
+        batch = [pending.popleft() for _ in range(min(batch_size, len(pending)))]
+        pending.extend(submit(*item) for item in itertools.islice(remaining, batch_size))
+        yield batch
+
+
+def score_batch(loaded, build_results_fn, batch):
+    """Output rows for one batch, in batch order; unreadable images get an error row"""
+    rows = [None] * len(batch)
+    ok_indices = []
+    ok_arrays = []
+    for index, (display_path, future) in enumerate(batch):
+        try:
+            ok_arrays.append(future.result())
+            ok_indices.append(index)
+        except Exception as e:
+            rows[index] = {
+                'path': display_path, 'prediction': None, 'confidence': None, 'scores': None,
+                'error': f'Could not process image: {str(e)}',
+            }
+
+    if ok_arrays:
+        predictions = loaded.model.predict(np.concatenate(ok_arrays, axis=0))
+        results = build_results_fn(predictions, calibration=loaded.calibration)
+        for index, prediction, result in zip(ok_indices, predictions, results):
+            rows[index] = {
+                'path': batch[index][0],
+                'prediction': result['prediction'],
+                'confidence': round(float(result['confidence']), 4),
+                'scores': np.asarray(prediction, dtype=np.float64).round(6).tolist(),
+                'error': None,
+            }
+    return rows
+
+
+def output_format(args):
+    if args.format:
+        return args.format
+    extension = os.path.splitext(args.output.rstrip(os.sep))[1].lower().lstrip('.')
+    if extension not in OUTPUT_FORMATS:
+        raise SystemExit(f"Cannot infer the output format from '{args.output}'; pass --format")
+    return extension
+
+
+def score_archive(args):
+    fmt = output_format(args)
+    if fmt == 'parquet':
+        try:
+            import pyarrow  # noqa: F401
+        except ImportError:
+            print("Error: Parquet output needs pyarrow: pip install pyarrow")
+            return False
+    inputs = collect_inputs(args)
+    digest = inputs_digest(inputs)
+    print(f"{len(inputs):,} images to score with the {args.model} model")
+
+    checkpoint = Checkpoint(args.output)
+    state = None if args.overwrite else checkpoint.load()
+    if state is not None:
+        if state['inputs'] != digest or state['model'] != args.model or state['format'] != fmt:
+            print(f"Error: {checkpoint.path} belongs to a different run (inputs, model or format changed)")
+            print("   Pass --overwrite to start over")
+            return False
+        if state['done'] >= len(inputs):
+            print(f"Already complete: {args.output}")
+            return True
+        print(f"Resuming after {state['done']:,} images")
+    elif os.path.exists(args.output) and not args.overwrite:
+        print(f"Error: {args.output} exists and has no checkpoint; pass --overwrite to replace it")
+        return False
+    elif os.path.isdir(args.output):
+        shutil.rmtree(args.output)
+
+    # Process-mode workers fork before the model is loaded, which is what
+    # imports TensorFlow here, as in the service
+    pool = PreprocessPool(args.pool, args.workers)
+    load_model, build_results_fn = MODELS[args.model]
+    loaded = load_model(
+        args.model_dir, args.backend, args.quantization,
+        jit_compile=args.xla, num_threads=args.inference_threads,
+    )
+    if state is not None and state['model_id'] != loaded.model_id:
+        print(f"Warning: the model changed since the checkpoint ({state['model_id']} -> {loaded.model_id})")
+
+    done = state['done'] if state else 0
+    writer = WRITERS[fmt](args.output, state['position'] if state else 0)
+    state = {
+        'model': args.model, 'model_id': loaded.model_id, 'format': fmt,
+        'inputs': digest, 'total': len(inputs), 'done': done, 'position': 0, 'failed': state['failed'] if state else 0,
+    }
+
+    def save_checkpoint():
+        state['position'] = writer.commit()
+        state['done'] = done
+        checkpoint.save(state)
+
+    started = time.perf_counter()
+    scored = 0
+    last_checkpoint = done
+    try:
+        # Both endpoints preprocess with contrast enhancement
+        batches = iter_batches(inputs[done:], pool, args.batch_size, args.prefetch, enhance_contrast=True)
+        for batch in batches:
+            for row in score_batch(loaded, build_results_fn, batch):
+                writer.write(row)
+                state['failed'] += row['error'] is not None
+            done += len(batch)
+            scored += len(batch)
+            if done - last_checkpoint >= args.checkpoint_every:
+                save_checkpoint()
+                last_checkpoint = done
+                rate = scored / (time.perf_counter() - started)
+                print(f"   {done:,}/{len(inputs):,} images ({rate:.1f} images/s)")
+        save_checkpoint()
+    except KeyboardInterrupt:
+        # Everything written so far is complete rows; keep it
+        save_checkpoint()
+        print(f"\nInterrupted after {done:,} images; rerun the same command to resume")
+        return False
+    finally:
+        writer.close()
+        pool.shutdown()
+
+    elapsed = time.perf_counter() - started
+    print(f"✓ Scored {scored:,} images in {elapsed:.1f} s ({scored / max(elapsed, 1e-9):.1f} images/s)")
+    print(f"   Failed: {state['failed']:,}   Output: {args.output}")
+    return True
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--model', choices=sorted(MODELS), required=True)
+    inputs = parser.add_mutually_exclusive_group(required=True)
+    inputs.add_argument('--input-dir', help='folder of images to score (recursively)')
+    inputs.add_argument('--manifest', help='text file with one image path per line, or .csv with a path column')
+    parser.add_argument('--output', required=True, help='output file (.csv, .jsonl) or directory (.parquet)')
+    parser.add_argument('--format', choices=OUTPUT_FORMATS, help='output format (default: from the output extension)')
+    parser.add_argument('--overwrite', action='store_true', help='ignore any checkpoint and start over')
+    parser.add_argument('--model-dir', default=MODEL_DIR)
+    parser.add_argument('--backend', choices=BACKENDS, default='keras')
+    parser.add_argument('--quantization', choices=QUANTIZATIONS, default='none')
+    parser.add_argument('--xla', action='store_true', help='compile the Keras model with XLA')
+    parser.add_argument('--inference-threads', type=int, help='threads for the TFLite / ONNX Runtime backends')
+    parser.add_argument('--batch-size', type=int, default=64)
+    parser.add_argument('--prefetch', type=int, default=4, help='batches read and preprocessed ahead of inference')
+    parser.add_argument('--pool', choices=PreprocessPool.MODES, default='thread', help='preprocessing pool mode')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help='preprocessing threads/processes')
+    parser.add_argument('--checkpoint-every', type=int, default=1024, help='images between checkpoints')
+    return score_archive(parser.parse_args())
+
+
+if __name__ == '__main__':
+    success = main()
+    sys.exit(0 if success else 1)
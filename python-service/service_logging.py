@@ -0,0 +1,63 @@
+"""
+Logging setup for the service.
+
+LOG_LEVEL gates what the service logger writes; per-request diagnostics are
+logged at DEBUG so they cost nothing at the default INFO level. Third-party
+libraries stay at INFO or above so LOG_LEVEL=DEBUG does not turn on their
+debug output. LOG_FORMAT=json writes one JSON object per line for log
+shippers; the default is plain text.
+
+Structured fields are passed as ``extra={'fields': {...}}``. The text format
+appends them as key=value pairs, the JSON format merges them into the object.
+"""
+
+import json
+import logging
+import sys
+import time
+
+SERVICE_LOGGER = 'medical_service'
+
+
+class TextFormatter(logging.Formatter):
+    """Plain-text lines with structured fields appended as key=value"""
+
+    def __init__(self):
+        super().__init__('%(asctime)s %(levelname)s %(name)s: %(message)s')
+
+    def formatMessage(self, record):
+        message = super().formatMessage(record)
+        fields = getattr(record, 'fields', None)
+        if fields:
+            message += ' ' + ' '.join(f'{name}={value}' for name, value in fields.items())
+        return message
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line"""
+
+    def format(self, record):
+        entry = {
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(record.created)) + f'.{int(record.msecs):03d}Z',
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+        entry.update(getattr(record, 'fields', None) or {})
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+def configure_logging(level='INFO', fmt='text'):
+    """Set the service log level and install a stdout handler on the root
+    logger unless one is configured already"""
+    level = logging.getLevelName(level.upper())
+    logging.getLogger(SERVICE_LOGGER).setLevel(level)
+    root = logging.getLogger()
+    root.setLevel(max(level, logging.INFO))
+    if root.handlers:
+        return
+    handler = logging.StreamHandler(sys.stdout)
+    handler.setFormatter(JsonFormatter() if fmt == 'json' else TextFormatter())
+    root.addHandler(handler)
@@ -0,0 +1,110 @@
+"""
+Admission control: deadline headers, the per-model cap, and the 429 / 503 /
+504 responses of the prediction endpoints.
+
+    cd python-service && python -m pytest tests
+"""
+
+import os
+import sys
+import time
+
+import pytest
+
+SERVICE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[:0] = [SERVICE_DIR]
+
+from admission import DEADLINE_HEADER, TIMEOUT_HEADER, AdmissionControl, deadline_passed, request_deadline  # noqa: E402
+
+
+def test_deadline_header_is_epoch_milliseconds():
+    assert request_deadline({DEADLINE_HEADER: '1700000000500'}, received_at=5.0) == 1700000000.5
+
+
+def test_timeout_header_is_relative_to_receipt():
+    assert request_deadline({TIMEOUT_HEADER: '2500'}, received_at=100.0) == 102.5
+
+
+def test_earlier_of_both_deadlines_applies():
+    headers = {DEADLINE_HEADER: '101000', TIMEOUT_HEADER: '5000'}
+    assert request_deadline(headers, received_at=100.0) == 101.0
+    assert request_deadline(headers, received_at=95.0) == 100.0
+
+
+@pytest.mark.parametrize('value', ['soon', '', 'inf', 'nan'])
+def test_malformed_deadlines_are_ignored(value):
+    assert request_deadline({DEADLINE_HEADER: value, TIMEOUT_HEADER: value}, received_at=100.0) is None
+
+
+def test_no_deadline():
+    assert request_deadline({}, received_at=100.0) is None
+    assert not deadline_passed(None)
+    assert deadline_passed(time.time() - 1)
+    assert not deadline_passed(time.time() + 60)
+
+
+def test_cap_per_model():
+    admission = AdmissionControl(['malaria', 'pneumonia'], max_pending=1)
+    assert admission.try_admit('malaria')
+    assert admission.saturated('malaria')
+    assert not admission.try_admit('malaria')
+    # Models are capped separately
+    assert admission.try_admit('pneumonia')
+    admission.release('malaria')
+    assert admission.try_admit('malaria')
+    assert admission.stats()['malaria'] == {'pending': 1, 'max_pending': 1, 'rejected': 1}
+
+
+def test_zero_cap_admits_everything():
+    admission = AdmissionControl(['malaria'], max_pending=0)
+    assert all(admission.try_admit('malaria') for _ in range(100))
+    assert not admission.saturated('malaria')
+    assert admission.stats()['malaria'] == {'pending': 100, 'max_pending': None, 'rejected': 0}
+
+
+@pytest.fixture(scope='module')
+def service(tmp_path_factory):
+    """The Flask app with no model files; admission runs before the model is needed"""
+    os.environ.update({
+        'MODEL_DIR': str(tmp_path_factory.mktemp('models')),
+        'LAZY_MODELS': 'malaria,pneumonia',
+        'MODEL_WATCH_INTERVAL': '0',
+        'INFERENCE_WARMUP': '0',
+        'ADMISSION_MAX_PENDING': '1',
+        'ADMISSION_RETRY_AFTER': '3',
+        'PREDICTION_CACHE_SIZE': '0',
+    })
+    pytest.importorskip('tensorflow')
+    import app as service
+    return service
+
+
+def test_over_the_cap_is_429_with_retry_after(service):
+    assert service.admission.try_admit('malaria')
+    try:
+        response = service.app.test_client().post('/predict')
+    finally:
+        service.admission.release('malaria')
+    assert response.status_code == 429
+    assert response.headers['Retry-After'] == '3'
+    assert response.get_json()['error'] == 'Too many malaria requests in progress'
+
+
+def test_full_batch_queue_is_503_with_retry_after(service, monkeypatch):
+    monkeypatch.setattr(service.batchers['pneumonia'], 'queue_full', lambda: True)
+    response = service.app.test_client().post('/pneumonia-predict')
+    assert response.status_code == 503
+    assert response.headers['Retry-After'] == '3'
+    assert 'queue is full' in response.get_json()['error']
+    # A refused request is not counted against the cap
+    assert service.admission.stats()['pneumonia']['pending'] == 0
+
+
+@pytest.mark.parametrize('headers', [
+    {DEADLINE_HEADER: str(int((time.time() - 1) * 1000))},
+    {TIMEOUT_HEADER: '0'},
+])
+def test_passed_deadline_is_504(service, headers):
+    response = service.app.test_client().post('/predict', headers=headers)
+    assert response.status_code == 504
+    assert 'Retry-After' not in response.headers
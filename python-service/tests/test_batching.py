@@ -0,0 +1,153 @@
+"""
+MicroBatcher: coalescing per model version, the queue bound and deadlines.
+
+Each test holds the batcher's worker inside a first forward pass, so the
+requests submitted meanwhile are queued together deterministically.
+
+    cd python-service && python -m pytest tests
+"""
+
+import os
+import sys
+import threading
+import time
+
+import numpy as np
+import pytest
+
+SERVICE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[:0] = [SERVICE_DIR]
+
+from batching import DeadlineExceeded, MicroBatcher, QueueFull  # noqa: E402
+
+
+class HeldModel:
+    """predict_fn recording each batch; the first batch waits for release()"""
+
+    def __init__(self):
+        self.batches = []
+        self.running = threading.Event()
+        self._release = threading.Event()
+
+    def __call__(self, inputs, key):
+        self.batches.append((key, inputs[:, 0].tolist()))
+        self.running.set()
+        self._release.wait(5)
+        return inputs * 10
+
+    def release(self):
+        self._release.set()
+
+
+def rows(*values):
+    return np.array(values, dtype=np.float32).reshape(-1, 1)
+
+
+@pytest.fixture
+def held():
+    model = HeldModel()
+    yield model
+    model.release()
+
+
+def hold(batcher, model, key=None):
+    """Occupy the worker with a one-row batch; returns its future"""
+    future = batcher.submit(rows(0), key)
+    assert model.running.wait(5)
+    return future
+
+
+def test_concurrent_requests_share_a_forward_pass(held):
+    batcher = MicroBatcher('test', held, max_batch_size=8, max_wait_ms=0)
+    first = hold(batcher, held)
+    futures = [batcher.submit(rows(value), None) for value in (1, 2, 3)]
+    held.release()
+    first.result(5)
+    assert [future.result(5)[:, 0].tolist() for future in futures] == [[10.0], [20.0], [30.0]]
+    assert held.batches[1] == (None, [1.0, 2.0, 3.0])
+    assert batcher.stats()['batch_size_histogram'] == {'1': 1, '3': 1}
+
+
+def test_batches_never_mix_model_versions(held):
+    batcher = MicroBatcher('test', held, max_batch_size=8, max_wait_ms=0)
+    old, new = object(), object()
+    first = hold(batcher, held, old)
+    futures = [batcher.submit(rows(value), key) for value, key in ((1, old), (2, new), (3, old), (4, new))]
+    held.release()
+    first.result(5)
+    assert [future.result(5)[0, 0] for future in futures] == [10.0, 20.0, 30.0, 40.0]
+    # Queued requests of the first batch's version go first, the others keep their order
+    assert held.batches[1:] == [(old, [1.0, 3.0]), (new, [2.0, 4.0])]
+
+
+def test_batch_size_is_capped(held):
+    batcher = MicroBatcher('test', held, max_batch_size=2, max_wait_ms=0)
+    first = hold(batcher, held)
+    futures = [batcher.submit(rows(value), None) for value in (1, 2, 3)]
+    held.release()
+    first.result(5)
+    for future in futures:
+        future.result(5)
+    assert [values for _, values in held.batches[1:]] == [[1.0, 2.0], [3.0]]
+
+
+def test_full_queue_refuses_rows(held):
+    batcher = MicroBatcher('test', held, max_batch_size=8, max_wait_ms=0, max_queue=2)
+    first = hold(batcher, held)
+    queued = batcher.submit(rows(1, 2), None)
+    assert batcher.queue_full()
+    with pytest.raises(QueueFull):
+        batcher.submit(rows(3), None)
+    held.release()
+    first.result(5)
+    assert queued.result(5)[:, 0].tolist() == [10.0, 20.0]
+    assert batcher.stats()['rejected'] == 1
+    assert not batcher.queue_full()
+
+
+def test_oversized_request_is_accepted_into_an_empty_queue(held):
+    batcher = MicroBatcher('test', held, max_batch_size=2, max_wait_ms=0, max_queue=2)
+    held.release()
+    assert batcher.predict(rows(1, 2, 3), timeout=5)[:, 0].tolist() == [10.0, 20.0, 30.0]
+
+
+def test_passed_deadline_is_refused_at_submit(held):
+    batcher = MicroBatcher('test', held)
+    with pytest.raises(DeadlineExceeded):
+        batcher.submit(rows(1), None, deadline=time.time() - 1)
+    assert batcher.stats()['expired'] == 1
+    assert held.batches == []
+
+
+def test_request_expiring_in_the_queue_is_not_run(held):
+    batcher = MicroBatcher('test', held, max_batch_size=8, max_wait_ms=0)
+    first = hold(batcher, held)
+    expiring = batcher.submit(rows(1), None, deadline=time.time() + 0.05)
+    kept = batcher.submit(rows(2), None, deadline=time.time() + 60)
+    time.sleep(0.1)
+    held.release()
+    first.result(5)
+    with pytest.raises(DeadlineExceeded):
+        expiring.result(5)
+    assert kept.result(5)[0, 0] == 20.0
+    assert held.batches[1:] == [(None, [2.0])]
+
+
+def test_tuple_outputs_are_sliced_per_request(held):
+    def predict(inputs, key):
+        return inputs * 10, inputs[:, 0] + 100
+
+    held.release()
+    batcher = MicroBatcher('test', predict, max_batch_size=8, max_wait_ms=50)
+    futures = [batcher.submit(rows(value), None) for value in (1, 2)]
+    outputs, activations = futures[1].result(5)
+    assert outputs[:, 0].tolist() == [20.0] and activations.tolist() == [102.0]
+
+
+def test_errors_reach_every_request_of_the_batch():
+    def predict(inputs, key):
+        raise ValueError('forward pass failed')
+
+    batcher = MicroBatcher('test', predict)
+    with pytest.raises(ValueError, match='forward pass failed'):
+        batcher.predict(rows(1), timeout=5)
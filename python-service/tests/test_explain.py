@@ -0,0 +1,79 @@
+"""
+Grad-CAM on the model shapes the service loads: a Sequential CNN saved as
+.h5, and a residual network whose last convolution sits inside a block.
+
+    cd python-service && python -m pytest tests
+"""
+
+import os
+import sys
+
+import numpy as np
+import pytest
+
+SERVICE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[:0] = [SERVICE_DIR]
+
+tf = pytest.importorskip('tensorflow')
+keras = tf.keras
+
+from backends import IMAGE_SHAPE  # noqa: E402
+from explain import GradCam, find_target_layer  # noqa: E402
+from model_loading import load_keras_model  # noqa: E402
+
+
+def sequential_cnn():
+    return keras.Sequential([
+        keras.Input(IMAGE_SHAPE),
+        keras.layers.Conv2D(4, 3, strides=4, activation='relu'),
+        keras.layers.Conv2D(8, 3, strides=2, activation='relu', name='last_conv'),
+        keras.layers.GlobalAveragePooling2D(),
+        keras.layers.Dense(2, activation='softmax'),
+    ])
+
+
+def residual_cnn():
+    inputs = keras.Input(IMAGE_SHAPE)
+    x = keras.layers.Conv2D(8, 3, strides=4, padding='same', activation='relu')(inputs)
+    y = keras.layers.DepthwiseConv2D(3, padding='same', name='block_depthwise')(x)
+    x = keras.layers.Add(name='block_add')([x, y])
+    outputs = keras.layers.Dense(1, activation='sigmoid')(keras.layers.GlobalAveragePooling2D()(x))
+    return keras.Model(inputs, outputs)
+
+
+def images(count=2):
+    return np.random.default_rng(0).random((count,) + IMAGE_SHAPE, dtype=np.float32)
+
+
+def check_heatmaps(gradcam, model):
+    outputs, activations = gradcam.forward(images())
+    np.testing.assert_allclose(outputs.numpy(), model(images(), training=False).numpy(), rtol=1e-5, atol=1e-6)
+    # The head reproduces the model output from the feature maps alone
+    np.testing.assert_allclose(gradcam._head(activations).numpy(), outputs.numpy(), rtol=1e-5, atol=1e-6)
+    heatmaps = gradcam.heatmaps(activations.numpy())
+    assert heatmaps.shape == (2,) + tuple(activations.shape[1:3])
+    assert heatmaps.min() >= 0.0 and heatmaps.max() <= 1.0 + 1e-6
+
+
+def test_sequential_h5_model(tmp_path):
+    path = str(tmp_path / 'sequential.h5')
+    sequential_cnn().save(path)
+    backend = load_keras_model(path, explain=True)
+    assert backend.gradcam is not None
+    assert backend.gradcam.layer_name == 'last_conv'
+    check_heatmaps(backend.gradcam, backend.model)
+    outputs, activations = backend.predict_with_activations(images())
+    assert outputs.shape == (2, 2) and activations.shape[0] == 2
+
+
+def test_residual_block_targets_block_output():
+    model = residual_cnn()
+    # The depthwise convolution is bypassed by the skip connection
+    assert find_target_layer(model).name == 'block_add'
+    gradcam = GradCam(model)
+    check_heatmaps(gradcam, model)
+
+
+def test_bypassed_layer_name_is_refused():
+    with pytest.raises(ValueError):
+        GradCam(residual_cnn(), 'block_depthwise')
@@ -0,0 +1,83 @@
+"""
+Weight assignment of TFJS models: by name only, unless positional
+assignment is asked for.
+
+    cd python-service && python -m pytest tests
+"""
+
+import logging
+import os
+import sys
+
+import numpy as np
+import pytest
+
+SERVICE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[:0] = [SERVICE_DIR]
+
+tf = pytest.importorskip('tensorflow')
+
+from model_conversion import ConversionError, _assign_weights  # noqa: E402
+from service_logging import SERVICE_LOGGER  # noqa: E402
+
+
+def batchnorm_model():
+    # gamma, beta, moving mean and variance all have the same shape
+    return tf.keras.Sequential([
+        tf.keras.Input((4,)),
+        tf.keras.layers.Dense(3, name='dense'),
+        tf.keras.layers.BatchNormalization(name='norm'),
+    ], name='model')
+
+
+def tfjs_weights(model, rename=None):
+    """{TFJS-style weight name: array} of a model, with `rename` applied"""
+    rng = np.random.default_rng(0)
+    weights = {}
+    for variable in model.weights:
+        # layer/weight, without the model name Keras prefixes
+        name = variable.path.split('/', 1)[1]
+        weights[(rename or {}).get(name, name)] = rng.random(tuple(variable.shape), dtype=np.float32)
+    return weights
+
+
+def test_weights_are_matched_by_name():
+    model = batchnorm_model()
+    weights = tfjs_weights(model)
+    # The TFJS order differs from the model's: names decide
+    shuffled = dict(reversed(list(weights.items())))
+    _assign_weights(model, shuffled)
+    for variable in model.weights:
+        np.testing.assert_array_equal(variable.numpy(), weights[variable.path.split('/', 1)[1]])
+
+
+def test_unmatched_name_is_refused():
+    model = batchnorm_model()
+    before = [variable.numpy() for variable in model.weights]
+    weights = tfjs_weights(model, rename={'norm/gamma': 'norm/scale'})
+    with pytest.raises(ConversionError, match='by name'):
+        _assign_weights(model, weights)
+    for variable, value in zip(model.weights, before):
+        np.testing.assert_array_equal(variable.numpy(), value)
+
+
+def test_positional_assignment_is_logged(caplog):
+    model = batchnorm_model()
+    weights = tfjs_weights(model, rename={'norm/gamma': 'norm/scale'})
+    with caplog.at_level(logging.WARNING, logger=SERVICE_LOGGER):
+        _assign_weights(model, weights, positional=True)
+    assert [record.getMessage() for record in caplog.records] == [
+        'Assigning TFJS weight norm/scale to model/norm/gamma by position',
+    ]
+    np.testing.assert_array_equal(model.get_layer('norm').gamma.numpy(), weights['norm/scale'])
+
+
+def test_positional_assignment_refuses_named_weights_out_of_place():
+    model = batchnorm_model()
+    weights = tfjs_weights(model, rename={'norm/gamma': 'norm/scale'})
+    items = list(weights.items())
+    # Swap beta and the moving mean: same shape, but their names say otherwise
+    beta, mean = [index for index, (name, _) in enumerate(items) if name in ('norm/beta', 'norm/moving_mean')]
+    items[beta], items[mean] = items[mean], items[beta]
+    with pytest.raises(ConversionError, match='matches another by name'):
+        _assign_weights(model, dict(items), positional=True)
@@ -0,0 +1,139 @@
+"""
+PredictionCache: LRU eviction, TTL expiry, the disk tier across instances,
+and what the cache key covers.
+
+    cd python-service && python -m pytest tests
+"""
+
+import os
+import sys
+import time
+
+import numpy as np
+import pytest
+
+SERVICE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[:0] = [SERVICE_DIR]
+
+import prediction_cache  # noqa: E402
+from prediction_cache import PredictionCache  # noqa: E402
+
+
+class Clock:
+    """Stand-in for time.time that only moves when told to"""
+
+    def __init__(self):
+        self.now = time.time()
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(prediction_cache.time, 'time', clock)
+    return clock
+
+
+def row(value):
+    return np.array([value], dtype=np.float32)
+
+
+def test_least_recently_used_entry_is_evicted():
+    cache = PredictionCache(max_entries=2)
+    cache.put('a', row(1))
+    cache.put('b', row(2))
+    # Reading 'a' makes 'b' the least recently used
+    assert cache.get('a')[0] == 1
+    cache.put('c', row(3))
+    assert cache.get('b') is None
+    assert cache.get('a')[0] == 1 and cache.get('c')[0] == 3
+    stats = cache.stats()
+    assert (stats['entries'], stats['evictions'], stats['hits'], stats['misses']) == (2, 1, 3, 1)
+
+
+def test_entries_expire_after_ttl(clock):
+    cache = PredictionCache(ttl_seconds=60)
+    cache.put('a', row(1))
+    clock.now += 59
+    assert cache.get('a') is not None
+    clock.now += 2
+    assert cache.get('a') is None
+    stats = cache.stats()
+    assert (stats['entries'], stats['expirations'], stats['misses']) == (0, 1, 1)
+
+
+def test_stored_value_is_a_read_only_copy():
+    cache = PredictionCache()
+    value = row(1)
+    cache.put('a', value)
+    value[0] = 5
+    cached = cache.get('a')
+    assert cached[0] == 1
+    with pytest.raises(ValueError):
+        cached[0] = 2
+
+
+def test_zero_entries_disables_the_cache(tmp_path):
+    cache = PredictionCache(max_entries=0, disk_dir=str(tmp_path))
+    cache.put('a', row(1))
+    assert cache.get('a') is None
+    assert not cache.stats()['enabled']
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_disk_tier_survives_a_new_instance(tmp_path):
+    PredictionCache(disk_dir=str(tmp_path)).put('ab12', row(7))
+    assert (tmp_path / 'ab' / 'ab12.npy').is_file()
+
+    cache = PredictionCache(disk_dir=str(tmp_path))
+    value = cache.get('ab12')
+    np.testing.assert_array_equal(value, row(7))
+    assert not value.flags.writeable
+    # The disk hit is promoted into memory
+    assert cache.get('ab12') is not None
+    stats = cache.stats()
+    assert (stats['disk_hits'], stats['hits'], stats['entries']) == (1, 1, 1)
+
+
+def test_expired_disk_entry_is_removed(tmp_path):
+    PredictionCache(disk_dir=str(tmp_path)).put('ab12', row(7))
+    path = tmp_path / 'ab' / 'ab12.npy'
+    old = time.time() - 120
+    os.utime(path, (old, old))
+
+    cache = PredictionCache(ttl_seconds=60, disk_dir=str(tmp_path))
+    assert cache.get('ab12') is None
+    assert not path.exists()
+    assert cache.stats()['expirations'] == 1
+
+
+def test_disk_prune_keeps_the_newest_entries(tmp_path, monkeypatch):
+    monkeypatch.setattr(PredictionCache, 'DISK_PRUNE_INTERVAL', 3)
+    cache = PredictionCache(disk_dir=str(tmp_path), disk_max_entries=2)
+    for age, key in ((30, 'aa01'), (20, 'aa02')):
+        cache.put(key, row(age))
+        stamp = time.time() - age
+        os.utime(tmp_path / 'aa' / f'{key}.npy', (stamp, stamp))
+    cache.put('aa03', row(0))
+    assert sorted(os.listdir(tmp_path / 'aa')) == ['aa02.npy', 'aa03.npy']
+
+
+def test_key_covers_model_and_flags():
+    key = PredictionCache.make_key(b'image', 'malaria', 'model.h5:1:2', explain=False)
+    assert key == PredictionCache.make_key(b'image', 'malaria', 'model.h5:1:2', explain=False)
+    others = [
+        PredictionCache.make_key(b'other', 'malaria', 'model.h5:1:2', explain=False),
+        PredictionCache.make_key(b'image', 'pneumonia', 'model.h5:1:2', explain=False),
+        PredictionCache.make_key(b'image', 'malaria', 'model.h5:1:3', explain=False),
+        PredictionCache.make_key(b'image', 'malaria', 'model.h5:1:2', explain=True),
+    ]
+    assert key not in others and len(set(others)) == len(others)
+
+
+@pytest.mark.parametrize('setting', ['PREPROCESSING_VERSION', 'DRAFT_SIZE'])
+def test_key_covers_preprocessing(monkeypatch, setting):
+    key = PredictionCache.make_key(b'image', 'malaria', 'model.h5:1:2')
+    monkeypatch.setattr(prediction_cache, setting, getattr(prediction_cache, setting) + 1)
+    assert PredictionCache.make_key(b'image', 'malaria', 'model.h5:1:2') != key
@@ -0,0 +1,48 @@
+"""
+Equivalence of the optimized preprocessing with the original pipeline
+(benchmarks/legacy_preprocessing.py), on the benchmark's synthetic X-rays.
+
+    cd python-service && python -m pytest tests
+"""
+
+import os
+import sys
+
+import numpy as np
+import pytest
+from PIL import Image
+
+SERVICE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[:0] = [SERVICE_DIR, os.path.join(SERVICE_DIR, 'benchmarks')]
+
+import preprocessing  # noqa: E402
+from preprocess_bench import (  # noqa: E402
+    APPROX_MEAN_TOLERANCE, compare, encode, equivalence_cases, reference_output, synthetic_xray,
+)
+
+CASES = equivalence_cases()
+
+
+@pytest.mark.parametrize('image_bytes', [image_bytes for _, image_bytes in CASES], ids=[label for label, _ in CASES])
+def test_matches_original_pipeline(image_bytes):
+    is_exact, _, mean_diff, flat = compare(image_bytes)
+    assert not flat, 'the reference output is constant, so the comparison proves nothing'
+    assert is_exact
+    assert mean_diff <= APPROX_MEAN_TOLERANCE
+
+
+def test_16bit_image_keeps_its_contrast():
+    image_bytes = encode(synthetic_xray(300, 'I;16'), 'PNG')
+    output = preprocessing.preprocess_image(image_bytes, draft_size=0)
+    assert output.std() > 0.05
+    # Same output as the 8-bit image it scales to
+    np.testing.assert_array_equal(output, reference_output(image_bytes))
+
+
+def test_16bit_scaling_uses_the_full_8bit_range():
+    pixels = np.array([[1000, 1500], [2000, 4000]], dtype=np.uint16)
+    scaled = np.asarray(preprocessing._scale_to_8bit(Image.fromarray(pixels)))
+    assert scaled.dtype == np.uint8
+    assert scaled.min() == 0 and scaled.max() == 255
+    expected = ((pixels.astype(np.float32) - 1000) / np.float32(3000 + 1e-7) * 255).astype(np.uint8)
+    np.testing.assert_array_equal(scaled, expected)
@@ -0,0 +1,59 @@
+"""
+Bounded-memory upload handling.
+
+Werkzeug keeps multipart file parts in a spooled temporary file, and the
+handlers used to read() each upload into a bytes object, so every upload was
+held in memory in full. UploadRequest keeps small requests in memory and
+writes the file parts of larger ones straight to an unnamed temporary file;
+upload_data() memory-maps those files instead of copying them, so a large
+upload costs page cache (reclaimable, shared) rather than heap.
+
+The total request size is capped separately (MAX_UPLOAD_MB in app.py).
+"""
+
+import io
+import mmap
+import os
+import tempfile
+
+from flask import Request
+
+# Requests up to this size keep their file parts in memory; larger ones are
+# spooled to disk and memory-mapped
+UPLOAD_SPOOL_BYTES = int(os.environ.get('UPLOAD_SPOOL_BYTES', str(1024 * 1024)))
+
+
+class UploadRequest(Request):
+    """Flask request that spools large file parts to unnamed temporary files"""
+
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        if total_content_length is not None and total_content_length <= UPLOAD_SPOOL_BYTES:
+            return io.BytesIO()
+        return tempfile.TemporaryFile('w+b')
+
+
+def upload_data(file_storage):
+    """Contents of an uploaded file without copying large uploads.
+
+    Returns bytes for in-memory parts and a read-only mmap for spooled ones;
+    the caller closes the mmap (see close_upload) once the request is done.
+    """
+    stream = file_storage.stream
+    if isinstance(stream, io.BytesIO):
+        return stream.getvalue()
+    stream.flush()
+    size = os.fstat(stream.fileno()).st_size
+    if size == 0:
+        return b''
+    return mmap.mmap(stream.fileno(), size, access=mmap.ACCESS_READ)
+
+
+def close_upload(data):
+    """Release an upload returned by upload_data"""
+    if isinstance(data, mmap.mmap):
+        try:
+            data.close()
+        except BufferError:
+            # Still referenced by a buffer export; the mapping is released
+            # when that goes away
+            pass